@@ -41,6 +41,8 @@ manager.add_command('db', MigrateCommand)
 # Import engine manager here to avoid circular imports
 from ais.engine.manage import manager as engine_manager
 manager.add_command('engine', engine_manager)
+from ais.api.manage import manager as api_manager
+manager.add_command('api', api_manager)
 
 # Init migration extension
 migrate = Migrate(app, app_db)
@@ -0,0 +1,40 @@
+"""
+Compare geocoding a list of addresses with one POST to /batch/addresses against
+one GET to /addresses/ per address.
+
+Usage: python benchmark_batch.py <base url> <file with one address per line> [batch size]
+"""
+import json
+import sys
+import time
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+base_url = sys.argv[1].rstrip('/')
+with open(sys.argv[2]) as f:
+    queries = [line.strip() for line in f if line.strip()]
+batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+queries = queries[:batch_size]
+
+print('Geocoding {} addresses one at a time...'.format(len(queries)))
+start = time.time()
+for query in queries:
+    try:
+        urlopen('{}/addresses/{}'.format(base_url, quote(query))).read()
+    except OSError:
+        # Unmatched addresses respond 404
+        pass
+sequential_time = time.time() - start
+
+print('Geocoding {} addresses in one batch...'.format(len(queries)))
+start = time.time()
+request = Request('{}/batch/addresses'.format(base_url), data=json.dumps(queries).encode('utf-8'),
+                  headers={'Content-Type': 'application/json'})
+with urlopen(request) as response:
+    num_results = sum(1 for line in response if line.strip())
+batch_time = time.time() - start
+assert num_results == len(queries), 'Expected {} results; received {}'.format(len(queries), num_results)
+
+print('Sequential: {:.2f}s ({:.1f} addresses/s)'.format(sequential_time, len(queries) / sequential_time))
+print('Batch:      {:.2f}s ({:.1f} addresses/s)'.format(batch_time, len(queries) / batch_time))
+print('Speedup:    {:.1f}x'.format(sequential_time / batch_time))
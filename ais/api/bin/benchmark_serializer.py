@@ -0,0 +1,73 @@
+"""
+Compare the cost per feature of serializing a page of addresses with each
+available JSON encoder, and of classifying the page's match types.
+
+Usage: python benchmark_serializer.py [block query] [repetitions]
+"""
+import sys
+import time
+from collections import OrderedDict
+from ais import app
+from ais.api import encoders, serializers
+from ais.api.match_types import classify_match_types
+from ais.api.views import get_tag_data
+from ais.models import parser, Address, AddressSummary
+
+query = sys.argv[1] if len(sys.argv) > 1 else '1200 block of market st'
+repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+with app.test_request_context('/block/{}'.format(query)):
+    from flask import request
+    parsed = parser.parse(query)
+    street = parsed['components']['street']
+    rows = AddressSummary.query \
+        .filter_by(street_name=street['name'], street_suffix=street['suffix']) \
+        .get_address_geoms(request) \
+        .order_by_address() \
+        .limit(1000) \
+        .all()
+    tag_data = get_tag_data(rows)
+    print('Serializing {} features {} times...'.format(len(rows), repetitions))
+
+    def make_serializer():
+        return serializers.AddressJsonSerializer(
+            metadata={'search_type': 'block', 'query': query, 'search_params': request.args},
+            tag_data=tag_data)
+
+    # Building the feature data
+    serializer = make_serializer()
+    start = time.time()
+    for _ in range(repetitions):
+        data = [serializer.model_to_data(row) for row in rows]
+    build_time = (time.time() - start) / (repetitions * len(rows))
+    print('model_to_data:  {:.1f} us/feature'.format(build_time * 1e6))
+
+    # Classifying match types from stored columns, against parsing each row
+    ref = Address(parsed['components']['output_address'])
+    addresses = [address for address, geocode_type, geom in rows]
+    start = time.time()
+    for _ in range(repetitions):
+        classify_match_types(ref, addresses)
+    classify_time = (time.time() - start) / (repetitions * len(rows))
+    start = time.time()
+    for _ in range(repetitions):
+        classify_match_types(ref, [Address(address.street_address) for address in addresses])
+    parsed_classify_time = (time.time() - start) / (repetitions * len(rows))
+    print('match types:    {:.1f} us/feature ({:.1f} us/feature parsing each row)'.format(
+        classify_time * 1e6, parsed_classify_time * 1e6))
+
+    # Encoding it
+    outputs = OrderedDict()
+    for name, make in encoders.ENCODERS.items():
+        try:
+            dumps = make()
+        except (ImportError, ValueError) as e:
+            print('{:<14}  unavailable ({})'.format(name + ':', e))
+            continue
+        start = time.time()
+        for _ in range(repetitions):
+            outputs[name] = [dumps(feature) for feature in data]
+        encode_time = (time.time() - start) / (repetitions * len(rows))
+        print('{:<14}  {:.1f} us/feature'.format(name + ':', encode_time * 1e6))
+
+    assert len(set(tuple(output) for output in outputs.values())) == 1, 'Encoders gave different output'
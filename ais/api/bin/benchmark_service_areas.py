@@ -0,0 +1,40 @@
+"""
+Report p50/p99 latency of /service_areas/ at random points inside the city
+extent. Run it against a server with SEGMENT_INDEX_ENABLED unset and then set
+to compare the queried and in-memory lookups.
+
+Usage: python benchmark_service_areas.py <base url> [number of points] [seed]
+"""
+import random
+import sys
+import time
+import requests
+
+# Bounding box of Philadelphia, in degrees
+MIN_X, MIN_Y, MAX_X, MAX_Y = -75.2803, 39.8670, -74.9557, 40.1379
+
+base_url = sys.argv[1].rstrip('/')
+num_points = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+random.seed(int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+points = [(random.uniform(MIN_X, MAX_X), random.uniform(MIN_Y, MAX_Y)) for _ in range(num_points)]
+session = requests.Session()
+
+# Warm up the connection and the server's first-request setup
+session.get('{}/service_areas/{},{}'.format(base_url, *points[0]))
+
+print('Looking up service areas at {} points...'.format(num_points))
+latencies = []
+statuses = {}
+for x, y in points:
+    start = time.time()
+    r = session.get('{}/service_areas/{},{}'.format(base_url, x, y))
+    latencies.append(time.time() - start)
+    statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+
+latencies.sort()
+def percentile(p):
+    return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)]
+
+print('Statuses: {}'.format(', '.join('{}: {}'.format(*item) for item in sorted(statuses.items()))))
+print('p50: {:.1f} ms'.format(percentile(50) * 1000))
+print('p99: {:.1f} ms'.format(percentile(99) * 1000))
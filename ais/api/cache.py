@@ -0,0 +1,164 @@
+"""
+Server-side cache for rendered JSON responses.
+
+Responses are keyed by the view, the normalized query (so that "1234 market st"
+and "1234 MARKET STREET" share an entry) and the request args that change the
+response. The query and request args are echoed back in each response's
+metadata, so those are re-stamped on the way out of the cache, with the same
+values the view itself would echo.
+
+The cache is off unless RESPONSE_CACHE['backend'] is set. Entries are flushed
+when a new engine is promoted (see promotion.py), but workers only notice a
+promotion through the stamp file on their own host. Unless the stamp file is on
+storage shared by every API host, or `ais api promote` is run on each host,
+'lru' caches on other hosts keep serving responses from the old engine until
+their entries expire (after `ttl` seconds) or the workers restart. The 'redis'
+backend is flushed for every host by the one promote.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+from flask import request
+from ais import app
+from .encoders import dumps, plain
+from .promotion import on_promotion
+
+config = app.config['RESPONSE_CACHE']
+
+
+class LRUCacheBackend:
+    """
+    In-process cache, private to each worker, with LRU eviction past
+    `max_entries` and expiry after `ttl` seconds.
+    """
+    def __init__(self, max_entries=5000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCacheBackend:
+    """
+    Cache shared by all workers on a host (or cluster), stored in Redis with a
+    TTL per entry.
+    """
+    prefix = 'ais:response:'
+
+    def __init__(self, url, ttl=3600):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value):
+        self.client.setex(self.prefix + key, self.ttl, value)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def make_backend(config):
+    backend = config['backend']
+    if not backend:
+        return None
+    if backend == 'lru':
+        return LRUCacheBackend(max_entries=config['max_entries'], ttl=config['ttl'])
+    if backend == 'redis':
+        return RedisCacheBackend(config['redis_url'], ttl=config['ttl'])
+    raise ValueError('Unknown response cache backend: {}'.format(backend))
+
+
+response_cache = make_backend(config)
+
+
+@on_promotion
+def flush_response_cache():
+    if response_cache:
+        response_cache.clear()
+
+
+def make_cache_key(view_name, normalized, args):
+    key_args = sorted((arg, args.get(arg)) for arg in config['key_args'] if arg in args)
+    raw_key = json.dumps([view_name, normalized, key_args])
+    return sha1(raw_key.encode()).hexdigest()
+
+
+def echo_request(query, args):
+    return query, args
+
+
+def restamp_metadata(body, query, args):
+    """
+    Put the query and request args of the current request, as the view echoes
+    them, into a cached body.
+    """
+    data = json.loads(body, object_pairs_hook=OrderedDict)
+    if 'query' in data:
+        data['query'] = query
+    if 'search_params' in data:
+        data['search_params'] = plain(args)
+    return dumps(data)
+
+
+def cache_response(normalize, echo=echo_request):
+    """
+    Cache successful responses of a view. `normalize` maps the raw query to
+    the value it is keyed by, e.g. the standardized address. `echo` maps the
+    query and request args to the values the view puts in `query` and
+    `search_params`.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(query, **kwargs):
+            if response_cache is None:
+                return view(query, **kwargs)
+
+            echo_query, echo_args = echo(query.strip('/'), request.args)
+            try:
+                normalized = normalize(echo_query, kwargs.get('parsed'))
+            except Exception:
+                normalized = query
+            key = make_cache_key(view.__name__, normalized, request.args)
+
+            body = response_cache.get(key)
+            if body is not None:
+                body = restamp_metadata(body, echo_query, echo_args)
+                return app.response_class(response=body, status=200, mimetype='application/json')
+
+            response = view(query, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response.get_data(as_text=True))
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,83 @@
+"""
+JSON encoding for API responses.
+
+Responses are encoded with a fast C encoder when one is installed, configured
+to give the same bytes as the standard library's `json.dumps` with its default
+arguments, and with the standard library otherwise. The encoder is picked with
+the JSON_ENCODER setting: 'auto' (the first one available), 'ujson' or 'json'.
+A fast encoder is only used if it encodes a probe document the same way.
+
+ujson writes floats under 1e-4 with a shorter exponent ("1e-7" rather than
+"1e-07"). No float in an AIS response is that small besides 0.0; coordinates
+are in degrees or feet and rates are rounded to three places.
+"""
+import json
+from collections import OrderedDict
+from ais import app
+
+
+def make_stdlib_dumps():
+    return json.dumps
+
+
+def make_ujson_dumps():
+    import ujson
+
+    def encode(obj):
+        return ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False,
+                           separators=(', ', ': '))
+
+    # Some builds read dict storage rather than OrderedDict order, which isn't
+    # insertion order before Python 3.6, and older ones don't take all of the
+    # arguments above.
+    probe = OrderedDict((str(i), [i, i / 3, None, 'é/"']) for i in reversed(range(32)))
+    try:
+        matches = encode(probe) == json.dumps(probe)
+    except TypeError:
+        matches = False
+    if not matches:
+        raise ValueError('ujson output does not match the standard library')
+
+    def dumps(obj):
+        try:
+            return encode(obj)
+        except (TypeError, ValueError, OverflowError) as e:
+            # Leave anything ujson can't encode (NaN, objects the standard
+            # library would also reject) to the standard library.
+            app.logger.warning('ujson could not encode response, using json: {}'.format(e))
+            return json.dumps(obj)
+
+    return dumps
+
+
+ENCODERS = OrderedDict([
+    ('ujson', make_ujson_dumps),
+    ('json', make_stdlib_dumps),
+])
+
+
+def make_dumps(name):
+    if name != 'auto':
+        if name not in ENCODERS:
+            raise ValueError('Unknown JSON encoder: {}'.format(name))
+        return name, ENCODERS[name]()
+
+    for name, make in ENCODERS.items():
+        try:
+            return name, make()
+        except (ImportError, ValueError):
+            continue
+
+
+encoder_name, dumps = make_dumps(app.config['JSON_ENCODER'])
+
+
+def plain(value):
+    """
+    Convert dict subclasses that present different items than they store, such
+    as the request args MultiDict, to an OrderedDict of their items. C encoders
+    read a dict's storage directly, the standard library calls `items()`.
+    """
+    if isinstance(value, dict) and type(value) not in (dict, OrderedDict):
+        return OrderedDict(value.items())
+    return value
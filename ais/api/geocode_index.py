@@ -0,0 +1,282 @@
+"""
+Per-worker, read-only index of the geocode points that `reverse_geocode`
+searches (PWD and DOR curb points and true range points), for finding the
+addresses nearest a point without querying the database.
+
+The points are kept in numpy arrays laid out as a KD-tree, along with the
+street address and geocode type of each point. Whether each address is ranged
+or a unit is kept too, which is all `reverse_geocode` needs to know about an
+address before fetching it by street address.
+
+The index is optional (REVERSE_GEOCODE_INDEX['enabled']) and is loaded,
+reloaded and budgeted like the segment index. Whenever it isn't loaded,
+lookups fall back to querying.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+import numpy as np
+from shapely.geometry import Point
+from sqlalchemy import text
+from ais import app, util, app_db as db
+from ais.models import ENGINE_SRID
+from .promotion import on_promotion
+from .segment_index import MemoryBudgetExceeded
+
+config = app.config['REVERSE_GEOCODE_INDEX']
+geocode_priority = app.config['ADDRESS_SUMMARY']['geocode_priority']
+
+# Geocode types that reverse geocoding searches
+GEOCODE_TYPES = tuple(geocode_priority[name] for name in ('pwd_curb', 'dor_curb', 'true_range'))
+
+NearestAddress = namedtuple('NearestAddress', ['street_address', 'geocode_type', 'is_range', 'is_unit'])
+
+# Memory used by each point (coordinates, split, tree order, address and
+# type) and by each address beyond the size of its text
+POINT_BYTES = 3 * 8 + 8 + 4 + 1
+ADDRESS_OVERHEAD_BYTES = 100
+
+GEOCODE_POINTS_SQL = '''
+    SELECT g.street_address, g.geocode_type, ST_X(g.geom), ST_Y(g.geom),
+           a.address_high IS NOT NULL, coalesce(a.unit_type, '') != ''
+    FROM geocode g
+    LEFT JOIN address_summary a ON a.street_address = g.street_address
+    WHERE g.geocode_type IN ({geocode_types})
+'''.format(geocode_types=', '.join(map(str, GEOCODE_TYPES)))
+
+# The nearest point of each address within the search radius, taking the
+# shorter address where points are equally near.
+NEAREST_ADDRESSES_SQL = '''
+    SELECT nearest.street_address, nearest.geocode_type,
+           a.address_high IS NOT NULL, coalesce(a.unit_type, '') != ''
+    FROM (
+        SELECT DISTINCT ON (street_address) street_address, geocode_type, distance
+        FROM (
+            SELECT street_address, geocode_type,
+                   geom <-> ST_Transform(ST_SetSRID(ST_MakePoint(:x, :y), :srid), :engine_srid) AS distance
+            FROM geocode
+            WHERE ST_DWithin(geom, ST_Transform(ST_SetSRID(ST_MakePoint(:x, :y), :srid), :engine_srid), :search_radius)
+              AND geocode_type IN ({geocode_types})
+        ) candidates
+        ORDER BY street_address, distance
+    ) nearest
+    LEFT JOIN address_summary a ON a.street_address = nearest.street_address
+    ORDER BY nearest.distance, length(nearest.street_address)
+    LIMIT :limit
+'''.format(geocode_types=', '.join(map(str, GEOCODE_TYPES)))
+
+
+class PointKDTree:
+    """
+    A static 2-d tree over points. The points are stored in one array, ordered
+    so that every node of the tree is a contiguous slice of it: a node of more
+    than LEAF_SIZE points is split at its median x (at even depths) or y (at
+    odd depths) into the halves either side of the median. The splitting value
+    of each node is kept at the position of its median.
+    """
+    LEAF_SIZE = 32
+
+    def __init__(self, xs, ys):
+        points = np.column_stack((np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)))
+        # Position of each tree point in the input
+        order = np.arange(len(points))
+        splits = np.zeros(len(points))
+        nodes = [(0, len(points), 0)]
+        while nodes:
+            start, end, depth = nodes.pop()
+            if end - start <= self.LEAF_SIZE:
+                continue
+            mid = (start + end) // 2
+            partition = np.argpartition(points[start:end, depth % 2], mid - start)
+            points[start:end] = points[start:end][partition]
+            order[start:end] = order[start:end][partition]
+            splits[mid] = points[mid, depth % 2]
+            nodes.append((start, mid, depth + 1))
+            nodes.append((mid, end, depth + 1))
+        self.points = points
+        self.order = order
+        self.splits = splits
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, x, y, k, max_distance):
+        """
+        Get the distances to and input positions of (up to) the k points
+        nearest (x, y) that are no more than max_distance away, nearest first.
+        Of points equally far away at the cutoff, which are kept is arbitrary.
+        """
+        target = (x, y)
+        bound = max_distance ** 2
+        best_d2 = np.empty(0)
+        best_positions = np.empty(0, dtype=np.intp)
+        # Nodes still to search, with the squared distance to their splitting
+        # plane (a lower bound on the distance to any point in them)
+        nodes = [(0, len(self.points), 0, 0.0)]
+        while nodes:
+            start, end, depth, plane_d2 = nodes.pop()
+            if plane_d2 > bound:
+                continue
+
+            if end - start <= self.LEAF_SIZE:
+                leaf = self.points[start:end]
+                d2 = (leaf[:, 0] - x) ** 2 + (leaf[:, 1] - y) ** 2
+                within = np.flatnonzero(d2 <= bound)
+                if len(within) == 0:
+                    continue
+                best_d2 = np.concatenate((best_d2, d2[within]))
+                best_positions = np.concatenate((best_positions, within + start))
+                if len(best_d2) > k:
+                    keep = np.argpartition(best_d2, k - 1)[:k]
+                    best_d2, best_positions = best_d2[keep], best_positions[keep]
+                if len(best_d2) == k:
+                    bound = best_d2.max()
+                continue
+
+            mid = (start + end) // 2
+            diff = target[depth % 2] - self.splits[mid]
+            if diff < 0:
+                near, far = (start, mid), (mid, end)
+            else:
+                near, far = (mid, end), (start, mid)
+            # Search the near side first
+            nodes.append((far[0], far[1], depth + 1, diff * diff))
+            nodes.append((near[0], near[1], depth + 1, plane_d2))
+
+        nearest_first = np.argsort(best_d2, kind='mergesort')
+        return np.sqrt(best_d2[nearest_first]), self.order[best_positions[nearest_first]]
+
+
+class IndexData:
+    """The contents of a loaded index, swapped in all at once."""
+    def __init__(self, max_memory_bytes):
+        self.max_memory_bytes = max_memory_bytes
+        self.memory_bytes = 0
+        self.street_addresses = []
+        self.is_range = []
+        self.is_unit = []
+        # Per point
+        self.address_ids = None
+        self.geocode_types = None
+        self.tree = None
+
+    def count(self, num_bytes):
+        self.memory_bytes += num_bytes
+        if self.memory_bytes > self.max_memory_bytes:
+            raise MemoryBudgetExceeded(
+                'Reverse geocode index is over its budget of {} bytes'.format(self.max_memory_bytes))
+
+
+class ReverseGeocodeIndex:
+    def __init__(self, max_memory_mb):
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self._data = None
+        self._lock = threading.Lock()
+        # Whether this process has tried loading the index, i.e. is serving
+        self.attempted = False
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def load(self):
+        """
+        Read the geocode points from the engine. Returns whether the index fit
+        in its memory budget; if not, lookups keep going to the database.
+        """
+        with self._lock:
+            self.attempted = True
+            data = IndexData(self.max_memory_bytes)
+            try:
+                self._load_points(data)
+            except MemoryBudgetExceeded as e:
+                app.logger.warning(str(e))
+                self._data = None
+                return False
+            self._data = data
+            return True
+
+    def unload(self):
+        self._data = None
+
+    def _load_points(self, data):
+        address_ids = {}
+        point_address_ids = []
+        geocode_types = []
+        xs = []
+        ys = []
+        for street_address, geocode_type, x, y, is_range, is_unit in db.engine.execute(text(GEOCODE_POINTS_SQL)):
+            address_id = address_ids.get(street_address)
+            if address_id is None:
+                data.count(len(street_address) + ADDRESS_OVERHEAD_BYTES)
+                address_id = address_ids[street_address] = len(data.street_addresses)
+                data.street_addresses.append(street_address)
+                data.is_range.append(is_range)
+                data.is_unit.append(is_unit)
+            data.count(POINT_BYTES)
+            point_address_ids.append(address_id)
+            geocode_types.append(geocode_type)
+            xs.append(x)
+            ys.append(y)
+
+        data.address_ids = np.array(point_address_ids, dtype=np.int32)
+        data.geocode_types = np.array(geocode_types, dtype=np.int8)
+        data.tree = PointKDTree(xs, ys)
+
+    def get_nearest_addresses(self, x, y, srid, search_radius, limit=1):
+        """
+        Get the (up to) `limit` addresses with a curb or true range geocode
+        nearest a point in the given SRID, within `search_radius` feet, nearest
+        first. Each address is located by its nearest point; of addresses
+        equally near, the shorter comes first.
+        """
+        data = self._data
+        if data is None:
+            rows = db.engine.execute(text(NEAREST_ADDRESSES_SQL), x=x, y=y, srid=srid, engine_srid=ENGINE_SRID,
+                                     search_radius=search_radius, limit=limit)
+            return [NearestAddress(*row) for row in rows]
+
+        point = util.project_shape(Point(x, y), from_srid=srid, to_srid=ENGINE_SRID)
+        num_points = limit
+        while True:
+            distances, positions = data.tree.query(point.x, point.y, num_points, search_radius)
+            address_ids = data.address_ids[positions]
+            candidates = sorted(
+                zip(distances.tolist(), address_ids.tolist(), data.geocode_types[positions].tolist()),
+                key=lambda candidate: (candidate[0], len(data.street_addresses[candidate[1]])))
+
+            nearest = OrderedDict()
+            for distance, address_id, geocode_type in candidates:
+                if address_id not in nearest:
+                    nearest[address_id] = (distance, geocode_type)
+            nearest = list(nearest.items())[:limit]
+
+            # Done if every point in the radius was found, or the last address
+            # kept is nearer than the farthest point found, so that no point
+            # as near as it was left out.
+            if len(positions) < num_points or (len(nearest) == limit and nearest[-1][1][0] < distances[-1]):
+                return [NearestAddress(data.street_addresses[address_id], geocode_type,
+                                       data.is_range[address_id], data.is_unit[address_id])
+                        for address_id, (distance, geocode_type) in nearest]
+            num_points *= 4
+
+
+reverse_geocode_index = ReverseGeocodeIndex(config['max_memory_mb'])
+
+
+@app.before_first_request
+def load_reverse_geocode_index():
+    if config['enabled']:
+        reverse_geocode_index.load()
+
+
+def _reload_in_background():
+    with app.app_context():
+        reverse_geocode_index.load()
+
+
+@on_promotion
+def reload_reverse_geocode_index():
+    # As with the segment index, load the new engine's points in a thread;
+    # lookups keep using the old index until the new one is swapped in.
+    if config['enabled'] and reverse_geocode_index.attempted:
+        threading.Thread(target=_reload_in_background, daemon=True).start()
@@ -0,0 +1,11 @@
+from flask_script import Manager
+
+manager = Manager(usage='Perform API operations')
+
+@manager.command
+def promote():
+    """Flush caches and reload indexes after a new engine build is promoted."""
+    # Importing the views registers the promotion hooks.
+    import ais.api.views
+    from ais.api.promotion import promote as run_promotion_hooks
+    run_promotion_hooks()
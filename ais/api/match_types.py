@@ -0,0 +1,240 @@
+"""
+Classify how an address in a response relates to the address that was searched
+for (its `match_type`).
+
+The classification reads only the address components stored on each row
+(`address_low`, `address_low_suffix`, `address_low_frac`, `address_high`,
+`unit_type`, `unit_num`, `street_full`, `street_address`), so it works on
+AddressSummary rows and parsed Address objects alike. A page of results can be
+classified without parsing any of them.
+
+Missing components are None on a parsed Address but '' on an AddressSummary
+row, so both are read through `get_components`, which makes them None.
+"""
+from collections import namedtuple
+
+GENERIC_UNIT_TYPES = ('APT', 'UNIT', '#')
+
+Components = namedtuple('Components', ['street_address', 'address_low', 'address_low_suffix', 'address_low_frac',
+                                       'address_high', 'unit_type', 'unit_num', 'street_full'])
+
+
+def get_components(address):
+    """The address components used to classify match types, with missing ones as None."""
+    if isinstance(address, Components):
+        return address
+    return Components(
+        street_address=address.street_address,
+        address_low=address.address_low,
+        address_low_suffix=address.address_low_suffix or None,
+        address_low_frac=address.address_low_frac or None,
+        address_high=address.address_high or None,
+        unit_type=address.unit_type or None,
+        unit_num=address.unit_num or None,
+        street_full=address.street_full,
+    )
+
+
+def address_full(address):
+    """Full primary address, e.g. 1003R-07 1/2 (as Address.address_full)"""
+    full = str(address.address_low)
+    if address.address_low_suffix:
+        full += address.address_low_suffix
+    if address.address_high:
+        full += '-' + str(address.address_high)[-2:]
+    if address.address_low_frac:
+        full += ' ' + address.address_low_frac
+    return full
+
+
+def address_full_num(address):
+    """Numeric part of the primary address, e.g. 1003-07 (as Address.address_full_num)"""
+    num = str(address.address_low)
+    if address.address_high:
+        num += '-' + str(address.address_high)[-2:]
+    return num
+
+
+def base_address(address):
+    return ' '.join([address_full(address), address.street_full])
+
+
+def base_address_no_suffix(address):
+    return '{} {}'.format(address_full_num(address), address.street_full)
+
+
+def is_generic_unit_variation(ref, address):
+    """
+    Whether `ref` is `address` with its unit type swapped for a generic one,
+    e.g. 1769-71 FRANKFORD AVE APT 8 for 1769-71 FRANKFORD AVE # 8.
+    """
+    ref = get_components(ref)
+    address = get_components(address)
+    return (ref.unit_type in GENERIC_UNIT_TYPES
+            and ref.unit_num == address.unit_num
+            and ref.address_low == address.address_low
+            and ref.address_low_suffix == address.address_low_suffix
+            and ref.address_low_frac == address.address_low_frac
+            and ref.address_high == address.address_high
+            and ref.street_full == address.street_full)
+
+
+def classify_match_type(ref, address, exact_match_type='exact'):
+    """
+    Get the match type of `address` in a response to a search for `ref`.
+    `exact_match_type` is used when they're the same address.
+    """
+    ref = get_components(ref)
+    address = get_components(address)
+    if address.street_address == ref.street_address:
+        # Address is same as reference address
+        return exact_match_type
+
+    ref_base_address = base_address(ref)
+    ref_base_address_no_suffix = base_address_no_suffix(ref)
+    address_base_address = base_address(address)
+    address_base_address_no_suffix = base_address_no_suffix(address)
+
+    if address.unit_type not in ('', None):
+        # Address is different from ref address and has unit type
+        if address.address_high is None:
+            # Address also doesn't have a high num
+            if ref.unit_type not in ('', None):
+                # Reference address has unit type
+                if ref.unit_num == address.unit_num:
+                    # Reference and address have same unit num
+                    if ref.unit_type == address.unit_type:
+                        return 'exact' if not ref.address_high else 'in_range'
+                    elif ref.unit_type in GENERIC_UNIT_TYPES and address.unit_type in GENERIC_UNIT_TYPES:
+                        return 'generic_unit_sibling' if not ref.address_high else 'in_range_generic_unit_sibling'
+                    else:
+                        return 'unit_sibling' if not ref.address_high else 'in_range_unit_sibling'
+                elif address_base_address == ref_base_address:
+                    return 'has_base_unit_child'
+                elif address_base_address_no_suffix == ref_base_address_no_suffix:
+                    return 'has_base_no_suffix_unit_child'
+                elif ref.address_high:
+                    if ref.address_low_suffix == address.address_low_suffix:
+                        if address.unit_num == ref.unit_num:
+                            return 'in_range'
+                        elif not address.unit_num:
+                            return 'has_base_in_range'
+                        else:
+                            # 1769-71 FRANKFORD AVE UNIT 8?include_units
+                            return 'has_base_in_range_unit_child'
+                    elif address.address_low_suffix:
+                        if ref.address_low_suffix:
+                            return 'has_base_no_suffix_in_range_suffix_child_unit_child'
+                        else:
+                            return 'has_base_in_range'
+                    else:
+                        if ref.address_low_suffix:
+                            return 'has_base_no_suffix_in_range_unit_child'
+                        else:
+                            return 'has_base_in_range_unit_child'
+                return None
+            elif ref.address_high is not None:
+                # Ref address has no unit type but has high num
+                if ref.address_low_suffix == address.address_low_suffix:
+                    return 'in_range_unit_child'
+                elif ref.address_low_suffix:
+                    if address.address_low_suffix:
+                        return 'has_base_no_suffix_in_range_suffix_child_unit_child'
+                    else:
+                        return 'has_base_no_suffix_in_range_unit_child'
+                else:
+                    return 'in_range_suffix_child_unit_child'
+            else:
+                # Ref address has no unit type or high num
+                if address.address_low_suffix is not None and address_base_address_no_suffix == ref_base_address:
+                    return 'has_base_no_suffix_unit_child'
+                else:
+                    return 'unit_child'
+        else:
+            # Address has unit type and high num (is a ranged unit address)
+            if ref.unit_type is not None:
+                if is_generic_unit_variation(ref, address):
+                    return 'generic_unit_sibling'
+                elif ref.address_high is None:
+                    if ref.unit_type in GENERIC_UNIT_TYPES and address.unit_type in GENERIC_UNIT_TYPES:
+                        return 'range_parent_unit_sibling'
+                    else:
+                        return 'range_parent_unit_child'
+                else:
+                    return 'unit_sibling' if ref.address_low == address.address_low and ref.address_high == address.address_high else 'overlapping_unit_sibling'
+            else:
+                if ref.address_high is None:
+                    return 'range_parent_unit_child'
+                else:
+                    return 'unit_child'
+
+    # Address is different from ref address but has no unit type
+    if address.address_high:
+        if not ref.address_high:
+            return 'range_parent'
+        elif ref.address_high != address.address_high or ref.address_low != address.address_low:
+            if not ref.unit_type and ref.address_low_suffix == address.address_low_suffix:
+                return 'overlaps'
+            elif ref_base_address == address_base_address:
+                return 'has_base_overlaps'
+            elif address.address_low_suffix:
+                # 4923-49 N 16TH ST
+                return 'overlapping_suffix_child'
+            else:
+                return 'has_base_no_suffix_overlaps'
+        elif ref.address_low_suffix == address.address_low_suffix:
+            return 'has_base'
+        else:
+            # 4923-47 N 16TH ST
+            return 'has_base_no_suffix'
+    elif ref.address_high:
+        # No address high on the address, but one on the ref address
+        if ref.unit_type:
+            if ref.address_low_suffix == address.address_low_suffix:
+                if not ref.unit_num:
+                    return 'in_range'
+                else:
+                    # 902A-4 N 3RD ST UNIT 2
+                    return 'has_base_in_range'
+            elif address.address_low_suffix:
+                # 902-4 N 3RD ST UNIT 2
+                if not ref.address_low_suffix:
+                    return 'in_range_suffix_child'
+                else:
+                    return 'has_base_no_suffix_in_range_suffix_child'
+            else:
+                # 902R-4 N 3RD ST UNIT 2
+                return 'has_base_no_suffix_in_range'
+        else:
+            if ref.address_low_suffix == address.address_low_suffix:
+                if not ref.unit_num:
+                    # 901A-4 N 3RD ST
+                    return 'in_range'
+                else:
+                    return 'in_range_unit_sibling'
+            elif address.address_low_suffix:
+                # 902-4 N 3RD ST UNIT 2
+                return 'in_range_suffix_child'
+            else:
+                # 902R-4 N 3RD ST
+                return 'has_base_no_suffix_in_range'
+    elif ref_base_address == address.street_address:
+        # 1769 FRANKFORD AVE UNIT 8
+        return 'has_base'
+    elif ref_base_address_no_suffix == address.street_address:
+        # 1769R FRANKFORD AVE
+        return 'has_base_no_suffix'
+    elif address_base_address_no_suffix == ref_base_address:
+        # 902 N 3RD ST UNIT 2
+        return 'has_base_suffix_child'
+    elif address_base_address_no_suffix == ref_base_address_no_suffix:
+        # 902 N 3RD ST UNIT 2
+        return 'has_base_no_suffix_suffix_child'
+    else:
+        return 'has_base'
+
+
+def classify_match_types(ref, addresses, exact_match_type='exact'):
+    """Get the match type of each of a page of addresses."""
+    ref = get_components(ref)
+    return [classify_match_type(ref, address, exact_match_type) for address in addresses]
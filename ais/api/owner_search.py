@@ -0,0 +1,146 @@
+"""
+Find the addresses whose OPA owners match an owner search, using the posting
+lists in owner_token rather than scanning address_summary.opa_owners.
+
+Each part of a search matches owner tokens equal to it and, depending on
+OWNER_SEARCH, tokens beginning with it (`prefix`) or within `max_typos` edits of
+it (for parts of at least `typo_min_length` characters). An address matches
+when its owners have a matching token for every part. Parts are intersected
+rarest first, so the common ones are only checked against the addresses found
+so far: only the part of each posting list shared with them is unnested.
+
+The matching and ranking all happen in one statement, which returns at most
+`max_candidates` addresses for the owner view to rank: those matching the most
+parts exactly first and, among those matching as many, those whose owners are
+most similar to the search (as the owner view ranks them). With `opa_only`,
+addresses the view would leave out are dropped before the cut.
+"""
+from collections import OrderedDict
+from sqlalchemy import text, func, desc, Integer
+from ais import app, util, app_db as db
+from ais.models import AddressSummary
+
+config = app.config['OWNER_SEARCH']
+
+PART_COST_SQL = '''
+    SELECT coalesce(sum(num_addresses), 0)
+    FROM owner_token
+    WHERE {condition}
+'''
+
+# The addresses with tokens matching the first part, and whether one matches
+# exactly
+FIRST_PART_ADDRESSES_SQL = '''
+    {name} AS (
+        SELECT address_id, bool_or(token = :part_{index}) AS exact
+        FROM owner_token, unnest(address_ids) AS address_id
+        WHERE {condition}
+        GROUP BY address_id
+    )
+'''
+
+# As above, but only the addresses matching the previous parts
+PART_ADDRESSES_SQL = '''
+    {name} AS (
+        SELECT address_id, bool_or(token = :part_{index}) AS exact
+        FROM owner_token,
+            unnest(ARRAY(
+                SELECT unnest(address_ids)
+                INTERSECT
+                SELECT address_id FROM {previous}
+            )) AS address_id
+        WHERE ({condition}) AND address_ids && (SELECT array_agg(address_id) FROM {previous})
+        GROUP BY address_id
+    )
+'''
+
+MATCHES_SQL = '''
+    WITH {parts}
+    SELECT address_id, {exact_count} AS exact_count
+    FROM {joins}
+'''
+
+
+def get_part_condition(part, index=0):
+    """
+    Get the condition for owner tokens matching a part, and its params, named
+    by the part's index.
+    """
+    conditions = ['token = :part_{}'.format(index)]
+    params = {'part_{}'.format(index): part}
+    if config['prefix']:
+        # Tokens are only letters and digits, so need no escaping
+        conditions.append('token LIKE :prefix_{}'.format(index))
+        params['prefix_{}'.format(index)] = part + '%'
+    if config['max_typos'] and len(part) >= config['typo_min_length']:
+        # Assume the first letter is right, so that only tokens beginning with
+        # it are compared.
+        conditions.append('''(
+            token LIKE :first_letter_{index}
+            AND length(token) BETWEEN :min_length_{index} AND :max_length_{index}
+            AND levenshtein(token, :part_{index}) <= :max_typos_{index}
+        )'''.format(index=index))
+        params.update({
+            'first_letter_{}'.format(index): part[0] + '%',
+            'min_length_{}'.format(index): len(part) - config['max_typos'],
+            'max_length_{}'.format(index): len(part) + config['max_typos'],
+            'max_typos_{}'.format(index): config['max_typos'],
+        })
+    return ' OR '.join(conditions), params
+
+
+def get_matches(parts):
+    """
+    Get a selectable of the addresses matching every part (in the order given)
+    with the number of parts each matches exactly.
+    """
+    ctes = []
+    params = {}
+    for index, part in enumerate(parts):
+        condition, part_params = get_part_condition(part, index)
+        params.update(part_params)
+        stmt = FIRST_PART_ADDRESSES_SQL if index == 0 else PART_ADDRESSES_SQL
+        ctes.append(stmt.format(name='part_{}'.format(index), previous='part_{}'.format(index - 1),
+                                index=index, condition=condition))
+
+    names = ['part_{}'.format(index) for index in reversed(range(len(parts)))]
+    sql = MATCHES_SQL.format(
+        parts=', '.join(ctes),
+        exact_count=' + '.join('{}.exact::integer'.format(name) for name in names),
+        joins=' JOIN '.join(names[:1] + ['{} USING (address_id)'.format(name) for name in names[1:]]))
+    return text(sql).bindparams(**params).columns(address_id=Integer, exact_count=Integer).alias('matches')
+
+
+def find_owner_address_ids(query, opa_only=False):
+    """
+    Get the IDs of the address_summary rows with owners matching `query`, best
+    candidates first. With `opa_only`, only those with OPA account numbers
+    that the owner view would return.
+    """
+    parts = list(OrderedDict.fromkeys(util.owner_tokens(query)))
+    if not parts:
+        return []
+
+    # Order parts by the number of addresses their tokens are on
+    costs = {}
+    for part in parts:
+        condition, params = get_part_condition(part)
+        costs[part] = db.engine.execute(text(PART_COST_SQL.format(condition=condition)), **params).scalar()
+        if costs[part] == 0:
+            return []
+    parts.sort(key=lambda part: costs[part])
+
+    matches = get_matches(parts)
+    candidates = AddressSummary.query \
+        .join(matches, matches.c.address_id == AddressSummary.id) \
+        .exclude_non_opa(opa_only) \
+        .with_entities(AddressSummary.id.label('address_id'),
+                       matches.c.exact_count.label('exact_count'),
+                       AddressSummary.opa_owners.label('opa_owners')) \
+        .subquery()
+    ranked = db.session.query(candidates.c.address_id) \
+        .order_by(desc(candidates.c.exact_count),
+                  desc(func.coalesce(func.similarity(candidates.c.opa_owners, query), 0)),
+                  candidates.c.address_id) \
+        .limit(config['max_candidates'])
+    return [row[0] for row in ranked]
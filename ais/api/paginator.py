@@ -1,6 +1,10 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from collections import OrderedDict
 from functools import lru_cache
+from itertools import chain
 from math import ceil
+from sqlalchemy import func, and_, or_
 from sqlalchemy.orm.query import Query
 
 
@@ -110,3 +114,157 @@ class QueryPaginator (Paginator):
 
             if limit <= 0:
                 break
+
+
+def strip_extra_columns(row, num_extra):
+    """
+    Remove `num_extra` trailing columns that were added to a query row for
+    bookkeeping, unwrapping rows that are left with a single entity.
+    """
+    row = tuple(row)[:-num_extra]
+    return row[0] if len(row) == 1 else row
+
+
+class WindowQueryPaginator (QueryPaginator):
+    """
+    Gets a page and the total size of the collection in a single statement by
+    adding a `count(*) OVER ()` column to the page query, instead of running
+    the query once to count it and again to fetch the page. Since the total
+    isn't known until a page has been fetched, the page that will be requested
+    is given up front.
+
+    With `stream_chunk_size`, page rows are read from a server-side cursor that
+    many at a time as they're iterated over, instead of all being loaded when
+    the page is fetched. A streamed page can only be iterated over once.
+    """
+    def __init__(self, collection, page=1, stream_chunk_size=None, **kwargs):
+        super().__init__(collection, **kwargs)
+        self.page = page
+        self.pages = {}
+        self.stream_chunk_size = stream_chunk_size
+
+    def fetch_page(self, page):
+        offset = (page - 1) * self.max_page_size
+
+        # Wrap the query so that the count is taken over the final rows, after
+        # any DISTINCT ON, unions or limits. A subquery's order isn't kept by
+        # the query around it, so its ORDER BY is applied again outside
+        # (adapted to the subquery's columns).
+        collection = self.collections[0]
+        query = collection.from_self() \
+            .add_columns(func.count().over().label('total_size')) \
+            .order_by(*(collection._order_by or ())) \
+            .offset(offset) \
+            .limit(self.max_page_size)
+        if self.stream_chunk_size:
+            # Read just the first row for the total, and leave the rest on
+            # the cursor
+            rows = iter(query.yield_per(self.stream_chunk_size))
+            first_row = next(rows, None)
+            if first_row is not None:
+                rows = chain([first_row], rows)
+        else:
+            rows = query.all()
+            first_row = rows[0] if rows else None
+
+        if first_row is not None:
+            total_size = first_row[-1]
+        elif offset == 0:
+            total_size = 0
+        else:
+            total_size = None
+
+        if self.stream_chunk_size:
+            return (strip_extra_columns(row, 1) for row in rows), total_size
+        return [strip_extra_columns(row, 1) for row in rows], total_size
+
+    @property
+    @lru_cache()
+    def collection_sizes(self):
+        try:
+            page = max(int(self.page), 1)
+        except (TypeError, ValueError):
+            page = 1
+
+        rows, total_size = self.fetch_page(page)
+        self.pages[page] = rows
+
+        # The requested page is past the end of the collection, so there's no
+        # row to read the total from; fall back to counting.
+        if total_size is None:
+            total_size = self.collections[0].count()
+        return (total_size,)
+
+    def get_page(self, page):
+        if page not in self.pages:
+            self.pages[page], _ = self.fetch_page(page)
+        yield from self.pages[page]
+
+
+class KeysetQueryPaginator (QueryPaginator):
+    """
+    Pages through a query by starting each page after the last row of the
+    previous one (identified by an opaque cursor) rather than with an OFFSET,
+    so deep pages cost the same as the first. The key columns must give the
+    rows a total order, so the last one should be unique. Nulls sort last, as
+    in a default btree index.
+    """
+    def __init__(self, collection, key_columns, **kwargs):
+        super().__init__(collection, **kwargs)
+        self.key_columns = key_columns
+
+    @staticmethod
+    def encode_cursor(values):
+        return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+        except (ValueError, TypeError):
+            raise self.ValidationError('Invalid cursor value.', {'cursor': cursor})
+        if not isinstance(values, list) or len(values) != len(self.key_columns):
+            raise self.ValidationError('Invalid cursor value.', {'cursor': cursor})
+        return values
+
+    def after(self, values):
+        """
+        Build a filter for rows that sort after the given key values.
+        """
+        conditions = []
+        for i, (column, value) in enumerate(zip(self.key_columns, values)):
+            # Nothing sorts after a null with the same prefix
+            if value is None:
+                continue
+            prefix = [col.isnot_distinct_from(val)
+                      for col, val in zip(self.key_columns[:i], values[:i])]
+            conditions.append(and_(*(prefix + [or_(column > value, column == None)])))
+        return or_(*conditions) if conditions else False
+
+    def get_page_after(self, cursor=None):
+        """
+        Returns the rows of the page after `cursor` (or the first page if there
+        is no cursor) and the cursor for the page after that, or None if this
+        is the last page.
+        """
+        num_keys = len(self.key_columns)
+        query = self.collections[0].from_self()
+        if cursor:
+            query = query.filter(self.after(self.decode_cursor(cursor)))
+        query = query \
+            .order_by(None) \
+            .order_by(*[col.asc().nullslast() for col in self.key_columns]) \
+            .add_columns(*self.key_columns) \
+            .limit(self.max_page_size + 1)
+        rows = query.all()
+
+        next_cursor = None
+        if len(rows) > self.max_page_size:
+            rows = rows[:self.max_page_size]
+            next_cursor = self.encode_cursor(list(rows[-1][-num_keys:]))
+        return [strip_extra_columns(row, num_keys) for row in rows], next_cursor
+
+    def get_cursor_page_info(self, page_rows, next_cursor):
+        return OrderedDict([
+            ('page_size', len(page_rows)),
+            ('next_cursor', next_cursor),
+        ])
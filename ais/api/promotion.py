@@ -0,0 +1,57 @@
+"""
+Hooks to run when a new engine build is promoted, for state in the API that
+was derived from the old engine: response caches, in-memory indexes, etc.
+
+Register a hook with the `on_promotion` decorator. `promote` runs them all; it
+is called by the `ais api promote` command, which also touches the promotion
+stamp file. Each worker checks the stamp at most every PROMOTION_CHECK_INTERVAL
+seconds and runs the hooks itself when it changes, so that per-worker state is
+reset too. Per-worker state is also reset whenever the workers restart, which
+happens on every deploy or swap.
+"""
+import os
+import time
+from ais import app
+
+STAMP_FILE = app.config['PROMOTION_STAMP_FILE']
+CHECK_INTERVAL = app.config['PROMOTION_CHECK_INTERVAL']
+
+_hooks = []
+
+def on_promotion(func):
+    _hooks.append(func)
+    return func
+
+def promote():
+    for hook in _hooks:
+        hook()
+    with open(STAMP_FILE, 'a'):
+        os.utime(STAMP_FILE, None)
+
+
+def read_stamp():
+    try:
+        return os.stat(STAMP_FILE).st_mtime
+    except OSError:
+        return None
+
+_last_stamp = read_stamp()
+_last_checked = time.time()
+
+@app.before_request
+def check_for_promotion():
+    """
+    Run the hooks in this worker if the engine has been promoted since it last
+    checked.
+    """
+    global _last_stamp, _last_checked
+    now = time.time()
+    if now - _last_checked < CHECK_INTERVAL:
+        return
+    _last_checked = now
+
+    stamp = read_stamp()
+    if stamp != _last_stamp:
+        _last_stamp = stamp
+        for hook in _hooks:
+            hook()
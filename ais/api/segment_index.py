@@ -0,0 +1,297 @@
+"""
+Per-worker, read-only index of street segments (geometry and left/right
+ranges), true ranges and service area polygons. `unknown_cascade_view` uses it
+to estimate the location and service areas of addresses that aren't in AIS,
+and `service_areas` to look up the service areas and nearest segment at a
+point, without querying the database.
+
+The index is optional (SEGMENT_INDEX['enabled']). Each worker loads it before
+serving its first request, and reloads it in the background when a new
+engine is promoted. If it would use more than SEGMENT_INDEX['max_memory_mb']
+(going by an estimate of its geometries, prepared geometries, trees and rows)
+it isn't kept. Whenever the index isn't loaded, lookups fall back to querying.
+"""
+import threading
+from collections import OrderedDict, namedtuple
+from geoalchemy2.shape import to_shape
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from sqlalchemy import func, text
+from ais import app, util, app_db as db
+from ais.models import StreetSegment, ServiceAreaLayer, ServiceAreaPolygon, ENGINE_SRID
+from .promotion import on_promotion
+
+config = app.config['SEGMENT_INDEX']
+
+Segment = namedtuple('Segment', ['seg_id', 'left_from', 'left_to', 'right_from', 'right_to', 'shape'])
+TrueRange = namedtuple('TrueRange', ['true_left_from', 'true_left_to', 'true_right_from', 'true_right_to'])
+
+# Rough memory used by the parts of a loaded index. A geometry's coordinates
+# take about the size of its WKB, plus the Python and GEOS objects around them.
+# A prepared geometry indexes the geometry's edges, taking about twice as much
+# again. Each geometry in an STRtree takes a node and an entry in the map of
+# positions. Segment and true range rows are namedtuples of ints in a dict.
+GEOMETRY_OVERHEAD_BYTES = 500
+PREPARED_GEOMETRY_WKB_FACTOR = 2
+TREE_ENTRY_BYTES = 250
+ROW_BYTES = 300
+
+TRUE_RANGE_SQL = '''
+    SELECT true_left_from, true_left_to, true_right_from, true_right_to
+    FROM true_range
+    WHERE seg_id = :seg_id
+'''
+
+SERVICE_AREAS_SQL = '''
+    WITH foo AS (
+        SELECT layer_id, value
+        FROM service_area_polygon
+        WHERE ST_Intersects(geom, ST_GeomFromText(:wkt, :srid))
+    )
+    SELECT DISTINCT ON (cols.layer_id) cols.layer_id, foo.value
+    FROM service_area_layer cols
+    LEFT JOIN foo ON foo.layer_id = cols.layer_id
+'''
+
+# The same, at a point given in any SRID, along with the nearest street
+# segment. The point expression is repeated rather than put in a CTE so that
+# the nearest segment is found by a KNN scan of the street_segment GiST index.
+POINT_SERVICE_AREAS_SQL = '''
+    WITH foo AS (
+        SELECT layer_id, value
+        FROM service_area_polygon
+        WHERE ST_Intersects(geom, ST_Transform(ST_SetSRID(ST_MakePoint(:x, :y), :srid), :engine_srid))
+    )
+    SELECT DISTINCT ON (cols.layer_id) cols.layer_id, foo.value
+    FROM service_area_layer cols
+    LEFT JOIN foo ON foo.layer_id = cols.layer_id
+    UNION
+    (
+        SELECT 'nearest_seg'::text AS layer_id, cast(ss.seg_id AS text) AS value
+        FROM street_segment ss
+        ORDER BY ss.geom <-> ST_Transform(ST_SetSRID(ST_MakePoint(:x, :y), :srid), :engine_srid)
+        LIMIT 1
+    )
+    ORDER BY layer_id
+'''
+
+NEAREST_SEG_KEY = 'nearest_seg'
+
+
+class MemoryBudgetExceeded (Exception):
+    pass
+
+
+class IndexData:
+    """The contents of a loaded index, swapped in all at once."""
+    def __init__(self, max_memory_bytes):
+        self.max_memory_bytes = max_memory_bytes
+        self.memory_bytes = 0
+        self.segments = {}
+        self.true_ranges = {}
+        self.layer_ids = []
+        self.point_keys = []
+        self.polygons = []
+        self.tree = None
+        self.tree_positions = {}
+        self.segment_ids = []
+        self.segment_tree = None
+        self.segment_tree_positions = {}
+
+    def count(self, num_bytes):
+        """Count memory the index will use, raising if it's over budget."""
+        self.memory_bytes += num_bytes
+        if self.memory_bytes > self.max_memory_bytes:
+            raise MemoryBudgetExceeded(
+                'Segment index is over its budget of {} bytes'.format(self.max_memory_bytes))
+
+    def load_shape(self, geom_wkb, prepared=False):
+        num_bytes = len(geom_wkb) + GEOMETRY_OVERHEAD_BYTES
+        if prepared:
+            num_bytes += len(geom_wkb) * PREPARED_GEOMETRY_WKB_FACTOR
+        self.count(num_bytes)
+        return wkb.loads(bytes(geom_wkb))
+
+    def make_tree(self, shapes):
+        """Get an STRtree of the shapes and the position of each in it."""
+        self.count(len(shapes) * TREE_ENTRY_BYTES)
+        return STRtree(shapes), {id(shape): position for position, shape in enumerate(shapes)}
+
+
+class SegmentIndex:
+    def __init__(self, max_memory_mb):
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self._data = None
+        self._lock = threading.Lock()
+        # Whether this process has tried loading the index, i.e. is serving
+        self.attempted = False
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    def load(self):
+        """
+        Read the segments, true ranges and service area polygons from the
+        engine. Returns whether the index fit in its memory budget; if not,
+        lookups keep going to the database.
+        """
+        with self._lock:
+            self.attempted = True
+            data = IndexData(self.max_memory_bytes)
+            try:
+                self._load_segments(data)
+                self._load_service_areas(data)
+            except MemoryBudgetExceeded as e:
+                app.logger.warning(str(e))
+                self._data = None
+                return False
+            self._data = data
+            return True
+
+    def unload(self):
+        self._data = None
+
+    def _load_segments(self, data):
+        segments = db.session.query(
+            StreetSegment.seg_id,
+            StreetSegment.left_from, StreetSegment.left_to,
+            StreetSegment.right_from, StreetSegment.right_to,
+            func.ST_AsBinary(StreetSegment.geom))
+        for seg_id, left_from, left_to, right_from, right_to, geom_wkb in segments:
+            # As with querying by seg_id, the first segment wins
+            if seg_id not in data.segments:
+                data.count(ROW_BYTES)
+                shape = data.load_shape(geom_wkb)
+                data.segments[seg_id] = Segment(seg_id, left_from, left_to, right_from, right_to, shape)
+
+        true_ranges = db.engine.execute(text('''
+            SELECT seg_id, true_left_from, true_left_to, true_right_from, true_right_to
+            FROM true_range
+        '''))
+        for seg_id, *true_range in true_ranges:
+            if seg_id not in data.true_ranges:
+                data.count(ROW_BYTES)
+                data.true_ranges[seg_id] = TrueRange(*true_range)
+
+        # For finding the nearest segment to a point. STRtree.nearest is only
+        # in Shapely 1.7 and up; on older versions those lookups are queried.
+        if hasattr(STRtree, 'nearest'):
+            data.segment_ids = list(data.segments)
+            shapes = [data.segments[seg_id].shape for seg_id in data.segment_ids]
+            data.segment_tree, data.segment_tree_positions = data.make_tree(shapes)
+
+    def _load_service_areas(self, data):
+        # Keep layers in the order that DISTINCT ON returns them in
+        layers = db.session.query(ServiceAreaLayer.layer_id) \
+            .distinct() \
+            .order_by(ServiceAreaLayer.layer_id)
+        data.layer_ids = [layer_id for layer_id, in layers]
+        # and point lookups, which add the nearest segment, in the order
+        # their ORDER BY returns them in
+        point_keys = db.engine.execute(text('''
+            SELECT layer_id FROM service_area_layer
+            UNION
+            SELECT :nearest_seg_key
+            ORDER BY layer_id
+        '''), nearest_seg_key=NEAREST_SEG_KEY)
+        data.point_keys = [key for key, in point_keys]
+
+        polygons = db.session.query(
+            ServiceAreaPolygon.layer_id,
+            ServiceAreaPolygon.value,
+            func.ST_AsBinary(ServiceAreaPolygon.geom))
+        shapes = []
+        for layer_id, value, geom_wkb in polygons:
+            shape = data.load_shape(geom_wkb, prepared=True)
+            shapes.append(shape)
+            data.polygons.append((layer_id, value, prep(shape)))
+
+        data.tree, data.tree_positions = data.make_tree(shapes)
+
+    def get_segment(self, seg_id):
+        data = self._data
+        if data is not None:
+            return data.segments.get(seg_id)
+
+        segment = StreetSegment.query.filter_by_seg_id(seg_id).first()
+        if segment is None:
+            return None
+        return Segment(segment.seg_id, segment.left_from, segment.left_to,
+                       segment.right_from, segment.right_to, to_shape(segment.geom))
+
+    def get_true_range(self, seg_id):
+        data = self._data
+        if data is not None:
+            return data.true_ranges.get(seg_id)
+
+        row = db.engine.execute(text(TRUE_RANGE_SQL), seg_id=seg_id).first()
+        return TrueRange(*row) if row is not None else None
+
+    def get_service_areas(self, shape):
+        """
+        Get the value of each service area layer at a shape, keyed by layer ID
+        (None where no polygon of the layer intersects it).
+        """
+        data = self._data
+        if data is None:
+            rows = db.engine.execute(text(SERVICE_AREAS_SQL), wkt=shape.wkt, srid=ENGINE_SRID)
+            return OrderedDict((layer_id, value) for layer_id, value in rows)
+
+        return self._get_indexed_service_areas(data, shape, data.layer_ids)
+
+    def get_point_service_areas(self, x, y, srid):
+        """
+        Get the service areas at a point in the given SRID, as with
+        `get_service_areas`, and the seg ID of the nearest street segment
+        (as text, under 'nearest_seg').
+        """
+        data = self._data
+        if data is None or data.segment_tree is None:
+            rows = db.engine.execute(text(POINT_SERVICE_AREAS_SQL), x=x, y=y, srid=srid, engine_srid=ENGINE_SRID)
+            return OrderedDict((layer_id, value) for layer_id, value in rows)
+
+        point = util.project_shape(Point(x, y), from_srid=srid, to_srid=ENGINE_SRID)
+        sa_data = self._get_indexed_service_areas(data, point, data.point_keys)
+        hit = data.segment_tree.nearest(point)
+        position = util.get_strtree_position(hit, data.segment_tree_positions)
+        sa_data[NEAREST_SEG_KEY] = str(data.segment_ids[position])
+        return sa_data
+
+    def _get_indexed_service_areas(self, data, shape, keys):
+        sa_data = OrderedDict((key, None) for key in keys)
+        found = set()
+        for hit in data.tree.query(shape):
+            position = util.get_strtree_position(hit, data.tree_positions)
+            layer_id, value, prepared = data.polygons[position]
+            if layer_id in found or not prepared.intersects(shape):
+                continue
+            found.add(layer_id)
+            if layer_id in sa_data:
+                sa_data[layer_id] = value
+        return sa_data
+
+
+segment_index = SegmentIndex(config['max_memory_mb'])
+
+
+@app.before_first_request
+def load_segment_index():
+    if config['enabled']:
+        segment_index.load()
+
+
+def _reload_in_background():
+    with app.app_context():
+        segment_index.load()
+
+
+@on_promotion
+def reload_segment_index():
+    # Load the new engine's index in a thread rather than in the request that
+    # noticed the promotion; lookups keep using the old index until the new
+    # one is swapped in.
+    if config['enabled'] and segment_index.attempted:
+        threading.Thread(target=_reload_in_background, daemon=True).start()
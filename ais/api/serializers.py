@@ -1,8 +1,10 @@
-import json
 from collections import OrderedDict, Iterable
 from geoalchemy2.shape import to_shape
+from shapely.geometry import mapping
 from ais import app, util #, app_db as db
 from ais.models import Address, ENGINE_SRID
+from .encoders import dumps, plain
+from .match_types import classify_match_type
 #from itertools import chain
 
 config = app.config
@@ -10,6 +12,8 @@ tag_fields = config['ADDRESS_SUMMARY']['tag_fields']
 tag_field_map = {}
 for tag in tag_fields:
     tag_field_map[tag['tag_key']] = tag['name']
+# Geocode type names by priority, as joined onto address rows
+geocode_type_names = {priority: name for name, priority in config['ADDRESS_SUMMARY']['geocode_priority'].items()}
 
 
 class BaseSerializer:
@@ -33,13 +37,14 @@ class GeoJSONSerializer (BaseSerializer):
         self.metadata = metadata
         self.pagination = pagination
         self.srid = srid
+        self._ref_address = None
         super().__init__()
 
 
     def render(self, data):
         final_data = []
         if self.metadata:
-            final_data += sorted(self.metadata.items(),reverse=True)
+            final_data += sorted(self.render_metadata(), reverse=True)
 
         # Render as a feature collection if in a list
         if isinstance(data, list):
@@ -54,184 +59,50 @@ class GeoJSONSerializer (BaseSerializer):
             final_data += data.items()
 
         final_data = OrderedDict(final_data)
-        return json.dumps(final_data)
+        return dumps(final_data)
+
+    def render_metadata(self):
+        return [(key, plain(value)) for key, value in self.metadata.items()]
+
+    def render_stream(self, data):
+        """
+        Render an iterable of features as a feature collection, yielding one
+        feature at a time. The joined chunks are the same as `render(list(data))`.
+        """
+        final_data = []
+        if self.metadata:
+            final_data += sorted(self.render_metadata(), reverse=True)
+        if self.pagination:
+            final_data += self.pagination.items()
+        final_data += [('type', 'FeatureCollection')]
+
+        # Leave the envelope open for the features
+        yield dumps(OrderedDict(final_data))[:-1] + ', "features": ['
+        for i, feature in enumerate(data):
+            yield (', ' if i else '') + dumps(feature)
+        yield ']}'
+
+    def render_ndjson(self, data):
+        """
+        Render an iterable of features as newline-delimited JSON, one feature
+        per line and no envelope.
+        """
+        for feature in data:
+            yield dumps(feature) + '\n'
+
+    def serialize_stream(self, instances, ndjson=False):
+        data = (self.model_to_data(instance) for instance in instances)
+        return self.render_ndjson(data) if ndjson else self.render_stream(data)
 
 
     def get_address_response_relationships(self, address=None, **kwargs):
         # TODO: assign in include_units fct?
 
-        #print("normalized: ", self.normalized_address)
-        #print(self.ref_addr)
-        ref_address = Address(self.ref_addr)
-        address = Address(address.street_address)
-        # print(ref_address, address)
-        ref_base_address = ' '.join([ref_address.address_full, ref_address.street_full])
-        ref_base_address_no_suffix = '{} {}'.format(ref_address.address_full_num, ref_address.street_full)
-        base_address = ' '.join([address.address_full, address.street_full])
-        base_address_no_suffix = '{} {}'.format(address.address_full_num, address.street_full)
-        match_type = None
-        unit_type_variations = ["APT", "UNIT", "#"]
-        street_address_variations = [address.street_address,
-                                     address.street_address.replace(address.unit_type, "APT"),
-                                     address.street_address.replace(address.unit_type, "UNIT"),
-                                     address.street_address.replace(address.unit_type, "#")] if address.unit_type else []
-
-        #print(address.unit_type, ref_address.unit_type)
-        if address.street_address == ref_address.street_address:
-            # Address is same as reference address
-            match_type = self.match_type
-        # elif address.base_address == ref_address.base_address:
-        #     # 1769 FRANKFORD AVE UNIT 99
-        #     match_type = 'has_base'
-        # elif address.base_address_no_suffix == ref_address.base_address or address.base_address == ref_address.base_address_no_suffix:
-        #     #6037 N 17TH ST #A or 6037B N 17TH ST #A
-        #     match_type = 'has_base_no_suffix'
-        elif address.unit_type not in ('', None):
-            # Address is different from ref address and has unit type
-            if address.address_high is None:
-                # Address also doesn't have a high num
-                if ref_address.unit_type not in ('', None):
-                    # Reference address has unit type
-                    if ref_address.unit_num == address.unit_num:
-                        if ref_address.unit_type == address.unit_type:
-                            match_type = 'exact' if not ref_address.address_high else 'in_range'
-                        # Reference and address have same unit num
-                        elif all(unit_type in unit_type_variations for unit_type in [ref_address.unit_type, address.unit_type]):
-                            match_type = 'generic_unit_sibling' if not ref_address.address_high else 'in_range_generic_unit_sibling'
-                        else:
-                            match_type = 'unit_sibling' if not ref_address.address_high else 'in_range_unit_sibling'
-                    elif base_address == ref_base_address:
-                        match_type = 'has_base_unit_child'
-                    elif base_address_no_suffix == ref_base_address_no_suffix:
-                        match_type = 'has_base_no_suffix_unit_child'
-                    elif ref_address.address_high:
-                        if ref_address.address_low_suffix == address.address_low_suffix:
-                            if address.unit_num == ref_address.unit_num:
-                                match_type = 'in_range'
-                            elif not address.unit_num:
-                                match_type = 'has_base_in_range'
-                            else:
-                                # 1769-71 FRANKFORD AVE UNIT 8?include_units
-                                match_type = 'has_base_in_range_unit_child'
-                        elif address.address_low_suffix:
-                            if ref_address.address_low_suffix:
-                                match_type = 'has_base_no_suffix_in_range_suffix_child_unit_child'
-                            else:
-                                match_type = 'has_base_in_range'
-                        else:
-                            if ref_address.address_low_suffix:
-                                match_type = 'has_base_no_suffix_in_range_unit_child'
-                            else:
-                                match_type = 'has_base_in_range_unit_child'
-                elif ref_address.address_high is not None:
-                    # Ref address has no unit type but has high_num:
-                    if ref_address.address_low_suffix == address.address_low_suffix:
-                        match_type = 'in_range_unit_child'
-                    elif ref_address.address_low_suffix:
-                        if address.address_low_suffix:
-                            match_type = 'has_base_no_suffix_in_range_suffix_child_unit_child'
-                        else:
-                            match_type = 'has_base_no_suffix_in_range_unit_child'
-                    else:
-                        match_type = 'in_range_suffix_child_unit_child'
-
-                else:
-                    # ref address has no unit type or address high num
-                    if address.address_low_suffix is not None and address.base_address_no_suffix == ref_address.base_address:
-                        match_type = 'has_base_no_suffix_unit_child'
-                    else:
-                        match_type = 'unit_child'
-            else:
-                # Address is different from ref address and has unit type and high num (is ranged unit address)
-                if ref_address.unit_type is not None:
-                    # Unit type is a generic unit type
-                    if ref_address.street_address in street_address_variations:
-                        match_type = 'generic_unit_sibling'
-                    else:
-                        if ref_address.address_high is None:
-                            if all(unit_type in unit_type_variations for unit_type in [ref_address.unit_type, address.unit_type]):
-                                match_type = 'range_parent_unit_sibling'
-                            else:
-                                match_type = 'range_parent_unit_child'
-                        else:
-                            match_type = 'unit_sibling' if ref_address.address_low == address.address_low and ref_address.address_high == address.address_high else 'overlapping_unit_sibling'
-                else:
-                    if ref_address.address_high is None:
-                        match_type = 'range_parent_unit_child'
-                    else:
-                        match_type = 'unit_child'
-                    # match_type = 'range_parent'
-        else:
-            # Address is different from ref address but has no unit type
-            if address.address_high:
-                if not ref_address.address_high:
-                    match_type = 'range_parent'
-                else:
-                    if ref_address.address_high != address.address_high or ref_address.address_low != address.address_low:
-                        if not ref_address.unit_type and ref_address.address_low_suffix == address.address_low_suffix:
-                            match_type = 'overlaps'
-                        elif ref_base_address == base_address:
-                            match_type =  'has_base_overlaps'
-                        else:
-                            if address.address_low_suffix:
-                                # 4923-49 N 16TH ST
-                                match_type = 'overlapping_suffix_child'
-                            else:
-                                match_type = 'has_base_no_suffix_overlaps'
-                    else:
-                        if ref_address.address_low_suffix == address.address_low_suffix:
-                            match_type = 'has_base'
-                        else:
-                            # 4923-47 N 16TH ST
-                            match_type = 'has_base_no_suffix'
-            elif ref_address.address_high:
-                # no address.address_high but ref_address.address_high
-                if ref_address.unit_type:
-                    if ref_address.address_low_suffix == address.address_low_suffix:
-                        if not ref_address.unit_num:
-                            match_type = 'in_range'
-                        else:
-                            # 902A-4 N 3RD ST UNIT 2
-                            match_type = 'has_base_in_range'
-
-                    elif address.address_low_suffix:
-                        # 902-4 N 3RD ST UNIT 2
-                        if not ref_address.address_low_suffix:
-                            match_type = 'in_range_suffix_child'
-                        else:
-                            match_type = 'has_base_no_suffix_in_range_suffix_child'
-                    else:
-                        # 902R-4 N 3RD ST UNIT 2
-                        match_type = 'has_base_no_suffix_in_range'
-                else:
-                    if ref_address.address_low_suffix == address.address_low_suffix:
-                        if not ref_address.unit_num:
-                            # 901A-4 N 3RD ST
-                            match_type = 'in_range'
-                        else:
-                            match_type = 'in_range_unit_sibling'
-                    elif address.address_low_suffix:
-                        # 902-4 N 3RD ST UNIT 2
-                        match_type = 'in_range_suffix_child'
-                    else:
-                        # 902R-4 N 3RD ST
-                        match_type = 'has_base_no_suffix_in_range'
-            elif ref_address.base_address == address.street_address:
-                # 1769 FRANKFORD AVE UNIT 8
-                match_type = 'has_base'
-            elif ref_address.base_address_no_suffix == address.street_address:
-                # 1769R FRANKFORD AVE
-                match_type = 'has_base_no_suffix'
-            elif address.base_address_no_suffix == ref_address.base_address:
-                # 902 N 3RD ST UNIT 2
-                match_type = 'has_base_suffix_child'
-            elif address.base_address_no_suffix == ref_address.base_address_no_suffix:
-                # 902 N 3RD ST UNIT 2
-                match_type = 'has_base_no_suffix_suffix_child'
-            else:
-                match_type = 'has_base'
-
-        return match_type
+        # The reference address is the same for every row on the page, so
+        # only parse it once; result rows are classified from their columns.
+        if self._ref_address is None:
+            self._ref_address = Address(self.ref_addr)
+        return classify_match_type(self._ref_address, address, exact_match_type=self.match_type)
 
 
 class AddressJsonSerializer (GeoJSONSerializer):
@@ -255,6 +126,8 @@ class AddressJsonSerializer (GeoJSONSerializer):
         self.match_type = match_type
         self.tag_data = tag_data
         self.ref_addr = ref_addr
+        self.projected_shape = None
+        self.sa_columns = None
 
         super().__init__(**kwargs)
 
@@ -266,10 +139,10 @@ class AddressJsonSerializer (GeoJSONSerializer):
         return util.project_shape(
             shape, from_srid=ENGINE_SRID, to_srid=self.srid)
 
-    def shape_to_geodict(self, shape):
-        from shapely.geometry import mapping
+    def shape_to_geodict(self, shape, geocode_type=None):
         data = mapping(shape)
         return OrderedDict([
+            ('geocode_type', geocode_type),
             ('type', data['type']),
             ('coordinates', data['coordinates'])
         ])
@@ -327,7 +200,11 @@ class AddressJsonSerializer (GeoJSONSerializer):
 
     def model_to_data(self, address):
 
-        shape = self.project_shape(self.shape) if self.shape else None
+        # The estimated shape is shared by every feature on the page, so only
+        # project it once.
+        if self.shape and self.projected_shape is None:
+            self.projected_shape = self.project_shape(self.shape)
+        shape = self.projected_shape
         geocode_response_type = None
         # Handle instances where query includes request arg 'parcel_geocode_location' which joins geom from geocode,
         # creating an iterable object
@@ -336,27 +213,24 @@ class AddressJsonSerializer (GeoJSONSerializer):
             # print(address)
             # print(len(address))
             address, geocode_response_type, geom = address
-            gp_map = config['ADDRESS_SUMMARY']['geocode_priority']
-            geocode_response_type = (list(gp_map.keys())[list(gp_map.values()).index(geocode_response_type)])
+            geocode_response_type = geocode_type_names[geocode_response_type]
             # print("SERIALIZED: ", vars(address))
         #cascade_geocode_type = self.estimated if self.estimated else None
-        geom_type = {'geocode_type': geocode_response_type} if geocode_response_type else {'geocode_type': address.geocode_type} \
-            if not self.estimated else {'geocode_type': self.estimated}
+        geocode_type = geocode_response_type if geocode_response_type else address.geocode_type \
+            if not self.estimated else self.estimated
 
         if self.estimated != 'parsed':
             shape = self.geom_to_shape(geom) if not shape else shape
-            geom_data = self.shape_to_geodict(shape)
-            geom_data.update(geom_type)
-            geom_data.move_to_end('geocode_type', last=False)
+            geom_data = self.shape_to_geodict(shape, geocode_type)
 
             # Build the set of associated service areas
-            sa_data = OrderedDict()
             if not self.estimated:
                 #print(address.street_address, address.service_areas)
-                for col in address.service_areas.__table__.columns:
-                    if col.name in ('id', 'street_address', 'zip_code'):
-                        continue
-                    sa_data[col.name] = getattr(address.service_areas, col.name)
+                service_areas = address.service_areas
+                if self.sa_columns is None:
+                    self.sa_columns = [col.name for col in service_areas.__table__.columns
+                                       if col.name not in ('id', 'street_address', 'zip_code')]
+                sa_data = OrderedDict([(name, getattr(service_areas, name)) for name in self.sa_columns])
             else:
                 sa_data = self.sa_data
             # if self.metadata['search_type'] == 'address':
@@ -455,11 +329,27 @@ class IntersectionJsonSerializer (GeoJSONSerializer):
             ('coordinates', data['coordinates'])
         ])
 
-    def model_to_data(self, intersection):
+    def project_shapes(self, shapes):
+        return util.project_shapes(
+            shapes, from_srid=ENGINE_SRID, to_srid=self.srid)
+
+    def serialize_many(self, instances):
+        # Project the whole page of intersection points in one call rather
+        # than one transform per feature.
+        instances = list(instances)
+        shapes = self.project_shapes(
+            to_shape(intersection.geom) if intersection.geom is not None else None
+            for intersection in instances)
+        data = [self.model_to_data(instance, shape=shape)
+                for instance, shape in zip(instances, shapes)]
+        return self.render(data)
+
+    def model_to_data(self, intersection, shape=None):
 
         if intersection.geom is not None:
-            shape = to_shape(intersection.geom)
-            shape = self.project_shape(shape)
+            if shape is None:
+                shape = to_shape(intersection.geom)
+                shape = self.project_shape(shape)
             geom_data = self.shape_to_geodict(shape)
             geom_type = {'geocode_type': 'intersection'}
             geom_data.update(geom_type)
@@ -546,7 +436,7 @@ class ServiceAreaSerializer ():
     def render(self, data):
         final_data = []
         if self.metadata:
-            final_data += sorted(self.metadata.items(),reverse=True)
+            final_data += sorted(((key, plain(value)) for key, value in self.metadata.items()), reverse=True)
         # Render as a feature collection if in a list
         if isinstance(data, list):
             # if self.pagination:
@@ -558,7 +448,7 @@ class ServiceAreaSerializer ():
 
         # Render as a feature otherwise
         else:
-            final_data += data.items()
+            final_data += [(key, plain(value)) for key, value in data.items()]
 
         final_data = OrderedDict(final_data)
         geom_data = OrderedDict([
@@ -567,7 +457,7 @@ class ServiceAreaSerializer ():
             ('coordinates', self.coordinates)
         ])
         final_data.update({'geometry': geom_data})
-        return json.dumps(final_data)
+        return dumps(final_data)
 
     def serialize(self):
         data = self.model_to_data()
@@ -680,7 +570,7 @@ class AddressTagSerializer():
     def render(self, data):
         final_data = []
         if self.metadata:
-            final_data += sorted(self.metadata.items(),reverse=True)
+            final_data += sorted(((key, plain(value)) for key, value in self.metadata.items()), reverse=True)
         # Render as a feature collection if in a list
         if isinstance(data, list):
             # if self.pagination:
@@ -691,11 +581,11 @@ class AddressTagSerializer():
             ]
         # Render as a feature otherwise
         else:
-            final_data += data.items()
+            final_data += [(key, plain(value)) for key, value in data.items()]
 
         final_data = OrderedDict(final_data)
 
-        return json.dumps(final_data)
+        return dumps(final_data)
 
     def serialize(self):
         data = self.model_to_data()
@@ -0,0 +1,26 @@
+import pytest
+from ais import app
+from ..cache import response_cache
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    return app.test_client()
+
+def get_uncached(client, url):
+    if response_cache:
+        response_cache.clear()
+    return client.get(url)
+
+def assert_indexed_matches_queried(client, index, url):
+    """Check that a response is the same with an in-memory index loaded as without."""
+    with app.app_context():
+        index.unload()
+        queried = get_uncached(client, url)
+        assert index.load()
+        try:
+            indexed = get_uncached(client, url)
+        finally:
+            index.unload()
+    assert indexed.status_code == queried.status_code == 200
+    assert indexed.get_data() == queried.get_data()
@@ -0,0 +1,33 @@
+import json
+from collections import OrderedDict
+from ..cache import LRUCacheBackend, make_cache_key, restamp_metadata
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCacheBackend(max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+
+def test_lru_expires_entries():
+    cache = LRUCacheBackend(ttl=-1)
+    cache.set('a', '1')
+    assert cache.get('a') is None
+
+def test_cache_key_ignores_echo_only_args():
+    key = make_cache_key('addresses', '1234 MARKET ST', {'srid': '2272'})
+    assert key == make_cache_key('addresses', '1234 MARKET ST', {'srid': '2272', 'foo': 'bar'})
+    assert key != make_cache_key('addresses', '1234 MARKET ST', {'srid': '4326'})
+    assert key != make_cache_key('block', '1234 MARKET ST', {'srid': '2272'})
+
+def test_restamp_metadata_keeps_key_order():
+    body = json.dumps(OrderedDict([('search_type', 'address'), ('search_params', {}),
+                                   ('query', '1234 market st'), ('features', [])]))
+    restamped = json.loads(restamp_metadata(body, '1234 Market Street', {'srid': '2272'}),
+                           object_pairs_hook=OrderedDict)
+    assert list(restamped.keys()) == ['search_type', 'search_params', 'query', 'features']
+    assert restamped['query'] == '1234 Market Street'
+    assert restamped['search_params'] == {'srid': '2272'}
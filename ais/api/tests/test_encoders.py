@@ -0,0 +1,25 @@
+import json
+import sys
+import types
+import pytest
+from ..encoders import make_ujson_dumps
+
+def fake_ujson(dumps):
+    module = types.ModuleType('ujson')
+    module.dumps = dumps
+    return module
+
+def test_ujson_without_all_arguments_is_not_used(monkeypatch):
+    def dumps(obj, ensure_ascii=True, escape_forward_slashes=True):
+        return json.dumps(obj)
+    monkeypatch.setitem(sys.modules, 'ujson', fake_ujson(dumps))
+    with pytest.raises(ValueError):
+        make_ujson_dumps()
+
+def test_unencodable_values_fall_back_to_json(monkeypatch):
+    def dumps(obj, **kwargs):
+        if obj != obj:
+            raise OverflowError('Invalid Nan value when encoding double')
+        return json.dumps(obj)
+    monkeypatch.setitem(sys.modules, 'ujson', fake_ujson(dumps))
+    assert make_ujson_dumps()(float('nan')) == 'NaN'
@@ -0,0 +1,35 @@
+import random
+import pytest
+from ais import app
+from ..geocode_index import PointKDTree, ReverseGeocodeIndex, reverse_geocode_index
+from .conftest import assert_indexed_matches_queried
+
+def test_kd_tree_finds_nearest_points_within_distance():
+    rand = random.Random(0)
+    # Integer coordinates, so that there are ties
+    points = [(rand.randint(0, 200), rand.randint(0, 200)) for _ in range(2000)]
+    tree = PointKDTree([x for x, y in points], [y for x, y in points])
+    for _ in range(100):
+        x, y = rand.uniform(-20, 220), rand.uniform(-20, 220)
+        k, max_distance = rand.randint(1, 20), rand.uniform(0, 50)
+        distances, positions = tree.query(x, y, k, max_distance)
+        expected = sorted(d for d in (((px - x) ** 2 + (py - y) ** 2) ** 0.5 for px, py in points)
+                          if d <= max_distance)[:k]
+        assert distances.tolist() == pytest.approx(expected)
+        assert [((points[p][0] - x) ** 2 + (points[p][1] - y) ** 2) ** 0.5 for p in positions] \
+            == pytest.approx(distances.tolist())
+
+def test_index_over_memory_budget_is_not_kept():
+    index = ReverseGeocodeIndex(max_memory_mb=0)
+    with app.app_context():
+        assert not index.load()
+    assert not index.loaded
+
+@pytest.mark.parametrize('url', [
+    '/reverse_geocode/-75.15311665258051,39.94923709403044',
+    '/reverse_geocode/2694253.78730206,235887.921013063',
+    '/reverse_geocode/2694253.78730206,235887.921013063?limit=10',
+    '/reverse_geocode/2734283 294882?search_radius=750&limit=5&include_units',
+])
+def test_indexed_reverse_geocode_matches_queried_reverse_geocode(client, url):
+    assert_indexed_matches_queried(client, reverse_geocode_index, url)
@@ -0,0 +1,75 @@
+import pytest
+from collections import namedtuple
+from ais.models import Address, AddressSummary
+from ..match_types import classify_match_type
+
+Row = namedtuple('Row', ['street_address', 'address_low', 'address_low_suffix', 'address_low_frac',
+                         'address_high', 'unit_type', 'unit_num', 'street_full'])
+
+def row(street_address, low, street_full, suffix='', high=None, unit_type='', unit_num=''):
+    """An address_summary row, where missing text components are ''."""
+    return Row(street_address, low, suffix, '', high, unit_type, unit_num, street_full)
+
+def parsed(street_address, low, street_full, suffix=None, high=None, unit_type=None, unit_num=None):
+    """A parsed Address, where missing components are None."""
+    return Row(street_address, low, suffix, None, high, unit_type, unit_num, street_full)
+
+FRANKFORD_1769 = row('1769 FRANKFORD AVE', 1769, 'FRANKFORD AVE')
+FRANKFORD_1769_UNIT_8 = row('1769 FRANKFORD AVE UNIT 8', 1769, 'FRANKFORD AVE', unit_type='UNIT', unit_num='8')
+FRANKFORD_1769_71 = row('1769-71 FRANKFORD AVE', 1769, 'FRANKFORD AVE', high=1771)
+FRANKFORD_1769_71_APT_8 = row('1769-71 FRANKFORD AVE APT 8', 1769, 'FRANKFORD AVE', high=1771, unit_type='APT', unit_num='8')
+THIRD_901_4 = row('901-4 N 3RD ST', 901, 'N 3RD ST', high=904)
+THIRD_902 = row('902 N 3RD ST', 902, 'N 3RD ST')
+
+@pytest.mark.parametrize('ref, address, match_type', [
+    (FRANKFORD_1769, FRANKFORD_1769, 'exact'),
+    (FRANKFORD_1769, FRANKFORD_1769_UNIT_8, 'unit_child'),
+    (FRANKFORD_1769, FRANKFORD_1769_71, 'range_parent'),
+    (FRANKFORD_1769_71, FRANKFORD_1769_71_APT_8, 'unit_child'),
+    (FRANKFORD_1769_UNIT_8, FRANKFORD_1769, 'has_base'),
+    (FRANKFORD_1769_UNIT_8, row('1769 FRANKFORD AVE APT 8', 1769, 'FRANKFORD AVE', unit_type='APT', unit_num='8'),
+     'generic_unit_sibling'),
+    (FRANKFORD_1769_UNIT_8, row('1769 FRANKFORD AVE STE 8', 1769, 'FRANKFORD AVE', unit_type='STE', unit_num='8'),
+     'unit_sibling'),
+    (FRANKFORD_1769_UNIT_8, row('1769 FRANKFORD AVE UNIT 9', 1769, 'FRANKFORD AVE', unit_type='UNIT', unit_num='9'),
+     'has_base_unit_child'),
+    (row('1769R FRANKFORD AVE', 1769, 'FRANKFORD AVE', suffix='R'), FRANKFORD_1769, 'has_base_no_suffix'),
+    (FRANKFORD_1769_71_APT_8, row('1769-71 FRANKFORD AVE # 8', 1769, 'FRANKFORD AVE', high=1771, unit_type='#', unit_num='8'),
+     'generic_unit_sibling'),
+    (FRANKFORD_1769_71_APT_8, row('1769-75 FRANKFORD AVE APT 9', 1769, 'FRANKFORD AVE', high=1775, unit_type='APT', unit_num='9'),
+     'overlapping_unit_sibling'),
+    (row('4923-49 N 16TH ST', 4923, 'N 16TH ST', high=4949), row('4923-47 N 16TH ST', 4923, 'N 16TH ST', high=4947),
+     'overlaps'),
+    (THIRD_901_4, row('901 N 3RD ST', 901, 'N 3RD ST'), 'in_range'),
+    (THIRD_901_4, row('901A N 3RD ST', 901, 'N 3RD ST', suffix='A'), 'in_range_suffix_child'),
+    (THIRD_902, row('902A N 3RD ST', 902, 'N 3RD ST', suffix='A'), 'has_base_suffix_child'),
+])
+def test_classify_match_type(ref, address, match_type):
+    assert classify_match_type(ref, address) == match_type
+
+@pytest.mark.parametrize('ref, address, match_type', [
+    (parsed('1769 FRANKFORD AVE', 1769, 'FRANKFORD AVE'), FRANKFORD_1769_UNIT_8, 'unit_child'),
+    (parsed('901-4 N 3RD ST', 901, 'N 3RD ST', high=904), row('901 N 3RD ST', 901, 'N 3RD ST'), 'in_range'),
+    (parsed('1769 FRANKFORD AVE UNIT 8', 1769, 'FRANKFORD AVE', unit_type='UNIT', unit_num='8'),
+     row('1769 FRANKFORD AVE APT 8', 1769, 'FRANKFORD AVE', unit_type='APT', unit_num='8'), 'generic_unit_sibling'),
+])
+def test_parsed_reference_classifies_rows(ref, address, match_type):
+    assert classify_match_type(ref, address) == match_type
+
+def test_exact_match_type_is_passed_through():
+    assert classify_match_type(FRANKFORD_1769, FRANKFORD_1769, exact_match_type='parsed') == 'parsed'
+
+def test_stored_columns_classify_like_parsed_addresses():
+    """
+    Classifying AddressSummary rows from their columns gives the same result as
+    classifying the parsed street address.
+    """
+    ref = Address('1769 FRANKFORD AVE UNIT 8')
+    rows = AddressSummary.query \
+        .filter_by(street_name='FRANKFORD', street_suffix='AVE') \
+        .filter(AddressSummary.address_low.between(1700, 1799)) \
+        .all()
+    assert rows
+    for address in rows:
+        assert classify_match_type(ref, address) == classify_match_type(ref, Address(address.street_address)), \
+            address.street_address
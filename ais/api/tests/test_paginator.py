@@ -8,7 +8,7 @@
 
 import pytest
 from ..views import validate_page_param
-from ..paginator import Paginator
+from ..paginator import Paginator, KeysetQueryPaginator, WindowQueryPaginator, strip_extra_columns
 
 @pytest.fixture
 def full_paginator():
@@ -67,3 +67,37 @@ def test_page_ends_in_split(page_request, full_paginator):
 
 def test_page_starts_in_split(page_request, full_paginator):
     assert list(full_paginator.get_page(2)) == [4, 5, 6]
+
+def test_strip_extra_columns_unwraps_single_entity():
+    assert strip_extra_columns(('address', 12), 1) == 'address'
+
+def test_strip_extra_columns_keeps_tuples():
+    assert strip_extra_columns(('address', 1, 'geom', 12), 1) == ('address', 1, 'geom')
+
+def test_cursor_round_trip():
+    paginator = KeysetQueryPaginator(None, key_columns=('street_name', 'address_low', 'unit_num'))
+    values = ['MARKET', 1234, None]
+    cursor = paginator.encode_cursor(values)
+    assert paginator.decode_cursor(cursor) == values
+
+def test_invalid_cursor_raises():
+    paginator = KeysetQueryPaginator(None, key_columns=('street_name', 'address_low'))
+    with pytest.raises(KeysetQueryPaginator.ValidationError):
+        paginator.decode_cursor('blah')
+    with pytest.raises(KeysetQueryPaginator.ValidationError):
+        paginator.decode_cursor(paginator.encode_cursor(['MARKET']))
+
+def test_window_pages_follow_collection_order():
+    from ais.models import AddressSummary
+    collection = AddressSummary.query \
+        .filter_by(street_name='MARKET', street_suffix='ST') \
+        .filter(AddressSummary.address_low.between(1200, 1299)) \
+        .order_by_address()
+    expected = [address.street_address for address in collection]
+    assert len(expected) > 10
+
+    paged = []
+    for page in range(1, (len(expected) + 9) // 10 + 1):
+        paginator = WindowQueryPaginator(collection, page=page, max_page_size=10)
+        paged += [address.street_address for address in paginator.get_page(page)]
+    assert paged == expected
@@ -0,0 +1,39 @@
+import pytest
+from ais import app
+from ..segment_index import IndexData, SegmentIndex, MemoryBudgetExceeded, segment_index
+from .conftest import assert_indexed_matches_queried
+
+@pytest.mark.parametrize('url', [
+    '/search/1050 filbert st',
+    '/search/3419 ashfield lane',
+    '/addresses/1050 filbert st?srid=2272',
+])
+def test_indexed_cascade_matches_queried_cascade(client, url):
+    assert_indexed_matches_queried(client, segment_index, url)
+
+def test_index_over_memory_budget_is_not_kept():
+    index = SegmentIndex(max_memory_mb=0)
+    with app.app_context():
+        assert not index.load()
+    assert not index.loaded
+
+def test_index_budget_counts_prepared_geometries_and_trees():
+    from shapely.geometry import box
+    geom_wkb = box(0, 0, 1, 1).wkb
+    data = IndexData(max_memory_bytes=10 ** 6)
+    shape = data.load_shape(geom_wkb)
+    plain_bytes = data.memory_bytes
+    data.load_shape(geom_wkb, prepared=True)
+    assert data.memory_bytes - plain_bytes > plain_bytes
+    before_tree = data.memory_bytes
+    data.make_tree([shape])
+    assert data.memory_bytes > before_tree
+    with pytest.raises(MemoryBudgetExceeded):
+        data.count(10 ** 6)
+
+@pytest.mark.parametrize('url', [
+    '/service_areas/-75.16381585580525,39.95263016560541',
+    '/service_areas/2694253.78730206,235887.921013063',
+])
+def test_indexed_service_areas_match_queried_service_areas(client, url):
+    assert_indexed_matches_queried(client, segment_index, url)
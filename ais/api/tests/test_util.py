@@ -0,0 +1,128 @@
+import pytest
+from ais import util
+
+
+def test_transformer_is_reused():
+    """
+    Transformers are built once per SRID pair and shared across calls.
+    """
+    first = util.get_transformer(2272, 4326)
+    second = util.get_transformer('2272', '4326')
+    assert first is second
+
+def test_project_points_matches_project_shape():
+    from shapely.geometry import Point
+    points = [(2694000.0, 236000.0), (2700000.0, 240000.0)]
+    batched = util.project_points(points, 2272, 4326)
+    for (x, y), (bx, by) in zip(points, batched):
+        single = util.project_shape(Point(x, y), 2272, 4326)
+        assert single.x == pytest.approx(bx)
+        assert single.y == pytest.approx(by)
+
+def test_project_points_same_srid_is_identity():
+    points = [(1.0, 2.0), (3.0, 4.0)]
+    assert util.project_points(points, 2272, 2272) == points
+
+def test_strtree_positions_match_built_geometries():
+    from shapely.geometry import Point, box
+    from shapely.strtree import STRtree
+    shapes = [box(0, 0, 1, 1), box(5, 5, 6, 6), box(10, 10, 11, 11)]
+    tree = STRtree(shapes)
+    tree_positions = {id(shape): position for position, shape in enumerate(shapes)}
+    hits = [util.get_strtree_position(hit, tree_positions) for hit in tree.query(box(4, 4, 7, 7))]
+    assert hits == [1]
+    assert util.get_strtree_position(tree.nearest(Point(10.5, 12)), tree_positions) == 2
+
+def test_cached_parser_counts_hits_and_misses():
+    class CountingParser:
+        calls = 0
+        def parse(self, raw):
+            self.calls += 1
+            return {'type': 'address', 'components': {'output_address': raw.upper()}}
+
+    inner = CountingParser()
+    parser = util.CachedParser(inner, maxsize=2)
+    assert parser.parse('1234 market st')['components']['output_address'] == '1234 MARKET ST'
+    parser.parse('1234 market st')
+    assert inner.calls == 1
+    assert parser.cache_info()['hits'] == 1
+    assert parser.cache_info()['misses'] == 1
+
+def test_cached_parser_results_are_copies():
+    class StubParser:
+        def parse(self, raw):
+            return {'type': 'address'}
+
+    parser = util.CachedParser(StubParser())
+    parser.parse('x')['type'] = 'mutated'
+    assert parser.parse('x')['type'] == 'address'
+
+def test_cached_parser_evicts_least_recently_used():
+    class StubParser:
+        def parse(self, raw):
+            return {'raw': raw}
+
+    parser = util.CachedParser(StubParser(), maxsize=2)
+    parser.parse('a')
+    parser.parse('b')
+    parser.parse('a')
+    parser.parse('c')
+    assert parser.cache_info()['currsize'] == 2
+    assert 'b' not in parser._cache
+
+def test_owner_tokens_split_on_anything_but_letters_and_digits():
+    assert util.owner_tokens("O'Brien Mary|Smith & Sons 2nd LLC") == \
+        ['OBRIEN', 'MARY', 'SMITH', 'SONS', '2ND', 'LLC']
+    assert util.owner_tokens(' & ') == []
+
+def test_persistent_parse_cache_is_shared_and_versioned(tmpdir):
+    class CountingParser:
+        calls = 0
+        def parse(self, raw):
+            self.calls += 1
+            return {'type': 'address', 'components': {'output_address': raw.upper()}}
+
+    path = str(tmpdir.join('parse_cache.sqlite'))
+    inner = CountingParser()
+    first = util.PersistentParseCache(inner, path, '1.0')
+    assert first.parse('1234 market st')['components']['output_address'] == '1234 MARKET ST'
+    first.flush()
+
+    # Another process (or a later build) with the same parser version
+    second = util.PersistentParseCache(inner, path, '1.0')
+    assert second.parse('1234 market st')['components']['output_address'] == '1234 MARKET ST'
+    assert inner.calls == 1
+    assert second.get_many(['1234 market st', 'x']).keys() == {'1234 market st'}
+
+    # A new parser version doesn't see the old results
+    upgraded = util.PersistentParseCache(inner, path, '2.0')
+    upgraded.parse('1234 market st')
+    assert inner.calls == 2
+
+def test_persistent_parse_cache_works_without_its_file(tmpdir):
+    class StubParser:
+        def parse(self, raw):
+            return {'raw': raw}
+
+    path = str(tmpdir.join('missing', 'parse_cache.sqlite'))
+    parser = util.PersistentParseCache(StubParser(), path, '1.0')
+    assert parser.parse('a') == {'raw': 'a'}
+    parser.flush()
+
+def test_api_parser_does_not_read_the_persistent_parse_cache():
+    from ais.models import parser
+    assert not isinstance(parser.parser, util.PersistentParseCache)
+
+def test_parser_version_changes_with_parser_data(tmpdir, monkeypatch):
+    package = tmpdir.mkdir('fake_parser_pkg')
+    package.join('__init__.py').write("__version__ = '1.0'\nclass Parser:\n    pass\n")
+    data = package.join('centerline.csv')
+    data.write('seg_id\n1\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    from fake_parser_pkg import Parser
+
+    version = util.get_parser_version(Parser())
+    assert version.startswith('1.0+data.')
+    assert util.get_parser_version(Parser()) == version
+    data.write('seg_id\n1\n2\n')
+    assert util.get_parser_version(Parser()) != version
@@ -1,6 +1,7 @@
 import json
 import pytest
-from ais import app, app_db
+from urllib.parse import quote
+from ais import app, app_db, util
 from operator import eq, gt
 
 @pytest.fixture
@@ -360,6 +361,47 @@ def test_owner_not_found(client):
     assert_status(response, 404)
     #assert_status(response, 200)
 
+def test_owner_search_matches_every_part_in_any_order(client):
+    forward = json.loads(client.get('/owner/CITY OF PHILA').get_data().decode())
+    backward = json.loads(client.get('/owner/PHILA CITY OF').get_data().decode())
+    assert forward['total_size'] == backward['total_size'] > 0
+    for feature in forward['features']:
+        tokens = util.owner_tokens('|'.join(feature['properties']['opa_owners']))
+        for part in ('CITY', 'OF', 'PHILA'):
+            assert any(token.startswith(part) for token in tokens)
+
+def test_owner_search_tolerates_typos_when_configured(client, monkeypatch):
+    response = client.get('/owner/PHILADELFIA')
+    assert_status(response, 404)
+    monkeypatch.setitem(app.config['OWNER_SEARCH'], 'max_typos', 1)
+    response = client.get('/owner/PHILADELFIA?page=1')
+    assert_status(response, 200)
+
+def test_owner_search_keeps_most_similar_candidates(monkeypatch):
+    from sqlalchemy import func
+    from ais.models import AddressSummary
+    from ..owner_search import find_owner_address_ids
+    # Only exact tokens match, so every candidate matches the one part exactly
+    monkeypatch.setitem(app.config['OWNER_SEARCH'], 'prefix', False)
+    everything = find_owner_address_ids('SAND')
+    monkeypatch.setitem(app.config['OWNER_SEARCH'], 'max_candidates', 5)
+    kept = find_owner_address_ids('SAND')
+    assert len(everything) > len(kept) == 5
+    similarities = dict(app_db.session.query(
+        AddressSummary.id, func.coalesce(func.similarity(AddressSummary.opa_owners, 'SAND'), 0))
+        .filter(AddressSummary.id.in_(everything)))
+    assert min(similarities[address_id] for address_id in kept) >= \
+        max(similarities[address_id] for address_id in everything if address_id not in kept)
+
+def test_owner_search_keeps_opa_candidates_with_opa_only(monkeypatch):
+    from ais.models import AddressSummary
+    from ..owner_search import find_owner_address_ids
+    monkeypatch.setitem(app.config['OWNER_SEARCH'], 'max_candidates', 5)
+    kept = find_owner_address_ids('CITY OF PHILA', opa_only=True)
+    assert len(kept) == 5
+    opa_account_nums = [address.opa_account_num for address in AddressSummary.query.filter(AddressSummary.id.in_(kept))]
+    assert all(opa_account_nums)
+
 def test_general_responses_are_cached(client):
     response = client.get('/addresses/1234 Market St')
     assert response.cache_control.max_age is not None
@@ -492,6 +534,23 @@ def test_addresses_with_unit_and_unmatching_high_num_resolves_to_match_with_no_h
     assert features[0]['properties']['street_address'] == '1769 FRANKFORD AVE APT 4'
     assert features[0]['match_type'] == 'in_range'
 
+def test_unit_children_of_base_address_match_unit_child(client):
+    response = client.get('/search/1769 frankford ave?include_units')
+    data = json.loads(response.get_data().decode())
+    features = data['features']
+    assert features[0]['properties']['street_address'] == '1769 FRANKFORD AVE'
+    assert features[0]['match_type'] == 'exact'
+    assert len(features) > 1
+    for feature in features[1:]:
+        assert feature['match_type'] == 'unit_child', feature['properties']['street_address']
+
+def test_address_in_range_of_query_matches_in_range(client):
+    response = client.get('/search/901-4 n 3rd st')
+    data = json.loads(response.get_data().decode())
+    features = data['features']
+    assert features[0]['properties']['street_address'] == '901 N 3RD ST'
+    assert features[0]['match_type'] == 'in_range'
+
 def test_sort_order_for_address_low_suffix_in_response(client):
     response = client.get('/search/1801 jfk blvd')
     data = json.loads(response.get_data().decode())
@@ -506,6 +565,23 @@ def test_child_addresses_get_linked_address_tags(client):
     features = data['features']
     assert features[0]['properties']['dor_parcel_id'] == '009S190092'
 
+def test_later_pages_get_tags_of_their_own_addresses(client):
+    """
+    Each address on a page after the first has the same tags as when it's
+    looked up on its own.
+    """
+    response = client.get('/owner/CITY OF PHILA?page=2&source_details')
+    assert_status(response, 200)
+    data = json.loads(response.get_data().decode())
+    assert data['page'] == 2
+    assert data['features']
+    for feature in data['features']:
+        street_address = feature['properties']['street_address']
+        url = '/addresses/{}?source_details'.format(quote(street_address))
+        single = json.loads(client.get(url).get_data().decode())
+        single_feature = next(f for f in single['features'] if f['properties']['street_address'] == street_address)
+        assert feature['properties'] == single_feature['properties'], street_address
+
 def test_match_type_for_search_by_key(client):
     response = client.get('/search/009S190092')
     data = json.loads(response.get_data().decode())
@@ -658,6 +734,20 @@ def test_reverse_geocode(client):
     response = client.get('/search/-70/40')
     assert_status(response, 404)
 
+def test_reverse_geocode_limit_returns_nearest_addresses_first(client):
+    response = client.get('/reverse_geocode/-75.15311665258051,39.94923709403044?limit=5')
+    assert_status(response, 200)
+    data = json.loads(response.get_data().decode())
+    addresses = [feature['properties']['street_address'] for feature in data['features']]
+    assert len(addresses) == len(set(addresses)) == 5
+    assert addresses[0] == '714 CHESTNUT ST'
+
+def test_reverse_geocode_limit_is_validated(client):
+    response = client.get('/reverse_geocode/-75.15311665258051,39.94923709403044?limit=0')
+    assert_status(response, 404)
+    response = client.get('/reverse_geocode/-75.15311665258051,39.94923709403044?limit=1000')
+    assert_status(response, 404)
+
 def test_0_address_low_addresses_return_404(client):
     response = client.get('/addresses/0 Lister')
     assert_status(response, 404)
@@ -728,3 +818,267 @@ def test_null_usps_zip_populated_from_service_area(client):
     data = json.loads(response.get_data().decode())
     assert data['features'][0]['properties']['zip_code'] == '19125'
 
+
+def count_statements(client, url):
+    from sqlalchemy import event
+    from ..cache import response_cache
+    if response_cache:
+        response_cache.clear()
+    # Connect first, so that the dialect's first-connect queries aren't counted
+    app_db.engine.connect().close()
+    statements = []
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(app_db.engine, 'before_cursor_execute', on_execute)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(app_db.engine, 'before_cursor_execute', on_execute)
+    assert_status(response, 200)
+    return len(statements)
+
+def test_addresses_statement_count(client):
+    """
+    An address takes three statements: the fallback tier, the page with its
+    total and geocodes, and the page's tags. Choosing a geocode location
+    (on_curb, on_street, parcel_geocode_location) is resolved in the page
+    query, so it shouldn't cost any extra round trips.
+    """
+    for args in ('', '?on_curb', '?on_street', '?parcel_geocode_location=pwd_parcel'):
+        num_statements = count_statements(client, '/addresses/1234 market st' + args)
+        assert num_statements == 3, (
+            '{} issued {} statements; expected 3').format(args or 'no args', num_statements)
+
+def test_block_statement_count(client):
+    """A block takes two statements: the page with its total and geocodes, and the page's tags."""
+    for args in ('', '?on_curb', '?on_street', '?parcel_geocode_location=pwd_parcel'):
+        num_statements = count_statements(client, '/block/1234 market st' + args)
+        assert num_statements == 2, (
+            '{} issued {} statements; expected 2').format(args or 'no args', num_statements)
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    from ais.api import cache
+    monkeypatch.setattr(cache, 'response_cache', cache.LRUCacheBackend())
+
+def test_cached_response_echoes_current_query(client, response_cache):
+    client.get('/addresses/1234 market st')
+    response = client.get('/addresses/1234 MARKET STREET')
+    assert_status(response, 200)
+    data = json.loads(response.get_data().decode())
+    assert data['query'] == '1234 MARKET STREET'
+    assert data['normalized'] == '1234 MARKET ST'
+
+def test_cached_response_echoes_first_batch_query(client, response_cache):
+    uncached = json.loads(client.get('/addresses/1234 market st;1801 N 10th St?srid=2272;4326')
+                          .get_data().decode())
+    assert uncached['query'] == '1234 market st'
+    assert uncached['search_params'] == {'srid': '2272'}
+    cached = json.loads(client.get('/addresses/1234 MARKET STREET;524 N Broad St?srid=2272;4326')
+                        .get_data().decode())
+    assert cached['query'] == '1234 MARKET STREET'
+    assert cached['search_params'] == uncached['search_params']
+
+def test_batch_addresses_match_single_responses(client):
+    queries = ['1234 market st', '1801 N 10th St', '524 N Broad St', 'not an address',
+               # Suffixed siblings and synonymous unit types
+               '1801 jfk blvd', '742R S DARIEN ST', '337 s camac st apt 3', '826-28 N 3rd St # 1',
+               '826-28 N 3rd St Unit 1', '826-28 N 3rd St Ste 1', '1769-75 frankford ave apt 4']
+    response = client.post('/batch/addresses', data=json.dumps(queries),
+                           content_type='application/json')
+    assert_status(response, 200)
+    lines = [line for line in response.get_data().decode().split('\n') if line]
+    assert len(lines) == len(queries)
+
+    for query, line in zip(queries, lines):
+        batch_data = json.loads(line)
+        single_data = json.loads(client.get('/addresses/{}'.format(quote(query))).get_data().decode())
+        assert batch_data.get('features') == single_data.get('features'), query
+        assert batch_data.get('total_size') == single_data.get('total_size'), query
+        assert batch_data.get('status') == single_data.get('status'), query
+
+def test_batch_addresses_cut_queries_and_args_like_single_responses(client):
+    queries = ['1234 market st;1801 N 10th St']
+    response = client.post('/batch/addresses?srid=2272;4326', data=json.dumps(queries),
+                           content_type='application/json')
+    batch_data = json.loads(response.get_data().decode().split('\n')[0])
+    single_data = json.loads(client.get('/addresses/{}?srid=2272;4326'.format(quote(queries[0]))).get_data().decode())
+    for key in ('query', 'normalized', 'search_params', 'features'):
+        assert batch_data[key] == single_data[key], key
+
+def test_parser_cache_info_is_logged(client, monkeypatch):
+    from .. import views
+    logged = []
+    monkeypatch.setattr(app.logger, 'warning', logged.append)
+    monkeypatch.setitem(app.config, 'PARSER_CACHE_LOG_INTERVAL', 1)
+    monkeypatch.setattr(views, '_parser_cache_logged', 0)
+    client.get('/addresses/1234 market st')
+    client.get('/addresses/1234 market st')
+    assert len(logged) == 1
+    assert logged[0].startswith('Parser cache: hits=')
+
+def test_batch_addresses_rejects_too_many_queries(client):
+    queries = ['1234 market st'] * (app.config['BATCH_MAX_QUERIES'] + 1)
+    response = client.post('/batch/addresses', data=json.dumps(queries),
+                           content_type='application/json')
+    assert_status(response, 400)
+
+def test_streamed_block_matches_paged_block(client):
+    paged = json.loads(client.get('/block/1200 block of market st').get_data().decode())
+    response = client.get('/block/1200 block of market st?page_size=100')
+    assert_status(response, 200)
+    assert response.is_streamed
+    streamed = json.loads(response.get_data().decode())
+    assert streamed['features'] == paged['features']
+    assert streamed['total_size'] == paged['total_size']
+
+def test_block_cursor_walks_every_geocode_once(client):
+    url = '/block/1200 block of market st?parcel_geocode_location=all'
+    paged = json.loads(client.get(url + '&page_size=1000').get_data().decode())
+    expected = [(feature['properties']['street_address'], feature['geometry']['geocode_type'])
+                for feature in paged['features']]
+
+    walked = []
+    cursor = ''
+    while True:
+        data = json.loads(client.get(url + '&page_size=3&cursor=' + cursor).get_data().decode())
+        walked += [(feature['properties']['street_address'], feature['geometry']['geocode_type'])
+                   for feature in data['features']]
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert len(walked) == len(set(walked))
+    assert sorted(walked) == sorted(expected)
+
+def test_ndjson_owner_has_one_feature_per_line(client):
+    paged = json.loads(client.get('/owner/SAND').get_data().decode())
+    response = client.get('/owner/SAND?format=ndjson&page_size=1000')
+    assert_status(response, 200)
+    assert response.mimetype == 'application/x-ndjson'
+    features = [json.loads(line) for line in response.get_data().decode().split('\n') if line]
+    assert len(features) == paged['total_size']
+    assert features[:len(paged['features'])] == paged['features']
+
+def test_bulk_owner_pages_go_past_response_limit(client):
+    paged = json.loads(client.get('/owner/CITY OF PHILA').get_data().decode())
+    assert paged['total_size'] == app.config['OWNER_RESPONSE_LIMIT']
+    response = client.get('/owner/CITY OF PHILA?format=ndjson&page_size=10000')
+    assert_status(response, 200)
+    features = [line for line in response.get_data().decode().split('\n') if line]
+    assert app.config['OWNER_RESPONSE_LIMIT'] < len(features) <= app.config['OWNER_SEARCH']['max_candidates']
+
+def test_page_size_is_capped(client):
+    response = client.get('/block/1200 block of market st?page_size={}'.format(app.config['MAX_PAGE_SIZE'] + 1))
+    assert_status(response, 404)
+
+def test_response_encoding_matches_stdlib(client):
+    from collections import OrderedDict
+    for url in ('/addresses/1234 market st?source_details', '/block/1200 block of market st', '/intersection/n 12th & market'):
+        body = client.get(url).get_data().decode()
+        assert body == json.dumps(json.loads(body, object_pairs_hook=OrderedDict)), url
+
+# Every address queried by the tests above, plus units that fall back
+FALLBACK_QUERIES = [
+    '0 Lister', '0-98 Sharpnack', '1050 filbert st', '11 N 2nd St', '1234 MARKET STREET', '1234 market st',
+    '13 1/2 Manheim St', '1307 S 6th St', '1319 N LEE ST', '1708 chestnut st', '1708-14 chestnut st',
+    '1737-39 Chestnut Street', '1769 frankford ave', '1769 frankford ave apt 2000', '1769-75 frankford ave',
+    '1769-75 frankford ave apt 4', '1801 N 10th St', '1801 jfk blvd', '1801-23 N 10th St', '1834-48 BLAIR ST',
+    '1849 blair st', '1922 SARTAIN ST', '1927 N PATTON ST,', '2100 KITTY HAWK AVE', '2100 SITTY TAWK AVE',
+    '2342 W HUNTING PARK AVE', '337 s camac st apt 3', '3419 ashfield lane', '3551 ashfield lane', '36 w gowen',
+    '523 N Broad St', '523-25 N Broad St', '524 N Broad St', '525 N Broad St', '5431R-39 westford rd',
+    '600 S 48th St', '621 REED ST APT 2R', '742R S DARIEN ST', '826-28 N 3rd St # 1', '826-28 N 3rd St # 11',
+    '826-28 N 3rd St Apartment 1', '826-28 N 3rd St Floor 1', '826-28 N 3rd St Ste 1', '826-28 N 3rd St Unit 1',
+    '901-4 n 3rd st', '921-29 E LYCOMING ST',
+]
+
+def sequential_address_tiers(filters, unit_type, normalized_address, base_address, base_address_no_num_suffix,
+                             high_num):
+    """
+    The fallback of the addresses view before its tiers were checked in one
+    statement: try each set of filters in turn until one finds addresses.
+    Returns a list of the tier that did, or an empty list.
+    """
+    from ais.models import AddressSummary
+    from ..views import AddressTier
+    range = None
+
+    def query_addresses(filters):
+        addresses = AddressSummary.query \
+                .filter_by(**filters) \
+                .filter_by_unit_type(unit_type)
+        return addresses
+
+    def matched(match_type, filters):
+        return [AddressTier(match_type, dict(filters), unit_type, bool(range))]
+
+    addresses = query_addresses(filters=filters)
+    if addresses.all():
+        return matched('exact', filters)
+    # if no matches, try base_address
+    if normalized_address != base_address:
+        if 'unit_num' in filters:
+            filters_copy = filters.copy()
+            filters_copy['unit_num'] = ''
+            unit_type = None
+        addresses = query_addresses(filters=filters_copy)
+        if addresses.all():
+            return matched('has_base', filters_copy)
+    if base_address != base_address_no_num_suffix:
+        filters_copy = filters.copy()
+        if 'unit_num' in filters:
+            filters_copy['unit_num'] = ''
+            unit_type = None
+        if 'address_low_suffix' in filters_copy:
+            del filters_copy['address_low_suffix']
+        if 'address_low_frac' in filters_copy:
+            del filters_copy['address_low_frac']
+        addresses = query_addresses(filters=filters_copy)
+        if addresses.all():
+            return matched('has_base_no_suffix', filters_copy)
+    # If no matches and is ranged address, try non-ranged low_num address
+    if high_num:
+        filters_copy = filters.copy()
+        del filters_copy['address_high']
+        range = True
+        addresses = query_addresses(filters=filters_copy)
+        if addresses.all():
+            return matched('in_range', filters_copy)
+        if normalized_address != base_address:
+            if 'unit_num' in filters:
+                filters_copy['unit_num'] = ''
+                unit_type = None
+            addresses = query_addresses(filters=filters_copy)
+            if addresses.all():
+                return matched('in_range_has_base', filters_copy)
+        if base_address != base_address_no_num_suffix:
+            if 'address_low_suffix' in filters_copy:
+                del filters_copy['address_low_suffix']
+            if 'address_low_frac' in filters_copy:
+                del filters_copy['address_low_frac']
+            addresses = query_addresses(filters=filters_copy)
+            if addresses.all():
+                return matched('in_range_has_base_no_suffix', filters_copy)
+    return []
+
+def test_ranked_fallback_matches_sequential_fallback(client, monkeypatch):
+    """
+    Picking the fallback tier with one ranked query gives the same responses
+    as trying each set of filters in turn, as the view used to.
+    """
+    from .. import views
+    from ..cache import response_cache
+
+    for query in FALLBACK_QUERIES:
+        for args in ('', '?include_units', '?opa_only'):
+            url = '/addresses/{}{}'.format(query, args)
+            if response_cache:
+                response_cache.clear()
+            ranked = client.get(url)
+            monkeypatch.setattr(views, 'get_address_tiers', sequential_address_tiers)
+            monkeypatch.setattr(views, 'find_address_tier', lambda tiers: 0 if tiers else None)
+            if response_cache:
+                response_cache.clear()
+            sequential = client.get(url)
+            monkeypatch.undo()
+            assert ranked.status_code == sequential.status_code, url
+            assert ranked.get_data() == sequential.get_data(), url
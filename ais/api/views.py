@@ -4,24 +4,33 @@ Does three primary things:
 * Standardizing addresses
 * Providing identifiers for other systems
 """
-from collections import OrderedDict
-from itertools import chain
-from flask import Response, request, redirect, url_for
+import time
+from collections import OrderedDict, namedtuple
+from itertools import chain, islice
+from flask import Response, request, redirect, url_for, stream_with_context
 from flask_cachecontrol import cache_for
 from flasgger.utils import swag_from
-from geoalchemy2.shape import to_shape
 from geoalchemy2.functions import ST_Transform
-from sqlalchemy import func, desc
-from passyunk.parser import PassyunkParser
+from sqlalchemy import func, desc, any_, bindparam, case, literal, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from ais import app, util, app_db as db
-from ais.models import Address, AddressSummary, StreetIntersection, StreetSegment, Geocode, AddressTag, DorParcel, PwdParcel, OpaProperty, ENGINE_SRID
+from ais.models import parser, Address, AddressSummary, StreetIntersection, Geocode, AddressTag, DorParcel, PwdParcel, OpaProperty, \
+    ADDRESS_SUMMARY_KEYSET_COLUMNS, ADDRESS_SUMMARY_GEOCODE_KEYSET_COLUMNS, SYNONYMOUS_UNIT_TYPES
 from ..util import NotNoneDict
 from .errors import json_error
-from .paginator import QueryPaginator, Paginator
+from .cache import cache_response
+from .segment_index import segment_index
+from .geocode_index import reverse_geocode_index
+from .owner_search import find_owner_address_ids
+from .paginator import QueryPaginator, WindowQueryPaginator, KeysetQueryPaginator, Paginator, PAGE_SIZE
 from .serializers import AddressJsonSerializer, IntersectionJsonSerializer, ServiceAreaSerializer, AddressTagSerializer
 
 config = app.config
 OWNER_RESPONSE_LIMIT = config['OWNER_RESPONSE_LIMIT']
+MAX_PAGE_SIZE = config['MAX_PAGE_SIZE']
+STREAM_CHUNK_SIZE = config['STREAM_CHUNK_SIZE']
+REVERSE_GEOCODE_MAX_LIMIT = config['REVERSE_GEOCODE_MAX_LIMIT']
 
 def json_response(*args, **kwargs):
     return Response(*args, mimetype='application/json', **kwargs)
@@ -37,37 +46,102 @@ def validate_page_param(request, paginator):
 
     return page_num, None
 
-# def get_tag_data(addresses):
-#     all_tags = {}
-#     for address, geocode_type, geom in addresses:
-#         tag_map = {}
-#         tags = AddressTag.query \
-#             .filter_tags_by_address(address.street_address)
-#         # TODO: If no tags, filter on base/in-range/overlapping number addresses. If still none, return 404.
-#         for tag in tags:
-#             if not tag.key in tag_map:
-#                 tag_map[tag.key] = []
-#             tag_map[tag.key].append(tag)
-#
-#         all_tags[address.street_address] = tag_map
-#
-#     return all_tags
+# # A single tag value, as consumed by AddressJsonSerializer.transform_tag_data
+TagValue = namedtuple('TagValue', ['value', 'linked_path'])
 
 def get_tag_data(addresses):
-    street_addresses = [address.street_address for address, geocode_type, geom in addresses]
-    tags = AddressTag.query \
-        .filter(AddressTag.street_address.in_(street_addresses))
+    """
+    Get tags for a page of (address, geocode_type, geom) rows. Tags come back
+    from one query already grouped by street address and key.
+    """
+    street_addresses = list(set(address.street_address for address, geocode_type, geom in addresses))
+    if not street_addresses:
+        return {}
+    tags = db.session.query(
+            AddressTag.street_address,
+            AddressTag.key,
+            func.array_agg(aggregate_order_by(AddressTag.value, AddressTag.id)),
+            func.array_agg(aggregate_order_by(AddressTag.linked_path, AddressTag.id))) \
+        .filter(AddressTag.street_address.in_(street_addresses)) \
+        .group_by(AddressTag.street_address, AddressTag.key)
     # TODO: If no tags, filter on base/in-range/overlapping number addresses. If still none, return 404.
     all_tags = {}
-    for tag in tags:
-        if not tag.street_address in all_tags:
-            all_tags[tag.street_address] = {}
-        if not tag.key in all_tags[tag.street_address]:
-            all_tags[tag.street_address][tag.key] = []
-        all_tags[tag.street_address][tag.key].append(tag)
+    for street_address, key, values, linked_paths in tags:
+        if not street_address in all_tags:
+            all_tags[street_address] = {}
+        all_tags[street_address][key] = [TagValue(value, linked_path)
+                                         for value, linked_path in zip(values, linked_paths)]
     return all_tags
 
 
+def get_stream_params(request):
+    """
+    Get the page size and format asked for by a bulk consumer. Either one
+    being given means the response should be streamed.
+    """
+    streamed = 'page_size' in request.args or 'format' in request.args
+    response_format = request.args.get('format', 'geojson').lower()
+    if response_format not in ('geojson', 'ndjson'):
+        error = json_error(404, 'Unknown response format.', {'format': response_format})
+        return None, None, None, error
+
+    page_size = request.args.get('page_size', str(PAGE_SIZE))
+    try:
+        page_size = int(page_size)
+        if not 1 <= page_size <= MAX_PAGE_SIZE:
+            raise ValueError
+    except ValueError:
+        error = json_error(404, 'Invalid page size.',
+                           {'page_size': page_size, 'max_page_size': MAX_PAGE_SIZE})
+        return None, None, None, error
+
+    return streamed, page_size, response_format == 'ndjson', None
+
+def stream_address_response(serializer, rows, ndjson=False):
+    """
+    Stream a page of (address, geocode_type, geom) rows, getting tags for and
+    serializing a chunk of rows at a time so that memory use doesn't grow with
+    the page size.
+    """
+    def rows_with_tags():
+        rows_iter = iter(rows)
+        while True:
+            chunk = list(islice(rows_iter, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            serializer.tag_data = get_tag_data(chunk)
+            yield from chunk
+
+    body = serializer.serialize_stream(rows_with_tags(), ndjson=ndjson)
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return Response(stream_with_context(body), mimetype=mimetype)
+
+
+def normalize_parsed(query, parsed=None):
+    parsed = parsed or parser.parse(query)
+    return parsed['components']['output_address']
+
+def normalize_raw(query, parsed=None):
+    return query.upper()
+
+def first_batch_query(query, args):
+    """
+    Get the first query of a (deprecated) batch query and its request args,
+    each cut at the first ';'.
+    """
+    requestargs = {}
+    if ';' in query:
+        query = query[:query.index(';')]
+    for arg in args:
+        val = args.get(arg)
+        if ';' in arg:
+            arg = arg[:arg.index(';')]
+        if ';' in val:
+            val = val[:val.index(';')]
+        requestargs[arg] = val
+    return query, requestargs
+
+
 @app.errorhandler(404)
 @app.errorhandler(500)
 def handle_errors(e):
@@ -138,7 +212,6 @@ def unknown_cascade_view(**kwargs):
     parsed = kwargs.get('parsed')
     seg_id = parsed['components']['cl_seg_id']
     base_address = parsed['components']['base_address']
-    sa_data = OrderedDict()
     config = app.config
     centerline_offset = config['GEOCODE']['centerline_offset']
     centerline_end_buffer = config['GEOCODE']['centerline_end_buffer']
@@ -164,10 +237,7 @@ def unknown_cascade_view(**kwargs):
         #                           search_type=search_type, address=address)
 
     # CASCADE TO STREET SEGMENT
-    cascadedseg = StreetSegment.query \
-        .filter_by_seg_id(seg_id) #if seg_id else None
-
-    cascadedseg = cascadedseg.first()
+    cascadedseg = segment_index.get_segment(seg_id)
 
     if not cascadedseg:
         error = json_error(404, 'Could not find any addresses matching query.',
@@ -186,13 +256,7 @@ def unknown_cascade_view(**kwargs):
         return json_response(response=error, status=404)
 
     # Get geom from true_range view item with same seg_id
-    true_range_stmt = '''
-                    Select true_left_from, true_left_to, true_right_from, true_right_to
-                     from true_range
-                     where seg_id = {seg_id}
-                '''.format(seg_id=cascadedseg.seg_id)
-    true_range_result = db.engine.execute(true_range_stmt).fetchall()
-    true_range_result = list(chain(*true_range_result))
+    true_range_result = segment_index.get_true_range(cascadedseg.seg_id)
     # Get side delta (address number range on seg side - from true_range if exists else from centerline seg)
     if true_range_result and seg_side=="R" and true_range_result[3] is not None and true_range_result[2] is not None:
         side_delta = true_range_result[3] - true_range_result[2]
@@ -210,27 +274,14 @@ def unknown_cascade_view(**kwargs):
     else:
         distance_ratio = (address.address_low - cascadedseg.right_from) / side_delta
 
-    shape = to_shape(cascadedseg.geom)
+    shape = cascadedseg.shape
 
     # New method: interpolate buffered
     seg_xsect_xy=util.interpolate_buffered(shape, distance_ratio, centerline_end_buffer)
     seg_xy = util.offset(shape, seg_xsect_xy, centerline_offset, seg_side)
 
     # GET INTERSECTING SERVICE AREAS
-    sa_stmt = '''
-                with foo as (
-                    SELECT layer_id, value
-                    from service_area_polygon
-                    where ST_Intersects(geom, ST_GeometryFromText('SRID={srid};{shape}'))
-                    )
-                SELECT DISTINCT ON (cols.layer_id) cols.layer_id, foo.value
-                from service_area_layer cols
-                left join foo on foo.layer_id = cols.layer_id
-        '''.format(shape=seg_xy, srid=ENGINE_SRID)
-
-    result = db.engine.execute(sa_stmt)
-    for item in result.fetchall():
-        sa_data[item[0]] = item[1]
+    sa_data = segment_index.get_service_areas(seg_xy)
 
     addresses = (address,)
     paginator = Paginator(addresses)
@@ -266,10 +317,131 @@ def unknown_cascade_view(**kwargs):
     return json_response(response=result, status=200)
 
 
+# A fallback tier of the addresses view: the filters and unit type it queries
+# with, whether it matches the low number of a range, and its match type.
+AddressTier = namedtuple('AddressTier', ['match_type', 'filters', 'unit_type', 'in_range'])
+
+def query_addresses(filters, unit_type):
+    return AddressSummary.query \
+        .filter_by(**filters) \
+        .filter_by_unit_type(unit_type)
+
+def get_address_filters(parsed):
+    """
+    Get the filters of the exact tier of an address query: the parsed
+    components, with the suffix and fraction left out when absent. The unit
+    type is filtered separately (see filter_by_unit_type).
+    """
+    full_num = parsed['components']['address']['full']
+    low_num = parsed['components']['address']['low_num']
+    high_num_full = parsed['components']['address']['high_num_full']
+    seg_id = parsed['components']['cl_seg_id']
+    unit_type = parsed['components']['address_unit']['unit_type']
+    unit_num = parsed['components']['address_unit']['unit_num']
+    loose_filters = OrderedDict([
+                                # ('seg_id',int(parsed['components']['cl_seg_id'])),
+                                 ('seg_id',seg_id),
+                                 ('address_low',low_num if low_num is not None else full_num),
+                                 ('address_low_suffix',parsed['components']['address']['addr_suffix']),
+                                 ('address_low_frac',parsed['components']['address']['fractional']),
+    ]) if seg_id else OrderedDict([
+                                 ('street_name',parsed['components']['street']['name']),
+                                 ('address_low',low_num if low_num is not None else full_num),
+                                 ('address_low_suffix',parsed['components']['address']['addr_suffix']),
+                                 ('address_low_frac',parsed['components']['address']['fractional']),
+                                 ('street_predir',parsed['components']['street']['predir']),
+                                 ('street_postdir',parsed['components']['street']['postdir']),
+                                 ('street_suffix',parsed['components']['street']['suffix']),
+    ])
+
+    strict_filters = dict(
+        address_high=high_num_full,
+        unit_num=unit_num or '',
+    )
+    # Remove keys with null values:
+    filters = loose_filters.copy()
+    for key, value in loose_filters.items():
+        if value is None:
+            del filters[key]
+
+    if unit_num == '':
+        strict_filters.update(dict(unit_type=unit_type or '', ))
+
+    filters.update(strict_filters)
+    return filters
+
+def get_exact_street_address(parsed):
+    """
+    Get the street address that the exact tier of an address query matches
+    alone, or None if the tier can match other addresses too: where a
+    component it filters on is missing (and so isn't filtered on), or the
+    unit type matches its synonyms.
+    """
+    components = parsed['components']
+    address = components['address']
+    street = components['street']
+    unit_type = components['address_unit']['unit_type']
+    unit_num = components['address_unit']['unit_num']
+    loose_values = [address['addr_suffix'], address['fractional']]
+    if not components['cl_seg_id']:
+        loose_values += [street['name'], street['predir'], street['postdir'], street['suffix']]
+    if any(value is None for value in loose_values):
+        return None
+    if unit_num and (not unit_type or unit_type in SYNONYMOUS_UNIT_TYPES):
+        return None
+    return components['output_address']
+
+def get_address_tiers(filters, unit_type, normalized_address, base_address, base_address_no_num_suffix, high_num):
+    """
+    List the tiers to fall back through for an address query, from the most to
+    the least specific. Each one drops the unit, the number suffix or fraction,
+    or the address high from the filters of an earlier one.
+    """
+    tiers = [AddressTier('exact', filters, unit_type, False)]
+    if normalized_address != base_address:
+        tier_filters = dict(filters, unit_num='')
+        unit_type = None
+        tiers.append(AddressTier('has_base', tier_filters, unit_type, False))
+    if base_address != base_address_no_num_suffix:
+        tier_filters = dict(filters, unit_num='')
+        unit_type = None
+        tier_filters.pop('address_low_suffix', None)
+        tier_filters.pop('address_low_frac', None)
+        tiers.append(AddressTier('has_base_no_suffix', tier_filters, unit_type, False))
+    # If it's a ranged address, try the non-ranged low number address
+    if high_num:
+        # TODO: handle overlapping addresses
+        tier_filters = dict(filters)
+        del tier_filters['address_high']
+        tiers.append(AddressTier('in_range', dict(tier_filters), unit_type, True))
+        if normalized_address != base_address:
+            tier_filters['unit_num'] = ''
+            unit_type = None
+            tiers.append(AddressTier('in_range_has_base', dict(tier_filters), unit_type, True))
+        if base_address != base_address_no_num_suffix:
+            tier_filters.pop('address_low_suffix', None)
+            tier_filters.pop('address_low_frac', None)
+            tiers.append(AddressTier('in_range_has_base_no_suffix', dict(tier_filters), unit_type, True))
+    return tiers
+
+def find_address_tier(tiers):
+    """
+    Get the index of the first tier that matches any addresses, or None. All
+    of the tiers are checked in one statement.
+    """
+    tier_queries = [
+        query_addresses(tier.filters, tier.unit_type).with_entities(literal(index).label('tier'))
+        for index, tier in enumerate(tiers)
+    ]
+    matched_tiers = union_all(*[tier_query.statement for tier_query in tier_queries]).alias('matched_tiers')
+    return db.session.query(func.min(matched_tiers.c.tier)).scalar()
+
+
 @app.route('/addresses/<path:query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed, echo=first_batch_query)
 @swag_from('docs/addresses.yml')
-def addresses(query):
+def addresses(query, parsed=None):
     """
     Looks up information about the address given in the query. Response is an
     object with the information for the matching address. The object includes:
@@ -298,20 +470,12 @@ def addresses(query):
 
     # Batch queries have been depreciated for this endpoint;
     # handle first query of batch query attempts:
-    requestargs = {}
-    if ';' in query:
-        query = query[:query.index(';')]
-    for arg in request.args:
-        val = request.args.get(arg)
-        if ';' in arg:
-            arg = arg[:arg.index(';')]
-        if ';' in val:
-            val = val[:val.index(';')]
-        requestargs[arg] = val
+    query, requestargs = first_batch_query(query, request.args)
     # TODO: Passyunk should handle '5249 GERMANTOWN AVE REAR UNIT REAR'
     search_type=normalized_address= ''
     try:
-        parsed = PassyunkParser().parse(query)
+        if parsed is None:
+            parsed = parser.parse(query)
         search_type = parsed['type']
         normalized_address = parsed['components']['output_address']
     except:
@@ -342,107 +506,40 @@ def addresses(query):
     #                              ('street_postdir',parsed['components']['street']['postdir']),
     #                              ('street_suffix',parsed['components']['street']['suffix']),
     # ])
-    loose_filters = OrderedDict([
-                                # ('seg_id',int(parsed['components']['cl_seg_id'])),
-                                 ('seg_id',seg_id),
-                                 ('address_low',low_num if low_num is not None else full_num),
-                                 ('address_low_suffix',parsed['components']['address']['addr_suffix']),
-                                 ('address_low_frac',parsed['components']['address']['fractional']),
-    ]) if seg_id else OrderedDict([
-                                 ('street_name',parsed['components']['street']['name']),
-                                 ('address_low',low_num if low_num is not None else full_num),
-                                 ('address_low_suffix',parsed['components']['address']['addr_suffix']),
-                                 ('address_low_frac',parsed['components']['address']['fractional']),
-                                 ('street_predir',parsed['components']['street']['predir']),
-                                 ('street_postdir',parsed['components']['street']['postdir']),
-                                 ('street_suffix',parsed['components']['street']['suffix']),
-    ])
-
-    strict_filters = dict(
-        address_high=high_num_full,
-        unit_num=unit_num or '',
-    )
-    # Remove keys with null values:
-    filters = loose_filters.copy()
-    for key, value in loose_filters.items():
-        if value is None:
-            del filters[key]
-
-    if unit_num == '':
-        strict_filters.update(dict(unit_type=unit_type or '', ))
-
-    filters.update(strict_filters)
+    filters = get_address_filters(parsed)
 
     if search_type not in ('address', 'street') or low_num is None:
         error = json_error(404, 'Not a valid address.',
                            {'query': query, 'normalized': normalized_address,'search_type': search_type})
         return json_response(response=error, status=404)
 
-    range = None
+    def process_query(tier):
 
-    def query_addresses(filters):
-
-        addresses = AddressSummary.query \
-                .filter_by(**filters) \
-                .filter_by_unit_type(unit_type) #\
-        return addresses
-
-    def process_query(addresses, match_type):
-
-        addresses = addresses.include_child_units(
+        addresses = query_addresses(tier.filters, tier.unit_type).include_child_units(
             'include_units' in request.args and request.args['include_units'].lower() != 'false',
-            is_range=False if range else high_num_full is not None,
-            is_unit=unit_type is not None,
+            is_range=False if tier.in_range else high_num_full is not None,
+            is_unit=tier.unit_type is not None,
             request=request) \
             .exclude_non_opa('opa_only' in request.args and request.args['opa_only'].lower() != 'false') \
             .get_address_geoms(request) \
             .order_by_address()
 
-        # Get tag data
-        # if not addresses.all():
-        # if addresses.all():
-        if not addresses.all():
-            if 'opa_only' in request.args and request.args['opa_only'].lower() != 'false':
-                error = json_error(404, 'Could not find any opa addresses matching the query.',
-                                   {'query': query, 'normalized': normalized_address, 'search_type': search_type})
-                return json_response(response=error, status=404)
-            else:
-                error = json_error(404, 'Invalid query.',
-                                   {'query': query, 'normalized': normalized_address, 'search_type': search_type,
-                                    'search_params': requestargs, })
-                return json_response(response=error, status=404)
-        try:
-            all_tags = get_tag_data(addresses)
-        except:
-            error = json_error(404, 'Invalid query.',
-                               {'query': query, 'normalized': normalized_address, 'search_type': search_type,
-                                'search_params': requestargs, })
-            return json_response(response=error, status=404)
-
         # Get pagination
-        paginator = QueryPaginator(addresses)
+        paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'))
 
-        # Ensure that we have results
+        # Ensure that we have results. The tier matched, so there are none
+        # only if child units or non-OPA addresses were filtered out.
         addresses_count = paginator.collection_size
-
-        # Handle unmatched addresses TODO: After deciding todo above, update this section (i.e. delete)
         if addresses_count == 0:
-
             if 'opa_only' in request.args and request.args['opa_only'].lower() != 'false':
                 error = json_error(404, 'Could not find any opa addresses matching the query.',
                                    {'query': query, 'normalized': normalized_address, 'search_type': search_type})
                 return json_response(response=error, status=404)
-            elif 'estimate' in request.args and request.args['estimate'].lower() == 'false':
-                error = json_error(404, 'Could not find any known addresses matching the query.',
-                                   {'query': query, 'normalized': normalized_address, 'search_type': search_type})
-                return json_response(response=error, status=404)
-            else:  # Try to cascade to street centerline segment
+            else:
                 error = json_error(404, 'Invalid query.',
                                    {'query': query, 'normalized': normalized_address, 'search_type': search_type,
                                     'search_params': requestargs, })
                 return json_response(response=error, status=404)
-                # return unknown_cascade_view(query=query, normalized_address=normalized_address, search_type=search_type,
-                #                             parsed=parsed)
 
         # Validate the pagination
         page_num, error = validate_page_param(request, paginator)
@@ -454,8 +551,18 @@ def addresses(query):
         crs = {'type': 'link',
                'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
 
+        addresses_page = list(paginator.get_page(page_num))
+
+        # Get tag data for just this page
+        try:
+            all_tags = get_tag_data(addresses_page)
+        except:
+            error = json_error(404, 'Invalid query.',
+                               {'query': query, 'normalized': normalized_address, 'search_type': search_type,
+                                'search_params': requestargs, })
+            return json_response(response=error, status=404)
+
         # Serialize the response
-        addresses_page = paginator.get_page(page_num)
         serializer = AddressJsonSerializer(
             metadata={'query': query, 'normalized': normalized_address, 'search_type': search_type,
                       'search_params': requestargs, 'crs': crs},
@@ -464,7 +571,7 @@ def addresses(query):
             normalized_address=normalized_address,
             base_address=base_address,
             tag_data=all_tags,
-            match_type=match_type,
+            match_type=tier.match_type,
             ref_addr=normalized_address,
         )
         try:
@@ -477,79 +584,147 @@ def addresses(query):
             return json_response(response=error, status=404)
 
 
-    addresses = query_addresses(filters=filters)
-    if addresses.all():
-        match_type = 'exact'
-        return process_query(addresses, match_type)
-    # if no matches, try base_address
-    if normalized_address != base_address:
-        if 'unit_num' in filters:
-            filters_copy = filters.copy()
-            filters_copy['unit_num'] = ''
-            unit_type = None  # more elegant approach involving filter_by_unit_type preferred
-        addresses = query_addresses(filters=filters_copy)
-        if addresses.all():
-            match_type = 'has_base'
-            return process_query(addresses, match_type)
-    if base_address != base_address_no_num_suffix:
-        filters_copy = filters.copy()
-        if 'unit_num' in filters:
-            filters_copy['unit_num'] = ''
-            unit_type = None
-        if 'address_low_suffix' in filters_copy:
-            del filters_copy['address_low_suffix']
-        if 'address_low_frac' in filters_copy:
-            del filters_copy['address_low_frac']
-        addresses = query_addresses(filters=filters_copy)
-        if addresses.all():
-            match_type = 'has_base_no_suffix'
-            return process_query(addresses, match_type)
-    # # If no matches and is ranged address, try non-ranged low_num address
-    if high_num:
-        # TODO: handle overlapping addresses
-        filters_copy = filters.copy()
-        del filters_copy['address_high']
-        range = True
-        addresses = query_addresses(filters=filters_copy)
-        if addresses.all():
-            match_type = 'in_range'
-            return process_query(addresses, match_type)
-        if normalized_address != base_address:
-            if 'unit_num' in filters:
-                filters_copy['unit_num'] = ''
-                unit_type = None  # more elegant approach involving filter_by_unit_type preferred
-            addresses = query_addresses(filters=filters_copy)
-            if addresses.all():
-                match_type = 'in_range_has_base'
-                return process_query(addresses, match_type)
-        if base_address != base_address_no_num_suffix:
-            if 'address_low_suffix' in filters_copy:
-                del filters_copy['address_low_suffix']
-            if 'address_low_frac' in filters_copy:
-                del filters_copy['address_low_frac']
-            addresses = query_addresses(filters=filters_copy)
-            if addresses.all():
-                match_type = 'in_range_has_base_no_suffix'
-                return process_query(addresses, match_type)
+    # Use the most specific fallback tier that matches any addresses
+    tiers = get_address_tiers(filters, unit_type, normalized_address, base_address,
+                              base_address_no_num_suffix, high_num)
+    tier_index = find_address_tier(tiers)
+    if tier_index is not None:
+        return process_query(tiers[tier_index])
 
+    # TODO: Decide what to do here!
+    if 'opa_only' in request.args and request.args['opa_only'].lower() != 'false':
+        error = json_error(404, 'Could not find any opa addresses matching the query.',
+                                {'query': query, 'normalized': normalized_address, 'search_type': search_type})
+        return json_response(response=error, status=404)
+    elif 'estimate' in request.args and request.args['estimate'].lower() == 'false':
+        error = json_error(404, 'Could not find any known addresses matching the query.',
+                                {'query': query, 'normalized': normalized_address, 'search_type': search_type})
+        return json_response(response=error, status=404)
+    else: # Try to cascade to street centerline segment
+        return unknown_cascade_view(query=query, normalized_address=normalized_address, search_type=search_type, parsed=parsed)
 
-    if not addresses.all(): # TODO: Decide what to do here!
-        if 'opa_only' in request.args and request.args['opa_only'].lower() != 'false':
-            error = json_error(404, 'Could not find any opa addresses matching the query.',
-                                    {'query': query, 'normalized': normalized_address, 'search_type': search_type})
-            return json_response(response=error, status=404)
-        elif 'estimate' in request.args and request.args['estimate'].lower() == 'false':
-            error = json_error(404, 'Could not find any known addresses matching the query.',
-                                    {'query': query, 'normalized': normalized_address, 'search_type': search_type})
-            return json_response(response=error, status=404)
-        else: # Try to cascade to street centerline segment
-            return unknown_cascade_view(query=query, normalized_address=normalized_address, search_type=search_type, parsed=parsed)
+
+def get_batch_queries(request):
+    """
+    Read the list of queries for a batch request. The body may be a JSON list,
+    a JSON object with a `queries` list, or plain text with one query per line.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        text = request.get_data(as_text=True)
+        return [line.strip() for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('queries')
+    if not isinstance(data, list) or not all(isinstance(query, str) for query in data):
+        raise ValueError('Expected a list of query strings.')
+    return data
+
+
+@app.route('/batch/addresses', methods=['POST'])
+@swag_from('docs/batch_addresses.yml')
+def batch_addresses():
+    """
+    Geocodes a batch of addresses in one request. Queries whose exact tier
+    matches a single street address are resolved at once in two statements:
+    one fetches the addresses by street address and one gets their tags. Each
+    other query, and each one the lookup finds nothing for, is then run
+    through the whole /addresses/ view, at the cost of an /addresses/ request.
+
+    Responds with newline-delimited JSON: one line per query, in order, each
+    the same as the /addresses/ response for that query.
+    """
+    try:
+        queries = get_batch_queries(request)
+    except ValueError as e:
+        error = json_error(400, str(e), None)
+        return json_response(response=error, status=400)
+
+    max_queries = config['BATCH_MAX_QUERIES']
+    if not queries:
+        error = json_error(400, 'No queries provided.', None)
+        return json_response(response=error, status=400)
+    if len(queries) > max_queries:
+        error = json_error(400, 'Too many queries; the limit is {}.'.format(max_queries),
+                           {'num_queries': len(queries)})
+        return json_response(response=error, status=400)
+
+    # Parse everything up front. Queries and args are cut at the first ';',
+    # as /addresses/ does.
+    requestargs = first_batch_query('', request.args)[1]
+    cut_queries = []
+    parsed_queries = []
+    for query in queries:
+        query = first_batch_query(query.strip('/'), {})[0]
+        try:
+            parsed = parser.parse(query)
+        except:
+            parsed = None
+        if parsed and parsed['type'] not in ('address', 'street'):
+            parsed = None
+        cut_queries.append(query)
+        parsed_queries.append(parsed)
+
+    # Resolve the exact tier of every query at once, looking up the street
+    # addresses of the queries it matches alone in one statement. Including
+    # units widens each match to a set of addresses, so those go through the
+    # cascade instead.
+    include_units = 'include_units' in request.args and request.args['include_units'].lower() != 'false'
+    query_indexes = {}  # street address => indexes of the queries for it
+    if not include_units:
+        for index, parsed in enumerate(parsed_queries):
+            if parsed and parsed['components']['address']['low_num'] is not None:
+                street_address = get_exact_street_address(parsed)
+                if street_address:
+                    query_indexes.setdefault(street_address, []).append(index)
+
+    exact_rows = {}  # query index => rows
+    if query_indexes:
+        matched_rows = AddressSummary.query \
+            .filter(AddressSummary.street_address == any_(
+                bindparam('street_addresses', value=list(query_indexes), type_=ARRAY(db.Text)))) \
+            .exclude_non_opa('opa_only' in request.args and request.args['opa_only'].lower() != 'false') \
+            .get_address_geoms(request) \
+            .order_by_address()
+        for row in matched_rows:
+            for query_index in query_indexes[row[0].street_address]:
+                exact_rows.setdefault(query_index, []).append(row)
+    all_tags = get_tag_data(list(chain(*exact_rows.values())))
+
+    srid = request.args.get('srid') if 'srid' in request.args else config['DEFAULT_API_SRID']
+    crs = {'type': 'link',
+           'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
+
+    def generate():
+        for query_index, (query, parsed) in enumerate(zip(queries, parsed_queries)):
+            normalized_address = parsed['components']['output_address'] if parsed else None
+            rows = exact_rows.get(query_index)
+            if rows:
+                paginator = Paginator(rows)
+                serializer = AddressJsonSerializer(
+                    metadata={'query': cut_queries[query_index], 'normalized': normalized_address,
+                              'search_type': parsed['type'], 'search_params': requestargs, 'crs': crs},
+                    pagination=paginator.get_page_info(1),
+                    srid=srid,
+                    normalized_address=normalized_address,
+                    base_address=parsed['components']['base_address'],
+                    tag_data=all_tags,
+                    match_type='exact',
+                    ref_addr=normalized_address,
+                )
+                result = serializer.serialize_many(paginator.get_page(1))
+            else:
+                # Fall back to the full cascade for this query
+                result = addresses(query).get_data(as_text=True)
+            yield result + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/block/<path:query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/block.yml')
-def block(query):
+def block(query, parsed=None):
     """
     Looks up information about the 100-range that the given address falls
     within.
@@ -559,7 +734,7 @@ def block(query):
           would go at a new route, like `segment` or `block-face`.
     """
     query = query.strip('/')
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
 
     # search_type = parsed['type']
     # if search_type != 'block':
@@ -570,6 +745,10 @@ def block(query):
     search_type = 'block'
     normalized_address = parsed['components']['output_address']
 
+    streamed, page_size, ndjson, error = get_stream_params(request)
+    if error:
+        return json_response(response=error, status=404)
+
     # Ensure that we can get a valid address number
     try:
         address_num = int(parsed['components']['address']['low_num']
@@ -598,11 +777,27 @@ def block(query):
         .get_address_geoms(request)
 
     addresses = addresses.order_by_address()
-    paginator = QueryPaginator(addresses)
+
+    # Walk the block with a cursor instead of page numbers, if asked
+    if 'cursor' in request.args:
+        if request.args.get('parcel_geocode_location') in ('', 'all'):
+            key_columns = ADDRESS_SUMMARY_GEOCODE_KEYSET_COLUMNS
+        else:
+            key_columns = ADDRESS_SUMMARY_KEYSET_COLUMNS
+        paginator = KeysetQueryPaginator(addresses, key_columns, max_page_size=page_size)
+        try:
+            block_page, next_cursor = paginator.get_page_after(request.args.get('cursor'))
+        except QueryPaginator.ValidationError as e:
+            error = json_error(404, e.message, e.data)
+            return json_response(response=error, status=404)
+        addresses_count = len(block_page)
+        pagination = paginator.get_cursor_page_info(block_page, next_cursor)
+    else:
+        paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'), max_page_size=page_size,
+                                         stream_chunk_size=STREAM_CHUNK_SIZE if streamed else None)
+        addresses_count = paginator.collection_size
 
     # Ensure that we have results
-    addresses_count = paginator.collection_size
-    #print(addresses_count)
     if addresses_count == 0:
         if 'opa_only' in request.args and request.args['opa_only'].lower() != 'false':
             error = json_error(404, 'Could not find any opa addresses matching query.',
@@ -615,22 +810,26 @@ def block(query):
         #     return unmatched_response(query=query, parsed=parsed, normalized_address=normalized_address,
         #                               search_type=search_type)
 
-    # Validate the pagination
-    page_num, error = validate_page_param(request, paginator)
-    if error:
-        return json_response(response=error, status=404)
-
-    # Get tag data
-    all_tags = get_tag_data(addresses)
+    if 'cursor' not in request.args:
+        # Validate the pagination
+        page_num, error = validate_page_param(request, paginator)
+        if error:
+            return json_response(response=error, status=404)
+        block_page = paginator.get_page(page_num)
+        pagination = paginator.get_page_info(page_num)
 
-    # Serialize the response
-    block_page = paginator.get_page(page_num)
     serializer = AddressJsonSerializer(
         metadata={'search_type': search_type, 'query': query, 'normalized': normalized_address, 'search_params': request.args},
-        pagination=paginator.get_page_info(page_num),
-        srid=request.args.get('srid') if 'srid' in request.args else config['DEFAULT_API_SRID'], tag_data=all_tags,
+        pagination=pagination,
+        srid=request.args.get('srid') if 'srid' in request.args else config['DEFAULT_API_SRID'],
         normalized_address=normalized_address,
     )
+    if streamed:
+        return stream_address_response(serializer, block_page, ndjson=ndjson)
+
+    # Serialize the response, with tag data for just this page
+    block_page = list(block_page)
+    serializer.tag_data = get_tag_data(block_page)
     result = serializer.serialize_many(block_page)
     #result = serializer.serialize_many(block_page) if addresses_count > 1 else serializer.serialize(next(block_page))
     return json_response(response=result, status=200)
@@ -638,6 +837,7 @@ def block(query):
 
 @app.route('/owner/<query>')
 @cache_for(hours=1)
+@cache_response(normalize_raw)
 @swag_from('docs/owner.yml')
 def owner(query):
     query = query.strip('/')
@@ -647,17 +847,33 @@ def owner(query):
         error = json_error(404, 'Query too short, please be more descriptive.',
                            {'query': query})
         return json_response(response=error, status=404)
+
+    streamed, page_size, ndjson, error = get_stream_params(request)
+    if error:
+        return json_response(response=error, status=404)
+
     # Match a set of addresses
+    opa_only = 'opa_only' in request.args and request.args['opa_only'].lower() != 'false'
+    address_ids = find_owner_address_ids(query, opa_only=opa_only)
+    if not address_ids:
+        error = json_error(404, 'Could not find any addresses with owner matching query.',
+                           {'query': query})
+        return json_response(response=error, status=404)
+
     addresses = AddressSummary.query\
-        .filter_by_owner(*owner_parts) \
-        .exclude_non_opa('opa_only' in request.args and request.args['opa_only'].lower() != 'false') \
+        .filter(AddressSummary.id.in_(address_ids)) \
+        .exclude_non_opa(opa_only) \
         .get_address_geoms(request) \
-        .order_by_owner_address(query) \
-        .limit(OWNER_RESPONSE_LIMIT)
+        .order_by_owner_address(query)
         # .order_by_address()
+    # Bulk requests get every candidate the owner search ranked, which is
+    # already bounded by OWNER_SEARCH['max_candidates']
+    if not streamed:
+        addresses = addresses.limit(OWNER_RESPONSE_LIMIT)
 
     # Get pagination
-    paginator = QueryPaginator(addresses)
+    paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'), max_page_size=page_size,
+                                     stream_chunk_size=STREAM_CHUNK_SIZE if streamed else None)
 
     # Ensure that we have results
     addresses_count = paginator.collection_size
@@ -675,16 +891,17 @@ def owner(query):
 
     crs = {'type': 'link', 'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
 
-    # Get tag data
-    all_tags = get_tag_data(addresses)
-
-    # Serialize the response
-    page = paginator.get_page(page_num)
     serializer = AddressJsonSerializer(
         metadata={'search_type': 'owner', 'query': query, 'normalized': owner_parts, 'search_params': request.args, 'crs': crs},
         pagination=paginator.get_page_info(page_num),
-        srid=srid, tag_data=all_tags,
+        srid=srid,
     )
+    if streamed:
+        return stream_address_response(serializer, paginator.get_page(page_num), ndjson=ndjson)
+
+    # Serialize the response, with tag data for just this page
+    page = list(paginator.get_page(page_num))
+    serializer.tag_data = get_tag_data(page)
     result = serializer.serialize_many(page)
 
     return json_response(response=result, status=200)
@@ -692,14 +909,15 @@ def owner(query):
 
 @app.route('/account/<query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/account.yml')
-def account(query):
+def account(query, parsed=None):
     """
     Looks up information about the property with the given OPA account number.
     Returns all addresses with opa_account_num matching query.
     """
     query = query.strip('/')
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
     search_type = parsed['type']
     normalized = parsed['components']['output_address']
 
@@ -720,7 +938,7 @@ def account(query):
         .order_by(desc(AddressSummary.street_address.in_(street_addresses)))
 
     # Get pagination
-    paginator = QueryPaginator(addresses)
+    paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'))
 
     # Ensure that we have results
     addresses_count = paginator.collection_size
@@ -738,11 +956,9 @@ def account(query):
 
     crs = {'type': 'link', 'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
 
-    # Get tag data
-    all_tags = get_tag_data(addresses)
-
-    # Serialize the response
-    addresses_page = paginator.get_page(page_num)
+    # Serialize the response, with tag data for just this page
+    addresses_page = list(paginator.get_page(page_num))
+    all_tags = get_tag_data(addresses_page)
     serializer = AddressJsonSerializer(
         metadata={'search_type': search_type, 'query': query, 'normalized': normalized, 'search_params': request.args, 'crs': crs},
         pagination=paginator.get_page_info(page_num),
@@ -755,6 +971,7 @@ def account(query):
 
 @app.route('/pwd_parcel/<query>')
 @cache_for(hours=1)
+@cache_response(normalize_raw)
 @swag_from('docs/pwd_parcel.yml')
 def pwd_parcel(query):
     """
@@ -782,7 +999,7 @@ def pwd_parcel(query):
         .order_by(desc(AddressSummary.street_address.in_(street_addresses)))
 
     # Get pagination
-    paginator = QueryPaginator(addresses)
+    paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'))
 
     addresses_count = paginator.collection_size
 
@@ -800,11 +1017,9 @@ def pwd_parcel(query):
 
     crs = {'type': 'link', 'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
 
-    # Get tag data
-    all_tags = get_tag_data(addresses)
-
-    # Serialize the response
-    addresses_page = paginator.get_page(page_num)
+    # Serialize the response, with tag data for just this page
+    addresses_page = list(paginator.get_page(page_num))
+    all_tags = get_tag_data(addresses_page)
     serializer = AddressJsonSerializer(
         metadata={'search_type': search_type, 'query': query, 'normalized': query, 'search_params': request.args, 'crs': crs},
         pagination=paginator.get_page_info(page_num),
@@ -817,12 +1032,13 @@ def pwd_parcel(query):
 
 @app.route('/dor_parcel/<query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/mapreg.yml')
-def dor_parcel(query):
+def dor_parcel(query, parsed=None):
     """
     Looks up information about the property with the given DOR parcel id.
     """
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
     normalized_id = parsed['components']['output_address']
     search_type = parsed['type']
     if search_type != 'mapreg':
@@ -841,7 +1057,7 @@ def dor_parcel(query):
         .order_by(desc(AddressSummary.street_address.in_(street_addresses)))
 
     # Get pagination
-    paginator = QueryPaginator(addresses)
+    paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'))
 
     addresses_count = paginator.collection_size
     if addresses_count == 0:
@@ -858,11 +1074,9 @@ def dor_parcel(query):
 
     crs = {'type': 'link', 'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
 
-    #Get tag data
-    all_tags = get_tag_data(addresses)
-
-    # Serialize the response
-    addresses_page = paginator.get_page(page_num)
+    # Serialize the response, with tag data for just this page
+    addresses_page = list(paginator.get_page(page_num))
+    all_tags = get_tag_data(addresses_page)
     serializer = AddressJsonSerializer(
         metadata={'search_type': search_type, 'query': query, 'normalized': normalized_id, 'search_params': request.args, 'crs': crs},
         pagination=paginator.get_page_info(page_num),
@@ -875,13 +1089,14 @@ def dor_parcel(query):
 
 @app.route('/intersection/<path:query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/intersection.yml')
-def intersection(query):
+def intersection(query, parsed=None):
     '''
     Called by search endpoint if search_type == "intersection_addr"
     '''
     query = query.strip('/')
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
     search_type = 'intersection' if parsed['type'] == 'intersection_addr' else parsed['type']
 
     if search_type != 'intersection':
@@ -958,7 +1173,7 @@ def intersection(query):
     intersections = intersections.distinct(StreetIntersection.street_1_full, StreetIntersection.street_2_full)
 
     # Get pagination
-    paginator = QueryPaginator(intersections)
+    paginator = WindowQueryPaginator(intersections, page=request.args.get('page', '1'))
 
     intersections_count = paginator.collection_size
 
@@ -994,11 +1209,12 @@ def intersection(query):
 
 @app.route('/reverse_geocode/<path:query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/reverse_geocode.yml')
-def reverse_geocode(query):
+def reverse_geocode(query, parsed=None):
 
     query = query.strip('/')
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
     search_type_out = 'coordinates'
     search_type = parsed['type']
     normalized = parsed['components']['output_address']
@@ -1009,82 +1225,57 @@ def reverse_geocode(query):
         error = json_error(404, 'Please format your query in State Plane or latitude longitude coordinates separated by a space or comma.',
                            {'search_type': search_type, 'query': query, 'normalized': normalized})
         return json_response(response=error, status=404)
-    engine_srid = str(ENGINE_SRID)  # check if necessary
     crs = {'type': 'link',
            'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
     x, y = normalized.split(",", 1)
     search_radius = request.args.get('search_radius') if 'search_radius' in request.args else config['DEFAULT_SEARCH_RADIUS']
     search_radius = min(int(search_radius), config['MAXIMUM_SEARCH_RADIUS'])
-    # queries the geocode table by coordinates for the record with the nearest coordinates having \
-    # geocode type = pwd_curb, dor_curb, true_range or centerline
-    reverse_geocode_stmt = '''
-        SELECT street_address, geocode_type
-        from geocode
-        where ST_DWITHIN(geom, ST_Transform(ST_GeometryFromText('POINT({x} {y})',{srid}),{engine_srid}), {search_radius})
-          AND geocode_type IN ({pwd_curb}, {dor_curb}, {true_range})
-        ORDER BY
-            geom <-> ST_Transform(ST_GeometryFromText('POINT({x} {y})',{srid}),{engine_srid}),
-            length(street_address) asc
-        LIMIT 1
-        '''.format(x=x, y=y, srid=srid, engine_srid=engine_srid, pwd_curb=7, dor_curb=8, true_range=5, centerline=6,
-                   search_radius=search_radius)
-
-    results = db.engine.execute(reverse_geocode_stmt)
-    result = None
-    for result in results:
-        street_address, geocode_type = result
-        break
-
-    if not result:
+    limit = request.args.get('limit', '1')
+    try:
+        limit = int(limit)
+        if not 1 <= limit <= REVERSE_GEOCODE_MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        error = json_error(404, 'Invalid limit.', {'limit': limit, 'max_limit': REVERSE_GEOCODE_MAX_LIMIT})
+        return json_response(response=error, status=404)
+
+    # Find the addresses with the nearest pwd_curb, dor_curb or true_range
+    # geocodes
+    nearest = reverse_geocode_index.get_nearest_addresses(float(x), float(y), int(srid), search_radius, limit)
+    if not nearest:
         error = json_error(404, 'Could not find any addresses matching query.',
                            {'query': query, 'normalized': normalized, 'search_type': search_type})
         return json_response(response=error, status=404)
 
-    parsed = PassyunkParser().parse(street_address)
-    normalized_address = parsed['components']['output_address']
-    unit_type = parsed['components']['address_unit']['unit_type']
-    unit_num = parsed['components']['address_unit']['unit_num']
-    high_num = parsed['components']['address']['high_num_full']
-    low_num = parsed['components']['address']['low_num']
-    base_address = parsed['components']['base_address']
-
-    loose_filters = NotNoneDict(
-        street_name=parsed['components']['street']['name'],
-        address_low=low_num if low_num is not None
-        else parsed['components']['address']['full'],
-        address_low_suffix=parsed['components']['address']['addr_suffix'],
-        address_low_frac=parsed['components']['address']['fractional'],
-        street_predir=parsed['components']['street']['predir'],
-        street_postdir=parsed['components']['street']['postdir'],
-        street_suffix=parsed['components']['street']['suffix'],
-    )
-    strict_filters = dict(
-        address_high=high_num,
-        unit_num=unit_num or '',
-    )
-    # if unit num is null, add unit_type to strict filter
-    if unit_num == '':
-        strict_filters.update(dict(unit_type=unit_type or '', ))
+    street_addresses = [address.street_address for address in nearest]
+    # Each address is located by the geocode found nearest. Units of the
+    # addresses (with include_units) are located like the nearest address.
+    geocode_type = nearest[0].geocode_type
+    if len(nearest) > 1:
+        geocode_type = case(OrderedDict((address.street_address, address.geocode_type) for address in nearest),
+                            value=AddressSummary.street_address, else_=geocode_type)
 
-    filters = strict_filters.copy()
-    filters.update(loose_filters)
     addresses = AddressSummary.query \
-        .filter_by(**filters) \
-        .filter_by_unit_type(unit_type) \
+        .filter(AddressSummary.street_address.in_(street_addresses)) \
         .include_child_units(
         'include_units' in request.args and request.args['include_units'].lower() != 'false',
-        is_range=high_num is not None,
-        is_unit=unit_type is not None,
+        is_range=all(address.is_range for address in nearest),
+        is_unit=all(address.is_unit for address in nearest),
         request=request) \
         .outerjoin(Geocode, Geocode.street_address == AddressSummary.street_address)\
         .filter(Geocode.geocode_type == geocode_type) \
         .add_columns(Geocode.geocode_type, ST_Transform(Geocode.geom, srid)) \
         .exclude_non_opa('opa_only' in request.args and request.args['opa_only'].lower() != 'false')
 
+    if len(nearest) > 1:
+        # Nearest first, followed by any units
+        nearness = case(OrderedDict((street_address, rank) for rank, street_address in enumerate(street_addresses)),
+                        value=AddressSummary.street_address, else_=len(street_addresses))
+        addresses = addresses.order_by(nearness)
     addresses = addresses.order_by_address()
 
     # Get pagination
-    paginator = QueryPaginator(addresses)
+    paginator = WindowQueryPaginator(addresses, page=request.args.get('page', '1'))
     # Ensure that we have results
     addresses_count = paginator.collection_size
     # Handle unmatched addresses
@@ -1093,24 +1284,21 @@ def reverse_geocode(query):
                            {'search_type': search_type, 'query': query, 'normalized': normalized})
         return json_response(response=error, status=404)
 
-    #Get tag data
-    all_tags=get_tag_data(addresses)
-
     # Validate the pagination
     page_num, error = validate_page_param(request, paginator)
     if error:
         return json_response(response=error, status=404)
 
     match_type = 'nearest'
-    # Serialize the response
-    addresses_page = paginator.get_page(page_num)
+    # Serialize the response, with tag data for just this page
+    addresses_page = list(paginator.get_page(page_num))
+    all_tags = get_tag_data(addresses_page)
     serializer = AddressJsonSerializer(
         metadata={'search_type': search_type_out, 'query': query, 'normalized': normalized,
                   'search_params': request.args, 'crs': crs},
         pagination=paginator.get_page_info(page_num),
         srid=srid,
-        normalized_address=normalized_address,
-        base_address=base_address,
+        normalized_address=street_addresses[0],
         match_type=match_type, tag_data=all_tags,
     )
     result = serializer.serialize_many(addresses_page)
@@ -1120,11 +1308,12 @@ def reverse_geocode(query):
 
 @app.route('/service_areas/<path:query>')
 @cache_for(hours=1)
+@cache_response(normalize_parsed)
 @swag_from('docs/service_areas.yml')
-def service_areas(query):
+def service_areas(query, parsed=None):
 
     query = query.strip('/')
-    parsed = PassyunkParser().parse(query)
+    parsed = parser.parse(query) if parsed is None else parsed
     search_type = parsed['type']
 
     if search_type == 'none':
@@ -1140,37 +1329,13 @@ def service_areas(query):
         error = json_error(404, 'Not a valid service_area query.',
                            {'query': query, 'search_type': search_type})
         return json_response(response=error, status=404)
-    engine_srid = str(ENGINE_SRID)
     crs = {'type': 'link',
            'properties': {'type': 'proj4', 'href': 'http://spatialreference.org/ref/epsg/{}/proj4/'.format(srid)}}
     x, y = normalized.split(",", 1)
     coords = [float(x), float(y)]
-    sa_data = OrderedDict()
     search_type_out = 'coordinates'
 
-    sa_stmt = '''
-    with foo as
-    (
-    SELECT layer_id, value
-    from service_area_polygon
-    where ST_Intersects(geom, ST_Transform(ST_GeometryFromText('POINT({x} {y})',{srid}),{engine_srid}))
-     )
-    SELECT DISTINCT ON (cols.layer_id) cols.layer_id, foo.value
-    from service_area_layer cols
-    left join foo on foo.layer_id = cols.layer_id
-    union
-    (
-    select 'nearest_seg'::text as layer_id, cast(ss.seg_id as text) as value
-    from street_segment ss
-    order by st_distance(ST_Transform(ST_GeometryFromText('POINT({x} {y})',{srid}),{engine_srid}),ss.geom) asc
-    limit 1
-    )
-    order by layer_id 
-    '''.format(srid=srid, engine_srid=engine_srid,x=x, y=y)
-
-    result = db.engine.execute(sa_stmt)
-    for item in result.fetchall():
-        sa_data[item[0]] = item[1]
+    sa_data = segment_index.get_point_service_areas(coords[0], coords[1], int(srid))
 
     if all(value == None for value in sa_data.values()):
         error = json_error(404, 'There are no intersecting service areas.',
@@ -1195,6 +1360,20 @@ def street(query):
                        {'query': query})
     return json_response(response=error, status=404)
 
+_parser_cache_logged = time.time()
+
+@app.after_request
+def log_parser_cache_info(response):
+    """Log the shared parser's cache hits and misses every so often, for sizing it."""
+    global _parser_cache_logged
+    interval = config['PARSER_CACHE_LOG_INTERVAL']
+    now = time.time()
+    if interval and now - _parser_cache_logged >= interval:
+        _parser_cache_logged = now
+        app.logger.warning('Parser cache: {}'.format(
+            ', '.join('{}={}'.format(key, value) for key, value in parser.cache_info().items())))
+    return response
+
 # from flask_sqlalchemy import get_debug_queries
 # @app.after_request
 # def after_request(response):
@@ -1240,20 +1419,19 @@ def search(query):
         'street': addresses,
     }
     try:
-        parsed = PassyunkParser().parse(query)
+        parsed = parser.parse(query)
     except:
         error = json_error(404, 'Could not parse query.',
                            {'query': query})
         return json_response(response=error, status=404)
     search_type = parsed['type']
     normalized_address = parsed['components']['output_address']
-    # TODO: Pass search_type (or parsed) to view function to avoid reparsing
     if search_type != 'none':
         # get the corresponding view function
         try:
             view = parser_search_type_map[search_type]
-            # call it
-            return view(query)
+            # call it, handing over the parse result so it isn't repeated
+            return view(query, parsed=parsed)
         except:
             error = json_error(404, 'Invalid query.',
                                {'query': query, 'normalized': normalized_address,'search_type': search_type})
@@ -0,0 +1,70 @@
+"""
+Time interpolating and offsetting every address on a street segment, as
+geocode_addresses does for centerline and true range geocodes, one address at
+a time with util.interpolate_buffered and util.offset and then in bulk with
+SegmentArrays, and report the largest difference between the two.
+
+Run against a built engine database.
+
+Usage: python benchmark_centerline.py
+"""
+import time
+import datum
+import numpy as np
+from shapely.wkt import loads
+from ais import app, util
+from ais.engine.centerline import SegmentArrays
+
+config = app.config
+centerline_offset = config['GEOCODE']['centerline_offset']
+centerline_end_buffer = config['GEOCODE']['centerline_end_buffer']
+
+db = datum.connect(config['DATABASES']['engine'])
+print('Reading streets, true ranges and address-streets...')
+seg_rows = db['street_segment'].read(fields=['seg_id'], geom_field='geom')
+seg_shapes = {row['seg_id']: loads(row['geom']) for row in seg_rows}
+true_ranges = {row['seg_id']: row for row in db['true_range'].read()}
+addresses = db.execute('''
+    select a.address_low, a.address_high, s.seg_id, s.seg_side
+    from address a
+    join address_street s on s.street_address = a.street_address
+    where s.seg_id is not null
+''')
+db.close()
+
+seg_ids = []
+seg_sides = []
+distance_ratios = []
+for address in addresses:
+    address_num = address['address_low']
+    if address['address_high']:
+        address_num += (address['address_high'] - address['address_low']) / 2
+    true_range = true_ranges[address['seg_id']]
+    side = 'left' if address['seg_side'] == 'L' else 'right'
+    low, high = true_range['true_{}_from'.format(side)], true_range['true_{}_to'.format(side)]
+    seg_ids.append(address['seg_id'])
+    seg_sides.append(address['seg_side'])
+    distance_ratios.append(0.5 if high - low == 0 else (address_num - low) / (high - low))
+
+print('Interpolating {} addresses one at a time...'.format(len(seg_ids)))
+start = time.perf_counter()
+expected = []
+for seg_id, seg_side, distance_ratio in zip(seg_ids, seg_sides, distance_ratios):
+    seg_shp = seg_shapes[seg_id]
+    xsect_xy = util.interpolate_buffered(seg_shp, distance_ratio, centerline_end_buffer)
+    xy = util.offset(seg_shp, xsect_xy, centerline_offset, seg_side)
+    expected.append((xy.x, xy.y))
+print('  {:.2f}s'.format(time.perf_counter() - start))
+
+print('Interpolating {} addresses in bulk...'.format(len(seg_ids)))
+start = time.perf_counter()
+seg_arrays = SegmentArrays(seg_shapes)
+print('  {:.2f}s flattening segments'.format(time.perf_counter() - start))
+start = time.perf_counter()
+positions = seg_arrays.get_positions(seg_ids)
+xsect_xs, xsect_ys = seg_arrays.interpolate_buffered(positions, distance_ratios, centerline_end_buffer)
+xs, ys = seg_arrays.offset(positions, xsect_xs, xsect_ys, centerline_offset, seg_sides)
+print('  {:.2f}s interpolating'.format(time.perf_counter() - start))
+
+differences = np.abs(np.array(expected).reshape(-1, 2) - np.column_stack((xs, ys)))
+print('Largest difference: {} ft'.format(differences.max() if len(differences) else 0))
@@ -0,0 +1,55 @@
+"""
+Compare intersecting a sample of addresses with the service area polygons one
+address at a time, as make_service_area_summary used to, with the one-shot
+join it uses now, check that they agree and project both to every address.
+
+Run against a built engine database.
+
+Usage: python benchmark_service_area_join.py [number of addresses]
+"""
+import sys
+import time
+import datum
+from ais import app
+from ais.engine import service_areas
+
+config = app.config
+num_addresses = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+sa_layer_ids = [x['layer_id'] for x in config['SERVICE_AREAS']['layers']]
+
+db = datum.connect(config['DATABASES']['engine'])
+total_addresses = db.execute('select count(*) as count from address_summary')[0]['count']
+sample = db.execute('''
+    select street_address, geocode_x, geocode_y
+    from address_summary
+    order by random()
+    limit {}
+'''.format(num_addresses))
+sample_where = "street_address in ({})".format(
+    ', '.join("'{}'".format(row['street_address'].replace("'", "''")) for row in sample))
+
+print('Intersecting {} addresses one at a time...'.format(len(sample)))
+poly_table = db['service_area_polygon']
+start = time.perf_counter()
+expected = {}
+for row in sample:
+    where = 'ST_Intersects(geom, ST_SetSrid(ST_Point({}, {}), 2272))'.format(row['geocode_x'], row['geocode_y'])
+    sa_rows = poly_table.read(fields=['layer_id', 'value'], where=where, sort=['id'], return_geom=False)
+    expected[row['street_address']] = ([x['layer_id'] for x in sa_rows], [x['value'] for x in sa_rows])
+one_at_a_time_seconds = time.perf_counter() - start
+db.close()
+
+print('Intersecting {} addresses in one join...'.format(len(sample)))
+conn = service_areas.connect(config['DATABASES']['engine'])
+cursor = conn.cursor()
+start = time.perf_counter()
+cursor.execute(service_areas.POLYGON_JOIN_SQL.format(where='WHERE ads.' + sample_where))
+joined = {street_address: (layer_ids or [], values or []) for street_address, layer_ids, values in cursor}
+join_seconds = time.perf_counter() - start
+conn.close()
+
+mismatches = [street_address for street_address in expected if joined.get(street_address) != expected[street_address]]
+print('Mismatched addresses: {}'.format(len(mismatches)))
+for label, seconds in (('One at a time', one_at_a_time_seconds), ('Join', join_seconds)):
+    print('{}: {:.2f}s, projected {:.0f}s for {} addresses'.format(
+        label, seconds, seconds * total_addresses / max(len(sample), 1), total_addresses))
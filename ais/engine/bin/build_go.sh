@@ -25,6 +25,12 @@ out_file_loc=../log/$out_file$datestamp.txt
 echo "Building the engine."
 send_slack "Starting new engine build."
 bash build_engine.sh > >(tee -a $out_file_loc) 2> >(tee -a $error_file_loc >&2)
+if [ $? -ne 0 ]
+then
+  echo "Engine build failed"
+  send_slack "Engine build has failed."
+  exit 1;
+fi
 send_slack "Engine build has completed."
 end_dt=$(date +%Y%m%d%T)
 echo "Time Summary: "
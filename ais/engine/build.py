@@ -0,0 +1,156 @@
+"""
+Run an engine build: each stage (an engine script) in its own process, starting
+it as soon as the stages it depends on have finished, with up to `workers`
+stages running at a time. Once a stage fails no more are started.
+
+Each stage's output goes to <log_dir>/<stage>.log. Whether each stage
+succeeded, how long it took and the row counts of the tables it writes are
+recorded in <log_dir>/build.json as the build goes, so that a failed build can
+be resumed without rerunning the stages that succeeded.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ais import app
+
+config = app.config
+
+
+class BuildError (Exception):
+    pass
+
+
+def path_for_script(root_path, script):
+    return os.path.join(root_path, 'engine', 'scripts', script + '.py')
+
+
+def order_stages(stages):
+    """
+    Get the names of the stages in an order that runs each after the stages it
+    depends on, otherwise keeping the order they're configured in.
+    """
+    for name, stage in stages.items():
+        for dependency in stage['depends_on']:
+            if dependency not in stages:
+                raise BuildError('{} depends on unknown stage {}'.format(name, dependency))
+
+    ordered = []
+    remaining = list(stages)
+    while remaining:
+        ready = [name for name in remaining
+                 if all(dependency in ordered for dependency in stages[name]['depends_on'])]
+        if not ready:
+            raise BuildError('Stages depend on each other: {}'.format(', '.join(remaining)))
+        ordered.append(ready[0])
+        remaining.remove(ready[0])
+    return ordered
+
+
+def run_script(path, log_path):
+    """Run an engine script, writing its output to a log. Returns its exit code and wall time."""
+    start = time.time()
+    with open(log_path, 'w') as log:
+        returncode = subprocess.call([sys.executable, '-u', path], stdout=log, stderr=subprocess.STDOUT,
+                                     env=os.environ.copy())
+    return returncode, time.time() - start
+
+
+class Build:
+    def __init__(self, stages, workers=1, log_dir='.', resume=False):
+        self.stages = stages
+        self.order = order_stages(stages)
+        self.workers = max(workers, 1)
+        self.log_dir = log_dir
+        self.state_path = os.path.join(log_dir, 'build.json')
+        # Stage name => {'status', 'seconds', 'row_counts'}, and 'row_count_error'
+        # if the row counts couldn't be taken
+        self.results = OrderedDict()
+
+        for name in self.order:
+            path = path_for_script(app.root_path, name)
+            if not os.path.isfile(path):
+                raise FileNotFoundError('Script not found: {}'.format(name))
+
+        if resume and os.path.isfile(self.state_path):
+            with open(self.state_path) as f:
+                previous = json.load(f, object_pairs_hook=OrderedDict)
+            self.results.update((name, result) for name, result in previous.items()
+                                if name in stages and result['status'] == 'succeeded')
+
+    def save(self):
+        with open(self.state_path, 'w') as f:
+            json.dump(self.results, f, indent=2)
+
+    def count_rows(self, name):
+        # Imported here so that loading the CLI doesn't need datum
+        import datum
+        db = datum.connect(config['DATABASES']['engine'])
+        row_counts = OrderedDict()
+        for table in self.stages[name]['tables']:
+            rows = db.execute('select count(*) as count from {}'.format(table))
+            row_counts[table] = rows[0]['count']
+        db.close()
+        return row_counts
+
+    def run(self):
+        """Run the stages that haven't succeeded. Returns whether they all did."""
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        succeeded = set(name for name, result in self.results.items() if result['status'] == 'succeeded')
+        for name in self.order:
+            if name in succeeded:
+                print('Skipping {} (succeeded in the last build)'.format(name))
+        pending = [name for name in self.order if name not in succeeded]
+        self.results = OrderedDict((name, result) for name, result in self.results.items() if name in succeeded)
+        self.save()
+
+        failed = False
+        running = {}  # future => stage name
+        with ThreadPoolExecutor(self.workers) as executor:
+            while True:
+                # Start whatever can run
+                for name in list(pending):
+                    if failed or len(running) >= self.workers:
+                        break
+                    if all(dependency in succeeded for dependency in self.stages[name]['depends_on']):
+                        print('Starting {}...'.format(name))
+                        pending.remove(name)
+                        path = path_for_script(app.root_path, name)
+                        log_path = os.path.join(self.log_dir, name + '.log')
+                        running[executor.submit(run_script, path, log_path)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    returncode, seconds = future.result()
+                    if returncode == 0:
+                        succeeded.add(name)
+                        self.results[name] = OrderedDict([('status', 'succeeded'), ('seconds', round(seconds, 1))])
+                        # The stage succeeded even if its tables can't be counted
+                        try:
+                            row_counts = self.count_rows(name)
+                        except Exception as e:
+                            self.results[name]['row_counts'] = None
+                            self.results[name]['row_count_error'] = str(e)
+                            print('Finished {} in {:.1f}s (could not count rows: {})'.format(name, seconds, e))
+                        else:
+                            self.results[name]['row_counts'] = row_counts
+                            print('Finished {} in {:.1f}s ({})'.format(
+                                name, seconds, ', '.join('{}: {} rows'.format(*item) for item in row_counts.items())))
+                    else:
+                        failed = True
+                        self.results[name] = OrderedDict([
+                            ('status', 'failed'), ('seconds', round(seconds, 1)), ('row_counts', None)])
+                        print('{} failed with exit code {} after {:.1f}s; see {}'.format(
+                            name, returncode, seconds, os.path.join(self.log_dir, name + '.log')))
+                self.save()
+
+        for name in pending:
+            print('Not run: {}'.format(name))
+        return not failed and not pending
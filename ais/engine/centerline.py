@@ -0,0 +1,123 @@
+"""
+Batched versions of util.interpolate_buffered and util.offset, for placing
+many addresses along street centerlines at once.
+
+The vertices of every segment are flattened into one array, with each
+segment's start position and cumulative vertex distances alongside, so that
+points on any number of segments can be interpolated and offset with numpy.
+Results match the per-point functions (which use GEOS and Python math) to
+within floating-point rounding, including their edge cases: distances below
+zero are measured back from the end of the line and then clamped to it, and
+the offset direction is taken from the first part of the line that brackets
+the point, or the last part if none does.
+"""
+import numpy as np
+
+
+class SegmentArrays:
+    def __init__(self, seg_shapes):
+        """seg_shapes is seg ID => LineString."""
+        self.positions = {}  # seg ID => position in the arrays below
+        coords = []
+        starts = []
+        counts = []
+        for seg_id, shape in seg_shapes.items():
+            seg_coords = [coord[:2] for coord in shape.coords]
+            self.positions[seg_id] = len(starts)
+            starts.append(len(coords))
+            counts.append(len(seg_coords))
+            coords.extend(seg_coords)
+
+        self.coords = np.array(coords, dtype=np.float64).reshape(-1, 2)
+        self.starts = np.array(starts, dtype=np.intp)
+        self.counts = np.array(counts, dtype=np.intp)
+
+        # Distance along its segment to each vertex, summed in order like GEOS
+        deltas = np.diff(self.coords, axis=0)
+        part_lengths = np.sqrt(deltas[:, 0] * deltas[:, 0] + deltas[:, 1] * deltas[:, 1])
+        self.distances = np.zeros(len(self.coords))
+        for start, count in zip(self.starts, self.counts):
+            self.distances[start + 1:start + count] = np.cumsum(part_lengths[start:start + count - 1])
+        self.lengths = self.distances[self.starts + self.counts - 1] if len(self.starts) else np.zeros(0)
+
+    def get_positions(self, seg_ids):
+        return np.array([self.positions[seg_id] for seg_id in seg_ids], dtype=np.intp)
+
+    @staticmethod
+    def _expand(starts, num_vertices):
+        """
+        Pair each point with each of `num_vertices` vertices of its segment,
+        beginning at `starts`. Returns the point and the vertex of each pair.
+        """
+        num_pairs = num_vertices.sum()
+        point_offsets = np.cumsum(num_vertices) - num_vertices
+        pair_points = np.repeat(np.arange(len(starts)), num_vertices)
+        pair_vertices = np.repeat(starts - point_offsets, num_vertices) + np.arange(num_pairs)
+        return pair_points, pair_vertices
+
+    def interpolate_buffered(self, positions, distance_ratios, _buffer):
+        """
+        Get the XYs at distance ratios along the segments at `positions`,
+        leaving a buffer at both ends.
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        # Older numpy rejects bincount's minlength=0
+        if not len(positions):
+            return np.zeros(0), np.zeros(0)
+        lengths = self.lengths[positions]
+        distances = _buffer + np.asarray(distance_ratios, dtype=np.float64) * (lengths - _buffer * 2)
+        distances = np.where(distances < 0, lengths + distances, distances)
+        distances = np.clip(distances, 0, lengths)
+
+        # The part each distance falls in starts at the last vertex at or
+        # before it, other than the segment's last vertex
+        starts = self.starts[positions]
+        pair_points, pair_vertices = self._expand(starts + 1, self.counts[positions] - 2)
+        passed = self.distances[pair_vertices] <= distances[pair_points]
+        parts = starts + np.bincount(pair_points[passed], minlength=len(positions))
+
+        part_lengths = self.distances[parts + 1] - self.distances[parts]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions = np.where(part_lengths > 0, (distances - self.distances[parts]) / part_lengths, 1.0)
+        # At or past the end of the line
+        fractions = np.where(distances >= lengths, 1.0, fractions)
+        part_starts = self.coords[parts]
+        xys = part_starts + fractions[:, np.newaxis] * (self.coords[parts + 1] - part_starts)
+        return xys[:, 0], xys[:, 1]
+
+    def offset(self, positions, xs, ys, distance, seg_sides):
+        """
+        Offset XYs on the segments at `positions` by a distance to the left or
+        right side ('L' or 'R') of each.
+        """
+        positions = np.asarray(positions, dtype=np.intp)
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        left = np.asarray(seg_sides) == 'L'
+        starts = self.starts[positions]
+        num_parts = self.counts[positions] - 1
+
+        # Take the direction of the first part bracketing each point, or of the
+        # last part
+        pair_points, pair_vertices = self._expand(starts, num_parts)
+        x_0, y_0 = self.coords[pair_vertices, 0], self.coords[pair_vertices, 1]
+        x_1, y_1 = self.coords[pair_vertices + 1, 0], self.coords[pair_vertices + 1, 1]
+        pair_xs, pair_ys = xs[pair_points], ys[pair_points]
+        brackets = ((x_0 < pair_xs) & (pair_xs < x_1)) | ((y_0 <= pair_ys) & (pair_ys <= y_1))
+        parts = starts + num_parts - 1
+        bracketed_points, first_brackets = np.unique(pair_points[brackets], return_index=True)
+        parts[bracketed_points] = pair_vertices[brackets][first_brackets]
+
+        part_deltas = self.coords[parts + 1] - self.coords[parts]
+        seg_angles = np.arctan2(part_deltas[:, 1], part_deltas[:, 0])
+        offset_angles = np.where(left, seg_angles + np.pi / 2, seg_angles - np.pi / 2)
+        offset_xs = xs + np.cos(offset_angles) * distance
+        offset_ys = ys + np.sin(offset_angles) * distance
+
+        # Segments starting vertically are offset horizontally
+        first_deltas = self.coords[starts + 1] - self.coords[starts]
+        vertical = first_deltas[:, 0] == 0
+        x_factors = np.where((first_deltas[:, 1] > 0) != left, 1, -1)
+        offset_xs = np.where(vertical, xs + distance * x_factors, offset_xs)
+        offset_ys = np.where(vertical, ys, offset_ys)
+        return offset_xs, offset_ys
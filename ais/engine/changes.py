@@ -0,0 +1,167 @@
+"""
+Change capture for incremental engine builds.
+
+load_addresses stores a fingerprint of each source row it reads with the
+row's source address. Comparing those with the previous build's gives the
+street addresses whose source rows were added, removed or changed. Along with
+the addresses on the same street segment sides (whose true ranges they feed)
+and every address linked to those, however indirectly, these are written to
+the address_change table, and the later stages only rebuild those addresses.
+Since tags and geocodes are only passed along links, the addresses outside the
+change set keep what they had.
+
+The state of the build is kept in engine_state. A build is full rather than
+incremental when:
+
+- ENGINE_BUILD['full_rebuild'] is set (`ais engine run all --full`),
+- the last build didn't get as far as make_service_area_summary,
+- a table that addresses are matched against (streets, parcels, curbs) has
+  changed since the last build, going by a fingerprint of its contents, or
+- the parser's version (see util.get_parser_version) has changed, or can't be
+  told. A parser data refresh can change the seg IDs and street codes parsed
+  for addresses without changing their street addresses or source rows.
+
+Stages that go full part way through a build mark it full, so that the stages
+after them do too.
+"""
+import hashlib
+import json
+
+CHANGED_ADDRESSES_TABLE = 'address_change'
+# For filtering a stage's reads to the changed addresses
+CHANGED_ADDRESSES_SQL = 'select street_address from {}'.format(CHANGED_ADDRESSES_TABLE)
+
+# engine_state key for what the current build is doing: 'incremental' or
+# 'full' while it runs, and 'applied' once it has finished
+CHANGE_SET_KEY = 'change_set'
+TABLE_FINGERPRINT_KEY = 'fingerprint:{}'
+PARSER_VERSION_KEY = 'parser_version'
+
+TABLE_FINGERPRINT_SQL = '''
+    select md5(coalesce(string_agg(row_hash, '' order by row_hash), '')) as fingerprint
+    from (
+        select md5((to_jsonb(t) - 'id')::text) as row_hash
+        from {table} t
+    ) row_hashes
+'''
+
+
+def row_fingerprint(row):
+    """Fingerprint a source row (a mapping of field values)."""
+    text = json.dumps(dict(row), sort_keys=True, default=str)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def source_address_key(row):
+    """What has to match for a source address row to be unchanged."""
+    return row['source_name'], row['source_address'], row['street_address'], row['fingerprint']
+
+
+def get_state(db):
+    return {row['key']: row['value'] for row in db.execute('select key, value from engine_state')}
+
+
+def set_state(db, key, value):
+    # Keys and values are all ours (table names, fingerprints and statuses)
+    db.execute("delete from engine_state where key = '{}'".format(key))
+    db.save()
+    db['engine_state'].write([{'key': key, 'value': value}])
+
+
+def is_incremental(db):
+    return get_state(db).get(CHANGE_SET_KEY) == 'incremental'
+
+
+def mark_full(db):
+    set_state(db, CHANGE_SET_KEY, 'full')
+
+
+def mark_applied(db):
+    set_state(db, CHANGE_SET_KEY, 'applied')
+
+
+def changed_tables(db, tables):
+    """
+    Get which of the tables have changed since they were last checked, and
+    record their current fingerprints. Row IDs are left out of the comparison,
+    since reloading a table renumbers them.
+    """
+    state = get_state(db)
+    changed = []
+    for table in tables:
+        fingerprint = db.execute(TABLE_FINGERPRINT_SQL.format(table=table))[0]['fingerprint']
+        key = TABLE_FINGERPRINT_KEY.format(table)
+        if state.get(key) != fingerprint:
+            changed.append(table)
+            set_state(db, key, fingerprint)
+    return changed
+
+
+def start_build(db, full_rebuild, tables, parser_version):
+    """
+    Decide whether a build can be incremental, checking the tables addresses
+    are matched against and the parser version, and record it. Returns why the
+    build has to be full, or None if it doesn't.
+    """
+    state = get_state(db)
+    previous = state.get(CHANGE_SET_KEY)
+    previous_parser_version = state.get(PARSER_VERSION_KEY)
+    changed = changed_tables(db, tables)
+    if parser_version is not None:
+        set_state(db, PARSER_VERSION_KEY, parser_version)
+    if full_rebuild:
+        reason = 'a full rebuild was requested'
+    elif previous is None:
+        reason = 'there is no previous build'
+    elif previous != 'applied':
+        reason = "the last build didn't finish"
+    elif changed:
+        reason = '{} changed'.format(', '.join(changed))
+    elif parser_version is None:
+        reason = "the parser's version can't be told"
+    elif parser_version != previous_parser_version:
+        reason = 'the parser changed'
+    else:
+        reason = None
+    set_state(db, CHANGE_SET_KEY, 'full' if reason else 'incremental')
+    return reason
+
+
+def expand_links(street_addresses, neighbour_map):
+    """
+    Add the addresses linked to any of the street addresses, directly or
+    through other links. neighbour_map is street address => linked addresses,
+    both ways.
+    """
+    expanded = set(street_addresses)
+    pending = list(expanded)
+    while pending:
+        street_address = pending.pop()
+        for neighbour in neighbour_map.get(street_address, ()):
+            if neighbour not in expanded:
+                expanded.add(neighbour)
+                pending.append(neighbour)
+    return expanded
+
+
+def expand_seg_sides(street_addresses, address_street_rows):
+    """
+    Add the addresses on the same street segment sides as any of the street
+    addresses, whose true ranges (and so true range geocodes) they may change.
+    """
+    address_street_rows = list(address_street_rows)
+    seg_sides = set((row['seg_id'], row['seg_side']) for row in address_street_rows
+                    if row['street_address'] in street_addresses)
+    expanded = set(street_addresses)
+    expanded.update(row['street_address'] for row in address_street_rows
+                    if (row['seg_id'], row['seg_side']) in seg_sides)
+    return expanded
+
+
+def write_changed_addresses(db, street_addresses):
+    """Replace the address_change table with the given street addresses."""
+    db.drop_table(CHANGED_ADDRESSES_TABLE)
+    db.create_table(CHANGED_ADDRESSES_TABLE, [{'name': 'street_address', 'type': 'text'}])
+    table = db[CHANGED_ADDRESSES_TABLE]
+    table.write([{'street_address': x} for x in sorted(street_addresses)], chunk_size=150000)
+    table.create_index('street_address')
@@ -0,0 +1,52 @@
+"""
+Index of address ranges for finding the ranges that contain a house number,
+without looping over every range on the street.
+
+Ranges are grouped under a key (for load_addresses, street and parity). The
+low and high ends of a key's ranges split the numbers into elementary
+intervals. For each of these the index keeps the ranges covering it, sorted
+and searched by bisection. Ranges come back in the order they were added, so
+code that took the first matching range from a list still gets the same one.
+"""
+import time
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex:
+    def __init__(self):
+        self._ranges = {}  # key => [(low, high, item)]
+        # key => (sorted boundaries, [items covering each elementary interval])
+        self._index = {}
+        self.lookups = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+    def add(self, key, low, high, item):
+        """Add an item for the numbers low to high, inclusive."""
+        self._ranges.setdefault(key, []).append((low, high, item))
+        self._index.pop(key, None)
+
+    def _build(self, key):
+        ranges = self._ranges.get(key, [])
+        boundaries = sorted(set([low for low, high, item in ranges] +
+                                [high + 1 for low, high, item in ranges]))
+        covering = [[] for _ in boundaries]
+        for low, high, item in ranges:
+            for i in range(bisect_left(boundaries, low), bisect_left(boundaries, high + 1)):
+                covering[i].append(item)
+        self._index[key] = boundaries, covering
+        return self._index[key]
+
+    def find(self, key, number):
+        """Get the items whose ranges under `key` contain a number, in the order they were added."""
+        start = time.perf_counter()
+        boundaries, covering = self._index.get(key) or self._build(key)
+        i = bisect_right(boundaries, number) - 1
+        items = covering[i] if i >= 0 else []
+        self.lookups += 1
+        self.matches += len(items)
+        self.seconds += time.perf_counter() - start
+        return items
+
+    def report(self):
+        return '{} lookups found {} ranges in {:.2f}s'.format(self.lookups, self.matches, self.seconds)
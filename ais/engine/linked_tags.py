@@ -0,0 +1,173 @@
+"""
+Linked tags: values an address takes for a tag key it has no tag for from
+the addresses it's linked to in address_link.
+
+LinkedTagGraph holds the tags by (street address, key) and the links as a
+graph. Tags are found in rounds: in the first, every address looks for each
+key it's missing in its links, in traversal order, taking the first linked
+address's tag for it. Addresses that gain tags pass them on in the next round,
+so a round only revisits the addresses linked to those that gained tags in the
+one before, and the rounds end when none do. This gives the same tags, in the
+same order, as rescanning every address each round.
+
+Unit addresses still missing a key then look for it on the unit of the same
+number in a range their tags were linked from (the "has base in range unit
+child" path).
+"""
+from collections import OrderedDict
+
+# Order links are followed in
+TRAVERSAL_ORDER = ['has generic unit', 'matches unit', 'has base', 'overlaps', 'in range']
+
+
+def is_rejected_link(geocode_map, street_address, link_address, rejected_link_map):
+    """
+    Check whether an address can't take tags from a linked address because
+    their PWD and DOR parcel geocodes both differ, recording it if so.
+    """
+    if all(a in geocode_map for a in (link_address, street_address)):
+        # TODO: different constraints based on tag type (i.e. dor/pwd ids)
+        if (geocode_map[link_address]['pwd'] is not None and
+                    geocode_map[link_address]['pwd'] != geocode_map[street_address]['pwd']) and \
+                (geocode_map[link_address]['dor'] is not None and
+                    geocode_map[link_address]['dor'] != geocode_map[street_address]['dor']):
+            rejected_link_map.setdefault(street_address, []).append(link_address)
+            return True
+    return False
+
+
+class LinkedTagGraph:
+    def __init__(self, tag_rows, link_rows, geocode_map, tag_keys):
+        self.geocode_map = geocode_map
+        self.tag_keys = tag_keys
+        self.tags = {}  # (street address, key) => first tag
+        self.tag_links = {}  # street address => [(linked address, linked path) of each tag]
+        for tag_row in tag_rows:
+            self.add_tag(tag_row)
+
+        # address_1 => links to follow, in traversal order
+        self.links = {}
+        # address_2 => addresses linked to it
+        self.linked_from = {}
+        links_by_address = OrderedDict()
+        for link_row in link_rows:
+            links_by_address.setdefault(link_row['address_1'], []).append(link_row)
+        for address_1, links in links_by_address.items():
+            self.links[address_1] = [link for rel in TRAVERSAL_ORDER for link in links
+                                     if link['relationship'] == rel]
+            for link in self.links[address_1]:
+                self.linked_from.setdefault(link['address_2'], set()).add(address_1)
+
+    def add_tag(self, tag):
+        street_address = tag['street_address']
+        self.tags.setdefault((street_address, tag['key']), tag)
+        self.tag_links.setdefault(street_address, []).append((tag['linked_address'], tag['linked_path']))
+
+    def propagate(self, street_addresses, rejected_link_map, on_round=None):
+        """
+        Find linked tags for the street addresses (others keep the tags they
+        have). Returns the new tags. on_round, if given, is called with the
+        number of each round before it runs.
+        """
+        positions = {street_address: i for i, street_address in enumerate(street_addresses)}
+        new_tags = []
+        visit = list(street_addresses)
+        i = 1
+        while visit:
+            if on_round:
+                on_round(i)
+            round_tags = []
+            for street_address in visit:
+                links = self.links.get(street_address)
+                if not links:
+                    continue
+                for tag_key in self.tag_keys:
+                    if (street_address, tag_key) in self.tags:
+                        continue
+                    for link in links:
+                        link_address = link['address_2']
+                        if is_rejected_link(self.geocode_map, street_address, link_address, rejected_link_map):
+                            continue
+                        tag = self.tags.get((link_address, tag_key))
+                        if tag is None:
+                            continue
+                        linked_path = tag['linked_path'] if tag['linked_path'] else link_address
+                        linked_address = tag['linked_address'] if tag['linked_address'] else link_address
+                        round_tags.append({
+                            'street_address': street_address,
+                            'key': tag_key,
+                            'value': tag['value'],
+                            'linked_address': linked_address,
+                            'linked_path': street_address + ' ' + link['relationship'] + ' ' + linked_path,
+                        })
+                        break
+
+            # Tags found in a round are only passed on in the next
+            revisit = set()
+            for tag in round_tags:
+                self.add_tag(tag)
+                revisit.update(self.linked_from.get(tag['street_address'], ()))
+            new_tags.extend(round_tags)
+            visit = sorted((x for x in revisit if x in positions), key=positions.get)
+            i += 1
+        return new_tags
+
+    def find_unit_child_tags(self, unit_address_rows, base_links, parse, rejected_link_map, on_progress=None):
+        """
+        Find tags for unit addresses still missing a key on the units of
+        ranges linked to their tags, with the same number, street and unit.
+        base_links is range street address => its 'has base' links. Returns
+        the new tags, which aren't passed on. on_progress, if given, is called
+        with the number of addresses looked at every 10000 addresses.
+        """
+        new_tags = []
+        for i, address_row in enumerate(unit_address_rows):
+            if on_progress and (i + 1) % 10000 == 0:
+                on_progress(i + 1)
+            street_address = address_row['street_address']
+            comps = [address_row[field] or '' for field in
+                     ('address_low', 'street_predir', 'street_name', 'street_suffix', 'street_postdir',
+                      'unit_type', 'unit_num')]
+
+            tag_links = self.tag_links.get(street_address)
+            if not tag_links:
+                continue
+            linked_addresses = set(tag_links)
+            for tag_key in self.tag_keys:
+                if (street_address, tag_key) in self.tags:
+                    continue
+                found = False
+                for linked_address, linked_path in linked_addresses:
+                    if found:
+                        break
+                    if linked_address is None:
+                        continue
+                    for link in base_links.get(linked_address, ()):
+                        l_street_address = link['address_1']
+                        parsed = parse(l_street_address)
+                        if is_rejected_link(self.geocode_map, linked_address, l_street_address, rejected_link_map):
+                            continue
+
+                        address_comps = parsed['components']['address']
+                        street_comps = parsed['components']['street']
+                        unit_comps = parsed['components']['address_unit']
+                        l_comps = [x or '' for x in (
+                            address_comps['low_num'], street_comps['predir'], street_comps['name'],
+                            street_comps['suffix'], street_comps['postdir'],
+                            unit_comps['unit_type'], unit_comps['unit_num'])]
+                        if l_comps != comps:
+                            continue
+
+                        link_tag = self.tags.get((l_street_address, tag_key))
+                        if link_tag is None:
+                            continue
+                        new_tags.append({
+                            'street_address': street_address,
+                            'key': tag_key,
+                            'value': link_tag['value'],
+                            'linked_address': l_street_address,
+                            'linked_path': linked_path + ' unit child ' + l_street_address,
+                        })
+                        found = True
+                        break
+        return new_tags
@@ -3,29 +3,40 @@ import sys
 import subprocess
 from flask_script import Manager
 from ais import app
+from ais.engine.build import Build, path_for_script
 
 manager = Manager(usage='Perform engine operations')
 
-def path_for_script(root_path, script):
-    return os.path.join(root_path, 'engine', 'scripts', script + '.py')
-
 @manager.option('script', help='Name of the script to run, e.g. '
                                '`load_addresses`. Use `all` to run all scripts.'
 )
-def run(script):
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='With `all`, how many scripts to run at once.')
+@manager.option('-r', '--resume', dest='resume', action='store_true', default=False,
+                help='With `all`, skip the scripts that succeeded in the last build.')
+@manager.option('-f', '--full', dest='full', action='store_true', default=False,
+                help='Rebuild all addresses, not only those whose sources changed.')
+def run(script, workers=None, resume=False, full=False):
     """Run engine scripts."""
-    root_path = app.root_path
-    scripts = app.config['ENGINE_SCRIPTS_ALL'] if script == 'all' else [script]
-    paths = []
-
-    for script in scripts:
-        path = path_for_script(root_path, script)
-        if not os.path.isfile(path):
-            raise FileNotFoundError('Script not found: {}'.format(script))
-        paths.append(path)
-        
-    for path in paths:
-        subprocess.call([sys.executable, path], env=os.environ.copy())
+    if full:
+        # Scripts read this from the config in their own processes
+        os.environ['ENGINE_FULL_REBUILD'] = 'True'
+    if script == 'all':
+        build_config = app.config['ENGINE_BUILD']
+        build = Build(app.config['ENGINE_STAGES'],
+                      workers=workers or build_config['workers'],
+                      log_dir=build_config['log_dir'],
+                      resume=resume)
+        if not build.run():
+            sys.exit(1)
+        return
+
+    path = path_for_script(app.root_path, script)
+    if not os.path.isfile(path):
+        raise FileNotFoundError('Script not found: {}'.format(script))
+    returncode = subprocess.call([sys.executable, path], env=os.environ.copy())
+    if returncode != 0:
+        sys.exit(returncode)
 
 # ACTIVATE BELOW WHEN running "ais db migrate"
 #Import database models with app context
@@ -0,0 +1,62 @@
+"""
+Spatial matching of addresses to parcels in process, for addresses on a
+segment that didn't match a parcel by address.
+
+The polygons of a parcel layer go into an STRtree of prepared geometries.
+Points are offset from each address's true range intersect at increasing
+distances from the street, and matched to the parcels they intersect; where
+a point is on more than one parcel, the one with the lowest row ID wins.
+"""
+import numpy as np
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from ais.util import get_strtree_position
+
+# Distances from the street to test, nearest first
+TEST_OFFSETS = range(10, 50, 10)
+
+
+class ParcelTree:
+    def __init__(self, parcel_ids, parcel_shapes):
+        """parcel_ids and parcel_shapes are parallel lists, ordered by ID."""
+        self.parcel_ids = list(parcel_ids)
+        self.shapes = list(parcel_shapes)
+        self.prepared = [prep(shape) for shape in self.shapes]
+        self.tree = STRtree(self.shapes)
+        self.tree_positions = {id(shape): position for position, shape in enumerate(self.shapes)}
+
+    def find(self, point):
+        """Get the ID of the first parcel the point is on, or None."""
+        hits = sorted(get_strtree_position(hit, self.tree_positions) for hit in self.tree.query(point))
+        for position in hits:
+            if self.prepared[position].intersects(point):
+                return self.parcel_ids[position]
+        return None
+
+    def match_offsets(self, seg_arrays, positions, xsect_xs, xsect_ys, seg_sides, offsets=TEST_OFFSETS):
+        """
+        Match addresses to the parcel at the first of `offsets` from their true
+        range intersects (xsect_xs, xsect_ys) on their side of their segment
+        (positions in seg_arrays) that is on one. Returns a list of parcel IDs,
+        None for addresses that matched at no offset.
+        """
+        seg_positions = np.asarray(positions, dtype=np.intp)
+        xsect_xs = np.asarray(xsect_xs, dtype=np.float64)
+        xsect_ys = np.asarray(xsect_ys, dtype=np.float64)
+        seg_sides = np.asarray(seg_sides)
+
+        parcel_ids = [None] * len(seg_positions)
+        unmatched = np.arange(len(seg_positions), dtype=np.intp)
+        for offset in offsets:
+            if not len(unmatched):
+                break
+            test_xs, test_ys = seg_arrays.offset(seg_positions[unmatched], xsect_xs[unmatched],
+                                                 xsect_ys[unmatched], offset, seg_sides[unmatched])
+            still_unmatched = []
+            for i, test_x, test_y in zip(unmatched.tolist(), test_xs.tolist(), test_ys.tolist()):
+                parcel_ids[i] = self.find(Point(test_x, test_y))
+                if parcel_ids[i] is None:
+                    still_unmatched.append(i)
+            unmatched = np.array(still_unmatched, dtype=np.intp)
+        return parcel_ids
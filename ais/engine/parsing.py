@@ -0,0 +1,52 @@
+"""
+Parse addresses in a pool of worker processes, each with its own parser.
+Results come back in the order the addresses were given, so that callers can
+merge them exactly as a serial loop would. Addresses in the persistent parse
+cache aren't parsed again.
+"""
+from multiprocessing import Pool
+from passyunk.parser import PassyunkParser
+from ais.util import PersistentParseCache
+
+# The parser of the current process
+_parser = None
+
+
+def _init_parser():
+    global _parser
+    _parser = PassyunkParser()
+
+
+def _parse(address):
+    try:
+        return _parser.parse(address)
+    except Exception:
+        return None
+
+
+def _parse_all(addresses, workers, chunk_size):
+    if workers <= 1 or len(addresses) <= chunk_size:
+        if _parser is None:
+            _init_parser()
+        return [_parse(address) for address in addresses]
+
+    with Pool(workers, initializer=_init_parser) as pool:
+        return pool.map(_parse, addresses, chunksize=chunk_size)
+
+
+def parse_addresses(addresses, workers=1, chunk_size=1000, cache=None):
+    """
+    Parse a list of addresses with up to `workers` processes, each taking
+    `chunk_size` addresses at a time. Returns the parse results in the same
+    order, with None for addresses the parser failed on. If `cache` is a
+    PersistentParseCache, addresses found in it aren't parsed, and the new
+    results are added to it.
+    """
+    if not isinstance(cache, PersistentParseCache):
+        cache = None
+    cached = cache.get_many(addresses) if cache is not None else {}
+    to_parse = [address for address in addresses if address not in cached]
+    parsed = dict(zip(to_parse, _parse_all(to_parse, workers, chunk_size)))
+    if cache is not None:
+        cache.put_many((address, result) for address, result in parsed.items() if result is not None)
+    return [cached[address] if address in cached else parsed[address] for address in addresses]
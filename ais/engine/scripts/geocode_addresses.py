@@ -6,7 +6,11 @@ from datetime import datetime
 from shapely.wkt import loads, dumps
 from shapely.geometry import Point, LineString, MultiLineString
 import datum
-from ais import app, util
+import numpy as np
+from ais import app
+from ais.engine import changes
+from ais.engine.centerline import SegmentArrays
+from ais.engine.parcels import ParcelTree
 from ais.models import Address
 # DEV
 import traceback
@@ -20,8 +24,6 @@ SET UP
 '''
 
 config = app.config
-Parser = config['PARSER']
-parser = Parser()
 db = datum.connect(config['DATABASES']['engine'])
 
 # parcel_table = 'pwd_parcel'
@@ -65,19 +67,37 @@ if FILTER_STREET_NAME not in [None, '']:
     WHERE_SEG_ID_IN = "seg_id in (select seg_id from {} where {})" \
         .format(seg_table.name, WHERE_STREET_NAME)
 
+print('Checking for changes since the last build...')
+incremental = changes.is_incremental(db)
+# Curbs aren't checked by load_addresses, which doesn't use them
+changed_curb_tables = changes.changed_tables(db, ['curb', 'parcel_curb'])
+if incremental and changed_curb_tables:
+    print('Geocoding all addresses: {} changed'.format(', '.join(changed_curb_tables)))
+    changes.mark_full(db)
+    incremental = False
+
+# Only geocode the changed addresses
+if incremental and WHERE_STREET_ADDRESS_IN is None:
+    WHERE_STREET_ADDRESS_IN = 'street_address in ({})'.format(changes.CHANGED_ADDRESSES_SQL)
+
 if WRITE_OUT:
-    print('Dropping indexes...')
-    geocode_table.drop_index('street_address')
+    if incremental:
+        print('Deleting XYs of changed addresses...')
+        db.execute('DELETE FROM geocode WHERE {}'.format(WHERE_STREET_ADDRESS_IN))
+    else:
+        print('Dropping indexes...')
+        geocode_table.drop_index('street_address')
 
-    print('Deleting existing XYs...')
-    geocode_table.delete()
+        print('Deleting existing XYs...')
+        geocode_table.delete()
 
     print('Deleting spatial address-parcels...')
     spatial_stmt = '''
 		DELETE FROM address_parcel
-			WHERE match_type = 'spatial'
-	'''
+			WHERE match_type = 'spatial' {}
+	'''.format('AND ' + WHERE_STREET_ADDRESS_IN if incremental else '')
     db.execute(spatial_stmt)
+    db.save()
 
 print('Reading streets from AIS...')
 seg_rows = seg_table.read(fields=seg_fields, geom_field='geom', \
@@ -167,7 +187,7 @@ parcel_curb_map['pwd'] = pwd_parcel_curb_map
 
 print('Reading addresses from AIS...')
 address_rows = address_table.read(fields=address_fields, \
-                                  where=WHERE_STREET_NAME)
+                                  where=WHERE_STREET_ADDRESS_IN)
 # where='street_address = \'2653-55 N ORIANNA ST\'')
 addresses = []
 seg_side_map = {}
@@ -213,6 +233,74 @@ for addr_parcel_row in addr_parcel_rows:
     addr_parcel_map[street_address].setdefault(parcel_source, [])
     addr_parcel_map[street_address][parcel_source].append(parcel_row_id)
 
+
+def get_address_num(address_row):
+    address_low = address_row['address_low']
+    address_high = address_row['address_high']
+    # Get mid-address of ranges
+    if address_high:
+        # This is not necessarily an integer, nor the right parity, but
+        # it shouldn't matter for interpolation.
+        return address_low + (address_high - address_low) / 2
+    return address_low
+
+
+def get_distance_ratio(address_num, low, high):
+    # If the there's no range, put it in the middle
+    if high - low == 0:
+        return 0.5
+    return (address_num - low) / (high - low)
+
+
+'''
+CENTERLINE & TRUE RANGE
+'''
+
+print('Interpolating addresses along streets...')
+interpolate_start = datetime.now()
+seg_arrays = SegmentArrays({seg_id: seg['shape'] for seg_id, seg in seg_map.items()})
+
+# Addresses on a seg (by row index) and what to interpolate them by
+seg_address_indexes = []
+seg_ids = []
+seg_sides = []
+distance_ratios = []
+true_distance_ratios = []
+for i, address_row in enumerate(address_rows):
+    addr_street_row = addr_street_map.get(address_row['street_address'])
+    if addr_street_row is None or not addr_street_row['seg_id']:
+        continue
+    seg_id = addr_street_row['seg_id']
+    seg_side = addr_street_row['seg_side']
+    side_ranges = seg_map[seg_id][seg_side]
+    address_num = get_address_num(address_row)
+    seg_address_indexes.append(i)
+    seg_ids.append(seg_id)
+    seg_sides.append(seg_side)
+    distance_ratios.append(get_distance_ratio(address_num, side_ranges['low'], side_ranges['high']))
+    true_distance_ratios.append(get_distance_ratio(address_num, side_ranges['true_low'],
+                                                   side_ranges['true_high']))
+
+# Interpolate using full range, then true range, with a buffer at the ends of
+# the seg, and offset to the side of the street
+seg_positions = seg_arrays.get_positions(seg_ids)
+xsect_xs, xsect_ys = seg_arrays.interpolate_buffered(seg_positions, distance_ratios, centerline_end_buffer)
+seg_xs, seg_ys = seg_arrays.offset(seg_positions, xsect_xs, xsect_ys, centerline_offset, seg_sides)
+true_xsect_xs, true_xsect_ys = seg_arrays.interpolate_buffered(seg_positions, true_distance_ratios,
+                                                               centerline_end_buffer)
+true_seg_xs, true_seg_ys = seg_arrays.offset(seg_positions, true_xsect_xs, true_xsect_ys, centerline_offset,
+                                             seg_sides)
+
+seg_sides = np.array(seg_sides)
+# address row index => position in the arrays above
+seg_address_positions = {i: j for j, i in enumerate(seg_address_indexes)}
+# address row index => (centerline XY, true range XY)
+centerline_xy_map = {}
+for i, seg_xy, true_seg_xy in zip(seg_address_indexes, zip(seg_xs.tolist(), seg_ys.tolist()),
+                                  zip(true_seg_xs.tolist(), true_seg_ys.tolist())):
+    centerline_xy_map[i] = (Point(seg_xy), Point(true_seg_xy))
+print('Interpolated {} addresses in {}'.format(len(seg_address_indexes), datetime.now() - interpolate_start))
+
 '''
 MAIN
 '''
@@ -223,6 +311,9 @@ geocode_count = 0
 
 # address-parcels to insert from spatial match
 address_parcels = []
+# parcel layer => positions in the seg address arrays of addresses to match
+# spatially
+spatial_match_map = {parcel_layer_name: [] for parcel_layer_name in parcel_layers}
 
 for i, address_row in enumerate(address_rows):
     try:
@@ -236,17 +327,6 @@ for i, address_row in enumerate(address_rows):
 
         address_id = address_row['id']
         street_address = address_row['street_address']
-        address_low = address_row['address_low']
-        address_high = address_row['address_high']
-
-        # Get mid-address of ranges
-        if address_high:
-            # This is not necessarily an integer, nor the right parity, but
-            # it shouldn't matter for interpolation.
-            address_mid_offset = (address_high - address_low) / 2
-            address_num = address_low + address_mid_offset
-        else:
-            address_num = address_low
 
         # Get seg ID
         try:
@@ -265,40 +345,9 @@ for i, address_row in enumerate(address_rows):
             CENTERLINE
             '''
 
-            # Get seg XY
-            seg = seg_map[seg_id]
-            seg_shp = seg['shape']
-
-            # Interpolate using full range
-            low = seg[seg_side]['low']
-            high = seg[seg_side]['high']
-            side_delta = high - low
-            # seg_estimated = False
-
-            # If the there's no range
-            if side_delta == 0:
-                # print('No range: seg {}, {} - {}'.format(seg_id, low, high))
-                # continue
-                # Put it in the middle
-                distance_ratio = 0.5
-            # seg_estimated = True
-            else:
-                distance_ratio = (address_num - low) / side_delta
-            # print('Distance ratio: {}'.format(distance_ratio))
-
-            # Old method: just interpolate
-            # seg_xsect_xy_old = seg_shp.interpolate(distance_ratio, \
-            # 	normalized=True)
-            # print('Old intersect: {}'.format(seg_xsect_xy_old))
-
-            # New method: interpolate buffered
-            seg_xsect_xy = util.interpolate_buffered(seg_shp, distance_ratio, \
-                                                     centerline_end_buffer)
-            # print('Intersect: {}'.format(seg_xsect_xy))
-
-            seg_xy = util.offset(seg_shp, seg_xsect_xy, centerline_offset, \
-                                 seg_side)
-            # print('Offset to {}: {}'.format(seg_side, seg_xy))
+            # Interpolated above
+            seg_shp = seg_map[seg_id]['shape']
+            seg_xy, true_seg_xy = centerline_xy_map[i]
             geocode_rows.append({
                 # 'address_id': address_id,
                 'street_address': street_address,
@@ -311,25 +360,6 @@ for i, address_row in enumerate(address_rows):
             TRUE RANGE
             '''
 
-            true_low = seg[seg_side]['true_low']
-            true_high = seg[seg_side]['true_high']
-            true_side_delta = true_high - true_low
-            # true_estimated = False
-
-            if true_side_delta == 0:
-                # print('No true range: {}, seg {}, {} - {}'.format(seg_id, true_low, true_high))
-                # continue
-                true_distance_ratio = 0.5
-            # true_estimated = True
-            else:
-                true_distance_ratio = (address_num - true_low) / true_side_delta
-
-            # true_xsect_xy = seg_shp.interpolate(true_distance_ratio, \
-            # 	normalized=True)
-            true_xsect_xy = util.interpolate_buffered(seg_shp, true_distance_ratio, \
-                                                      centerline_end_buffer)
-            true_seg_xy = util.offset(seg_shp, true_xsect_xy, centerline_offset, \
-                                      seg_side)
             # print('true: {}'.format(true_seg_xy))
             geocode_rows.append({
                 # 'address_id': address_id,
@@ -384,49 +414,8 @@ for i, address_row in enumerate(address_rows):
                 SPATIAL MATCH
                 '''
 
-                for test_offset in range(10, 50, 10):
-                    # Get test XY
-                    test_xy_shp = util.offset(seg_shp, true_xsect_xy, \
-                                              test_offset, seg_side)
-                    test_xy_wkt = dumps(test_xy_shp)
-
-                    parcel_match_stmt = '''
-						SELECT
-							id,
-							CASE
-								WHEN ST_Intersects(geom, ST_Centroid(geom))
-								THEN ST_AsText(ST_Centroid(geom))
-								ELSE ST_AsText(ST_PointOnSurface(geom))
-							END as wkt
-						FROM {source_table}
-						WHERE ST_Intersects(geom, ST_GeomFromText('{test_xy_wkt}', 2272))
-					'''.format(source_table=source_table, test_xy_wkt=test_xy_wkt)
-                    db.execute(parcel_match_stmt)
-                    parcel_match = db._c.fetchone()
-
-                    if parcel_match:
-                        parcel_id = parcel_match['id']
-                        # pwd_parcel_id = parcel_match['parcel_id']
-                        # pwd_parcel_xy = parcel_xy_map[parcel_layer_name][parcel_id]
-                        # print('Rematched {} to PWD parcel {}'.format(street_address, pwd_parcel_id))
-                        parcel_match_wkt = parcel_match['wkt']
-                        geocode_rows.append({
-                            'street_address': street_address,
-                            'geocode_type': geocode_priority_map[source_table + '_spatial'],
-                            # 'estimated': '1',
-                            # 'geometry': dumps(pwd_parcel_xy)
-                            'geom': parcel_match_wkt,
-                        })
-
-                        # Make estimated address-parcel
-                        address_parcels.append({
-                            'street_address': street_address,
-                            'parcel_source': parcel_layer_name,
-                            'parcel_row_id': parcel_id,
-                            'match_type': 'spatial',
-                        })
-
-                        break
+                # Matched to all addresses at once, below
+                spatial_match_map[parcel_layer_name].append(seg_address_positions[i])
 
             '''
             CURBSIDE & IN_STREET (MIDPOINT B/T CURB & CENTERLINE)
@@ -478,6 +467,60 @@ for i, address_row in enumerate(address_rows):
         print(traceback.format_exc())
         sys.exit()
 
+'''
+SPATIAL MATCH
+'''
+
+# Match addresses on a seg without a parcel to the parcel at a point offset
+# from their true range intersect, trying points further from the street
+# until one hits a parcel.
+print('Matching addresses to parcels spatially...')
+for parcel_layer_name, spatial_positions in spatial_match_map.items():
+    source_table = parcel_layer_name + '_parcel'
+    print('  - {}: {} addresses'.format(parcel_layer_name, len(spatial_positions)))
+    if not spatial_positions:
+        continue
+    spatial_start = datetime.now()
+
+    # Ordered by ID, so that a point on more than one parcel matches the first
+    parcel_rows = db[source_table].read(fields=['id'], geom_field='geom', sort=['id'])
+    parcel_ids = []
+    parcel_shapes = []
+    for parcel_row in parcel_rows:
+        parcel_ids.append(parcel_row['id'])
+        parcel_shapes.append(loads(parcel_row['geom']))
+    parcel_tree = ParcelTree(parcel_ids, parcel_shapes)
+    del parcel_rows, parcel_ids, parcel_shapes
+    parcel_layer_xy_map = parcel_xy_map[parcel_layer_name]
+
+    spatial_positions = np.array(spatial_positions, dtype=np.intp)
+    matched_parcel_ids = parcel_tree.match_offsets(seg_arrays, seg_positions[spatial_positions],
+                                                   true_xsect_xs[spatial_positions],
+                                                   true_xsect_ys[spatial_positions], seg_sides[spatial_positions])
+    num_matched = 0
+    for j, parcel_id in zip(spatial_positions.tolist(), matched_parcel_ids):
+        if parcel_id is None:
+            continue
+        num_matched += 1
+        street_address = address_rows[seg_address_indexes[j]]['street_address']
+        geocode_rows.append({
+            'street_address': street_address,
+            'geocode_type': geocode_priority_map[source_table + '_spatial'],
+            # Centroid, or point on surface if that's outside the parcel
+            'geom': dumps(parcel_layer_xy_map[parcel_id]),
+        })
+
+        # Make estimated address-parcel
+        address_parcels.append({
+            'street_address': street_address,
+            'parcel_source': parcel_layer_name,
+            'parcel_row_id': parcel_id,
+            'match_type': 'spatial',
+        })
+
+    print('    matched {} in {}'.format(num_matched, datetime.now() - spatial_start))
+    del parcel_tree
+
 if WRITE_OUT:
     print('Writing XYs...')
     geocode_table.write(geocode_rows, chunk_size=150000)
@@ -493,8 +536,9 @@ if WRITE_OUT:
     print('Wrote {} rows'.format(len(geocode_rows) + geocode_count))
 
 
-print('Creating index...')
-geocode_table.create_index('street_address')
+if not incremental:
+    print('Creating index...')
+    geocode_table.create_index('street_address')
 
 db.close()
 
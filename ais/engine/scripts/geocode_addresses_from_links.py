@@ -1,6 +1,7 @@
 from datetime import datetime
 import datum
 from ais import app
+from ais.engine import changes
 
 start = datetime.now()
 print('Starting...')
@@ -10,8 +11,6 @@ SET UP
 '''
 
 config = app.config
-Parser = config['PARSER']
-parser = Parser()
 db = datum.connect(config['DATABASES']['engine'])
 WRITE_OUT = True
 geocode_table = db['geocode']
@@ -35,6 +34,9 @@ for geocode_row in geocode_rows:
 print('Reading address tags...')
 tag_map = {}
 where = "linked_address != '' and key in ('pwd_parcel_id', 'dor_parcel_id')"
+# The other addresses still have the geocodes they got from links
+if changes.is_incremental(db):
+    where += ' and street_address in ({})'.format(changes.CHANGED_ADDRESSES_SQL)
 tag_rows = address_tag_table.read(where=where)
 print('Mapping address tags...')
 for tag_row in tag_rows:
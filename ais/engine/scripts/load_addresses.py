@@ -2,12 +2,16 @@
 # import os
 # import csv
 # from copy import deepcopy
+from collections import Counter, OrderedDict
 from datetime import datetime
+from itertools import chain
 import datum
 from ais import app
-from ais.models import Address
-from ais.util import parity_for_num, parity_for_range
-from passyunk.parser import PassyunkParser
+from ais.engine import changes
+from ais.engine.interval_index import IntervalIndex
+from ais.engine.parsing import parse_addresses
+from ais.models import Address, parser, use_parse_cache
+from ais.util import parity_for_num, parity_for_range, get_parser_version
 # DEV
 # import traceback
 # from pprint import pprint
@@ -16,6 +20,7 @@ print('Starting...')
 start = datetime.now()
 
 config = app.config
+parse_cache = use_parse_cache()
 Parser = config['PARSER']
 
 parser_tags = config['ADDRESSES']['parser_tags']
@@ -56,6 +61,9 @@ true_range_select_stmt = '''
     order by r.seg_id
 '''
 parcel_layers = config['BASE_DATA_SOURCES']['parcels']
+# Tables addresses are matched against here. If any of them changed since the
+# last build, every address is rebuilt.
+base_tables = ['street_segment'] + [x + '_parcel' for x in parcel_layers]
 address_parcel_table = db['address_parcel']
 address_property_table = db['address_property']
 address_error_table = db['address_error']
@@ -86,8 +94,35 @@ parser_address_tags = []
 address_tag_strings = set()  # Pipe-joined addr/key/value triples
 source_addresses = []
 links = []  # dicts of address, relationship, address triples
-parser = PassyunkParser()
+parse_workers = config['ENGINE_BUILD']['parse_workers']
+parse_chunk_size = config['ENGINE_BUILD']['parse_chunk_size']
 parsed_addresses = {}
+unparsed_addresses = set()  # source addresses the parser failed on
+
+print('Checking for changes since the last build...')
+# Parsed seg IDs and street codes change with the parser's data
+parser_version = parse_cache.version if parse_cache else get_parser_version(parser.parser)
+full_rebuild_reason = changes.start_build(db, config['ENGINE_BUILD']['full_rebuild'], base_tables, parser_version)
+incremental = full_rebuild_reason is None
+if incremental:
+    print('Rebuilding changed addresses only')
+    # Compare source addresses and their fingerprints with the last build's
+    print('Reading previous source addresses...')
+    source_address_fields = ['source_name', 'source_address', 'street_address', 'fingerprint']
+    previous_source_addresses = Counter(changes.source_address_key(x) for x in
+                                        source_address_table.read(fields=source_address_fields))
+    current_source_addresses = Counter()
+    # Addresses linked to a changed address before or after this build are
+    # affected too
+    print('Reading previous address links...')
+    neighbour_map = {}  # street_address => set of linked street addresses
+    for link_row in address_link_table.read(fields=['address_1', 'address_2']):
+        neighbour_map.setdefault(link_row['address_1'], set()).add(link_row['address_2'])
+        neighbour_map.setdefault(link_row['address_2'], set()).add(link_row['address_1'])
+    print('Reading previous address-streets...')
+    previous_address_streets = address_street_table.read(fields=['street_address', 'seg_id', 'seg_side'])
+else:
+    print('Rebuilding all addresses: {}'.format(full_rebuild_reason))
 
 if WRITE_OUT:
     print('Dropping indexes...')
@@ -99,7 +134,12 @@ if WRITE_OUT:
     print('Deleting existing addresses...')
     address_table.delete()
     print('Deleting existing address tags...')
-    address_tag_table.delete()
+    if incremental:
+        # Keep linked tags; make_linked_tags only redoes the changed addresses'
+        db.execute("delete from address_tag where coalesce(linked_address, '') = ''")
+        db.save()
+    else:
+        address_tag_table.delete()
     print('Deleting existing source addresses...')
     source_address_table.delete()
     print('Deleting existing address links...')
@@ -187,6 +227,24 @@ for source in sources:
             source_rows = source_table.read(fields=source_fields, \
                                             aliases=aliases, where=where, return_geom=False)
 
+    # Get each row's source address, and parse the ones not seen before in
+    # parallel. Results are added in the order a serial loop would add them.
+    if preprocessor:
+        row_source_addresses = [preprocessor(source_row) for source_row in source_rows]
+    else:
+        row_source_addresses = [source_row['street_address'] for source_row in source_rows]
+    new_source_addresses = [x for x in OrderedDict.fromkeys(row_source_addresses)
+                            if x is not None and x not in parsed_addresses and x not in unparsed_addresses]
+    print('Parsing {} source addresses with {} workers...'.format(len(new_source_addresses), parse_workers))
+    parse_results = parse_addresses(new_source_addresses, workers=parse_workers, chunk_size=parse_chunk_size,
+                                    cache=parse_cache)
+    for source_address, parsed_address in zip(new_source_addresses, parse_results):
+        if parsed_address is None:
+            unparsed_addresses.add(source_address)
+        else:
+            parsed_addresses[source_address] = parsed_address
+    del new_source_addresses, parse_results
+
     # Loop over addresses
     for i, source_row in enumerate(source_rows):
         if i % 100000 == 0:
@@ -200,12 +258,7 @@ for source in sources:
         # else:
         #     source_address = preprocessor(source_row)
 
-        # If there's a preprocessor, apply. This could be single field or comps.
-        if preprocessor:
-            source_address = preprocessor(source_row)
-        # Must be a single field
-        else:
-            source_address = source_row['street_address']
+        source_address = row_source_addresses[i]
 
         if source_address is None:
             # TODO: it might be helpful to log this, but right now we aren't
@@ -219,16 +272,10 @@ for source in sources:
         street_address = None
 
         try:
-            # Try parsing
+            # Parsed above
             parsed_address = parsed_addresses.get(source_address)
             if parsed_address is None:
-                # Passyunk no longer raising errors
-                try:
-                    parsed_address = parser.parse(source_address)
-                    parsed_addresses[source_address] = parsed_address
-
-                except:
-                    raise ValueError('Could not parse')
+                raise ValueError('Could not parse')
 
             if parsed_address['type'] == "none":
                 raise ValueError('Unknown address type')
@@ -255,6 +302,7 @@ for source in sources:
                 'source_name': source_name,
                 'source_address': source_address,
                 'street_address': street_address,
+                'fingerprint': changes.row_fingerprint(source_row),
             }
             source_addresses.append(source_address_dict)
 
@@ -326,6 +374,7 @@ for source in sources:
                         'source_name': 'AIS',
                         'source_address': base_address,
                         'street_address': base_address,
+                        'fingerprint': None,
                     }
                     # Add base AIS created addresses to source_address table
                     source_addresses.append(source_address_dict)
@@ -367,8 +416,11 @@ for source in sources:
 
         print('Writing {} source addresses...'.format(len(source_addresses)))
         source_address_table.write(source_addresses, chunk_size=150000)
-        source_addresses = []
+    if incremental:
+        current_source_addresses.update(changes.source_address_key(x) for x in source_addresses)
+    source_addresses = []
 
+    del row_source_addresses
     #source_db.close()
 
 insert_rows = [dict(x) for x in addresses]
@@ -419,7 +471,7 @@ address_tag_strings = set()
 print('** ADDRESS LINKS **')
 print('Indexing addresses...')
 street_address_map = {}  # street_full => [addresses]
-street_range_map = {}  # street_full => [range addresses]
+street_range_index = IntervalIndex()  # (street_full, parity) => range addresses
 base_address_map = {}  # base_address => [unit addresses]
 for i, address in enumerate(addresses):
     if i % 100000 == 0:
@@ -428,12 +480,11 @@ for i, address in enumerate(addresses):
     street_full = address.street_full
     if not street_full in street_address_map:
         street_address_map[street_full] = []
-        street_range_map[street_full] = []
     street_address_map[street_full].append(address)
 
     # TODO: Include addresses with units in street range map? - base address or include unit?
     if address.address_high is not None and address.unit_type is None:
-        street_range_map[street_full].append(address)
+        street_range_index.add((street_full, address.parity), address.address_low, address.address_high, address)
 
     base_address = address.base_address  # TODO: handle addresses with number suffixes using base_address_no_suffix
     # # Get 'has_base' link for addresses with units
@@ -508,13 +559,10 @@ for i, address in enumerate(addresses):
         address_low = address.address_low
         address_suffix = address.address_low_suffix
         parity = address.parity
-        ranges_on_street = street_range_map[address.street_full]
+        ranges_on_street = street_range_index.find((address.street_full, parity), address_low)
 
         for range_on_street in ranges_on_street:
-            if (range_on_street.address_low <= address_low <= \
-                        range_on_street.address_high) and \
-                            range_on_street.parity == parity and \
-                            range_on_street.address_low_suffix == address_suffix:
+            if range_on_street.address_low_suffix == address_suffix:
                 child_link = {
                     'address_1': address.street_address,
                     'relationship': 'in range',
@@ -554,6 +602,7 @@ for i, address in enumerate(addresses):
                         'source_name': 'AIS',
                         'source_address': child_street_address,
                         'street_address': child_street_address,
+                        'fingerprint': None,
                     }
                     # Add in-range AIS created addresses to source_address table
                     source_addresses.append(source_address_dict)
@@ -569,33 +618,31 @@ for i, address in enumerate(addresses):
                 print('Could not parse new address: {}'.format(child_address))
                 continue
 
-        # Overlap link
-        if street_full in street_range_map:
-            ranges_on_street = street_range_map[street_full]
-            for range_on_street in ranges_on_street:
-                if street_address != range_on_street.street_address \
-                        and range_on_street.parity == parity \
-                        and base_address != range_on_street.base_address \
-                        and base_address_no_suffix != range_on_street.base_address_no_suffix \
-                        and unit_type == range_on_street.unit_type \
-                        and unit_num == range_on_street.unit_num \
-                        and (
-                                            range_on_street.address_low <= address_low <= range_on_street.address_high
-                                or range_on_street.address_low <= address_high <= range_on_street.address_high
-                        ):
-                    child_link = {
-                        'address_1': street_address,
-                        'relationship': 'overlaps',
-                        'address_2': range_on_street.street_address,
-                    }
-                    # 'overlaps' links are bi-directional
-                    child_link_rev = {
-                        'address_1': range_on_street.street_address,
-                        'relationship': 'overlaps',
-                        'address_2': street_address,
-                    }
-                    links.append(child_link)
-                    links.append(child_link_rev)
+        # Overlap link: ranges containing either end of this one
+        ranges_on_street = street_range_index.find((street_full, parity), address_low)
+        ranges_on_street = ranges_on_street + [x for x in street_range_index.find((street_full, parity), address_high)
+                                               if x not in ranges_on_street]
+        for range_on_street in ranges_on_street:
+            if street_address != range_on_street.street_address \
+                    and base_address != range_on_street.base_address \
+                    and base_address_no_suffix != range_on_street.base_address_no_suffix \
+                    and unit_type == range_on_street.unit_type \
+                    and unit_num == range_on_street.unit_num:
+                child_link = {
+                    'address_1': street_address,
+                    'relationship': 'overlaps',
+                    'address_2': range_on_street.street_address,
+                }
+                # 'overlaps' links are bi-directional
+                child_link_rev = {
+                    'address_1': range_on_street.street_address,
+                    'relationship': 'overlaps',
+                    'address_2': street_address,
+                }
+                links.append(child_link)
+                links.append(child_link_rev)
+
+print('Range lookups: {}'.format(street_range_index.report()))
 
 # Remove any duplicates in link list
 links = [dict(t) for t in set([tuple(d.items()) for d in links])]
@@ -605,6 +652,10 @@ if WRITE_OUT:
     address_link_table.write(links, chunk_size=150000)
     print('Created {} address links'.format(len(links)))
 
+if incremental:
+    for link in links:
+        neighbour_map.setdefault(link['address_1'], set()).add(link['address_2'])
+        neighbour_map.setdefault(link['address_2'], set()).add(link['address_1'])
 del links
 
 insert_rows = [dict(x) for x in new_addresses]
@@ -614,7 +665,15 @@ if WRITE_OUT:
 
     print('Writing {} base and in-range AIS source addresses...'.format(len(source_addresses)))
     source_address_table.write(source_addresses, chunk_size=150000)
-    source_addresses = []
+
+if incremental:
+    current_source_addresses.update(changes.source_address_key(x) for x in source_addresses)
+    # Source addresses added, removed or with changed source rows
+    changed_source_addresses = (previous_source_addresses - current_source_addresses) + \
+                               (current_source_addresses - previous_source_addresses)
+    changed_addresses = set(key[2] for key in changed_source_addresses)
+    print('{} addresses have changed sources'.format(len(changed_addresses)))
+    del previous_source_addresses, current_source_addresses, changed_source_addresses
 
 source_addresses = []
 del insert_rows
@@ -844,6 +903,13 @@ for address in addresses:
 if WRITE_OUT:
     print('Writing address-streets...')
     address_street_table.write(address_streets, chunk_size=150000)
+if incremental:
+    changed_addresses = changes.expand_seg_sides(changed_addresses,
+                                                 chain(previous_address_streets, address_streets))
+    # Tags are passed along links, so later stages need every address an
+    # affected address is linked to, however indirectly.
+    changed_addresses = changes.expand_links(changed_addresses, neighbour_map)
+    del previous_address_streets, neighbour_map
 del address_streets
 
 # Handle errors
@@ -896,7 +962,13 @@ if WRITE_OUT:
     print('Dropping index on address-parcels...')
     address_parcel_table.drop_index('street_address')
     print('Deleting existing address-parcels...')
-    address_parcel_table.delete()
+    if incremental:
+        # Keep spatial matches; geocode_addresses only redoes the changed
+        # addresses'
+        db.execute("delete from address_parcel where match_type != 'spatial'")
+        db.save()
+    else:
+        address_parcel_table.delete()
 
 for parcel_layer in parcel_layers:
     source_table_name = parcel_layer + '_parcel'
@@ -1099,13 +1171,14 @@ prop_map = {x['street_address']: x for x in prop_rows}
 
 print('Indexing range properties...')
 range_rows = [x for x in prop_rows if x['address_high'] is not None]
-range_map = {}  # street_full => [range props]
+range_prop_index = IntervalIndex()  # (street_full, parity) => range props
 for range_row in range_rows:
     try:
         street_address = range_row['street_address']
         street_full = Address(street_address).street_full
-        prop_list = range_map.setdefault(street_full, [])
-        prop_list.append(range_row)
+        range_parity = parity_for_range(range_row['address_low'], range_row['address_high'])
+        range_prop_index.add((street_full, range_parity), range_row['address_low'], range_row['address_high'],
+                             range_row)
     except ValueError:
         print('Unrecognized format for range address: {}'.format(street_address))
         continue
@@ -1143,29 +1216,18 @@ for i, address in enumerate(addresses):
         match_type = 'generic_unit'
 
     # RANGE
-    elif address.address_high is None and address.street_full in range_map:
-        range_props_on_street = range_map[address.street_full]
-        address_parity = address.parity
-
-        for range_prop in range_props_on_street:
-            range_prop_address_low = range_prop['address_low']
-            range_prop_address_high = range_prop['address_high']
-            range_prop_parity = parity_for_range(range_prop_address_low, \
-                                                 range_prop_address_high)
-
-            # Check parity
-            if address_parity != range_prop_parity:
+    elif address.address_high is None:
+        range_props = range_prop_index.find((address.street_full, address.parity), address.address_low)
+
+        for range_prop in range_props:
+            # If there's a unit num we have to make sure that matches too
+            if (address.unit_num or range_prop['unit_num']) and \
+                            address.unit_num != range_prop['unit_num']:
                 continue
 
-            if range_prop['address_low'] <= address.address_low <= range_prop['address_high']:
-                # If there's a unit num we have to make sure that matches too
-                if (address.unit_num or range_prop['unit_num']) and \
-                                address.unit_num != range_prop['unit_num']:
-                    continue
-
-                prop = range_prop
-                match_type = 'range'
-                break
+            prop = range_prop
+            match_type = 'range'
+            break
 
     if prop:
         address_prop = {
@@ -1175,6 +1237,8 @@ for i, address in enumerate(addresses):
         }
         address_props.append(address_prop)
 
+print('Range property lookups: {}'.format(range_prop_index.report()))
+
 if WRITE_OUT:
     address_property_table.write(address_props)
     print('Indexing address-properties...')
@@ -1225,6 +1289,10 @@ if WRITE_OUT:
     address_link_table.create_index('address_2')
     address_street_table.create_index('street_address')
 
+    if incremental:
+        print('Writing {} changed addresses...'.format(len(changed_addresses)))
+        changes.write_changed_addresses(db, changed_addresses)
+
 db.close()
 
 print('Finished in {} seconds'.format(datetime.now() - start))
@@ -5,7 +5,7 @@ import re
 from datetime import datetime
 from passyunk.data import DIRS_STD, SUFFIXES_STD
 import datum
-from ais.models import Address
+from ais.models import Address, use_parse_cache
 from ais.util import parity_for_num, parity_for_range
 from ais import app
 from config import VALID_ADDRESS_LOW_SUFFIXES
@@ -19,6 +19,7 @@ print('Starting...')
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 db = datum.connect(config['DATABASES']['engine'])
 
 source_def = config['BASE_DATA_SOURCES']['parcels']['dor']
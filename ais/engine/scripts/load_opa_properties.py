@@ -3,7 +3,7 @@ import re
 from datetime import datetime
 import datum
 from ais import app
-from ais.models import Address
+from ais.models import Address, parser, use_parse_cache
 # DEV
 import traceback
 from pprint import pprint
@@ -15,6 +15,7 @@ start = datetime.now()
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 source_def = config['BASE_DATA_SOURCES']['properties']
 source_db = datum.connect(config['DATABASES'][source_def['db']])
 ais_source_db = datum.connect(config['DATABASES']['gis'])
@@ -23,8 +24,6 @@ field_map = source_def['field_map']
 db = datum.connect(config['DATABASES']['engine'])
 prop_table = db['opa_property']
 
-Parser = config['PARSER']
-parser = Parser()
 
 """MAIN"""
 
@@ -4,7 +4,7 @@ import csv
 from datetime import datetime
 import datum
 from ais import app
-from ais.models import Address
+from ais.models import Address, use_parse_cache
 # DEV
 from pprint import pprint
 import traceback
@@ -17,6 +17,7 @@ print('Starting...')
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 db = datum.connect(config['DATABASES']['engine'])
 parcel_table = db['pwd_parcel']
 parcel_geom_field = parcel_table.geom_field
@@ -5,7 +5,7 @@ from pprint import pprint
 # from phladdress.parser import Parser
 from ais import app
 from datum import Database
-from ais.models import StreetSegment
+from ais.models import StreetSegment, parser, use_parse_cache
 
 
 print('Starting...')
@@ -14,8 +14,8 @@ start = datetime.now()
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 
-Parser = config['PARSER']
 db = Database(config['DATABASES']['engine'])
 engine_srid = config['ENGINE_SRID']
 
@@ -38,8 +38,6 @@ street_table = db[street_table_name]
 
 """MAIN"""
 
-parser = Parser()
-
 print('Deleting existing streets...')
 street_table.delete(cascade=True)
 
@@ -5,7 +5,7 @@ from copy import deepcopy
 from datetime import datetime
 import datum
 from ais import app
-from ais.models import Address
+from ais.models import Address, use_parse_cache
 # DEV
 import traceback
 from pprint import pprint
@@ -15,6 +15,7 @@ start = datetime.now()
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 db = datum.connect(config['DATABASES']['engine'])
 source_db = datum.connect(config['DATABASES']['gis'])
 # source_table = source_db['usps_zip4s']
@@ -5,7 +5,9 @@ from datetime import datetime
 from copy import deepcopy
 import datum
 from ais import app
+from ais.engine import changes
 from ais.models import Address
+from ais.util import OWNER_TOKEN_SEPARATOR
 # DEV
 import traceback
 from pprint import pprint
@@ -32,10 +34,17 @@ geocode_types_in_street = config['ADDRESS_SUMMARY']['geocode_types_in_street']
 tag_table = db['address_tag']
 link_table = db['address_link']
 address_summary_table = db['address_summary']
+owner_token_table = db['owner_token']
 
 # DEV
 WRITE_OUT = True
 
+# Only summarize the changed addresses
+incremental = changes.is_incremental(db)
+changed_where = 'street_address in ({})'.format(changes.CHANGED_ADDRESSES_SQL) if incremental else None
+if incremental:
+    print('Summarizing changed addresses only')
+
 
 def wkt_to_xy(wkt):
     xy = wkt.replace('POINT(', '')
@@ -66,11 +75,16 @@ def get_tag_by_key(tag_rows, search_key):
 # Get street names for chunking addresses
 print('Reading street names...')
 street_name_stmt = '''
-	select distinct street_name from address order by street_name
-'''
+	select distinct street_name from address {} order by street_name
+'''.format('where ' + changed_where if incremental else '')
 street_names = [x['street_name'] for x in db.execute(street_name_stmt)]
 
-if WRITE_OUT:
+if WRITE_OUT and incremental:
+    print('Deleting summary rows of changed addresses...')
+    db.execute('delete from address_summary where {}'.format(changed_where))
+    db.save()
+
+elif WRITE_OUT:
     print('Dropping indexes...')
     address_summary_table.drop_index('street_address')
     trgm_idx_stmt = '''
@@ -82,13 +96,16 @@ if WRITE_OUT:
     print('Deleting existing summary rows...')
     address_summary_table.delete()
 
+if WRITE_OUT:
+
     print('Creating temporary street name index...')
     address_table.create_index('street_name')
 
 print('Reading XYs...')
 geocode_rows = geocode_table.read( \
     fields=['street_address', 'geocode_type'], \
-    geom_field='geom' \
+    geom_field='geom', \
+    where=changed_where \
     )
 geocode_map = {}  # street_address => [geocode rows]
 for geocode_row in geocode_rows:
@@ -100,7 +117,7 @@ for geocode_row in geocode_rows:
     geocode_map[street_address].append(geocode_row)
 
 print('Indexing addresses...')
-address_rows_all = address_table.read()
+address_rows_all = address_table.read(where=changed_where)
 street_map = {}  # street_name => [address rows]
 for address_row in address_rows_all:
     street_name = address_row['street_name']
@@ -295,14 +312,36 @@ if WRITE_OUT:
     address_summary_table.write(summary_rows, chunk_size=100000)
     del summary_rows
 
-    print('Creating indexes...')
-    address_summary_table.create_index('street_address')
+    if not incremental:
+        print('Creating indexes...')
+        address_summary_table.create_index('street_address')
 
-    index_stmt = '''
+        index_stmt = '''
 		CREATE EXTENSION IF NOT EXISTS pg_trgm;
         CREATE INDEX address_summary_opa_owners_trigram_idx ON address_summary USING GIN (opa_owners gin_trgm_ops);
 	'''
-    db.execute(index_stmt)
+        db.execute(index_stmt)
+        db.save()
+
+    # Posting list of address_summary IDs for each owner token, for owner
+    # searches. The IDs don't change after this.
+    print('Indexing owner tokens...')
+    owner_token_table.delete()
+    owner_token_stmt = '''
+        DROP INDEX IF EXISTS owner_token_token_pattern_idx;
+        INSERT INTO owner_token (token, num_addresses, address_ids)
+        SELECT token, count(*), array_agg(id ORDER BY id)
+        FROM (
+            SELECT DISTINCT id, regexp_split_to_table(replace(upper(opa_owners), chr(39), ''), '{separator}') AS token
+            FROM address_summary
+            WHERE opa_owners != ''
+        ) address_token
+        WHERE token != ''
+        GROUP BY token;
+        CREATE INDEX owner_token_token_pattern_idx ON owner_token (token text_pattern_ops);
+        CREATE EXTENSION IF NOT EXISTS fuzzystrmatch;
+    '''.format(separator=OWNER_TOKEN_SEPARATOR)
+    db.execute(owner_token_stmt)
     db.save()
 
     print('Deleting temporary street name index...')
@@ -313,8 +352,8 @@ if WRITE_OUT:
 		update address_summary asm
 		set seg_id = ast.seg_id, seg_side = ast.seg_side
 		from address_street ast
-		where ast.street_address = asm.street_address
-    '''
+		where ast.street_address = asm.street_address {}
+    '''.format('and asm.' + changed_where if incremental else '')
     db.execute(seg_stmt)
     db.save()
 
@@ -323,8 +362,8 @@ if WRITE_OUT:
 	    update address_summary asm
 	    set street_code = sts.street_code
 		from street_segment sts
-		where sts.seg_id = asm.seg_id
-    '''
+		where sts.seg_id = asm.seg_id {}
+    '''.format('and asm.' + changed_where if incremental else '')
     db.execute(stcode_stmt)
     db.save()
 
@@ -333,7 +372,7 @@ if WRITE_OUT:
         with scnulls as (
         select street_address, address_low, address_low_suffix, address_low_frac, street_predir, street_name, street_suffix, street_postdir
         from address_summary asm 
-        where street_code is null and address_high is not null
+        where street_code is null and address_high is not null {}
         )
         update address_summary asm
         set street_code = final.street_code
@@ -346,7 +385,7 @@ if WRITE_OUT:
         group by asm.street_address, asmj.street_code
         )final
         where final.street_address = asm.street_address    
-    '''
+    '''.format('and asm.' + changed_where if incremental else '')
     db.execute(rstcode_stmt)
     db.save()
 
@@ -1,26 +1,18 @@
-import sys
 from datetime import datetime
 from shapely.wkt import loads
 from datetime import datetime
-from copy import deepcopy
 import datum
 from ais import app
+from ais.engine import changes, service_areas
 from ais.models import Address
 
 # DEV
-import traceback
 from pprint import pprint
 
 
 print('Starting...')
 start = datetime.now()
 
-"""
-TODO
-- This might perform better if we do one big spatial join at the beginning
-  between address summary and service area polygons.
-"""
-
 """SET UP"""
 config = app.config
 db = datum.connect(config['DATABASES']['engine'])
@@ -32,32 +24,42 @@ line_dual_table = db['service_area_line_dual']
 point_table = db['service_area_point']
 #sa_summary_table = db['service_area_summary']
 address_summary_table = db['address_summary']
-address_summary_fields = [
-	'street_address',
-	'geocode_x',
-	'geocode_y',
-	# 'seg_id',
-	# 'seg_side',
-]
 sa_summary_fields = [{'name': 'street_address', 'type': 'text'}]
 sa_summary_fields += [{'name': x, 'type': 'text'} for x in sa_layer_ids]
-sa_summary_row_template = {x: '' for x in sa_layer_ids}
 
 # DEV
 WRITE_OUT = True
 
-# Keep poly rows in memory so we make less trips to the database for overlapping
-# points.
-# xy_map = {}  # x => y => [sa_poly_rows]
+print('Checking for changes since the last build...')
+incremental = changes.is_incremental(db)
+changed_sa_tables = changes.changed_tables(db, ['service_area_polygon', 'service_area_line_single',
+												'service_area_line_dual', 'service_area_point'])
+if incremental and changed_sa_tables:
+	print('Summarizing all addresses: {} changed'.format(', '.join(changed_sa_tables)))
+	incremental = False
+# Filters for only updating the changed addresses
+if incremental:
+	print('Summarizing changed addresses only')
+	changed_where = 'street_address in ({})'.format(changes.CHANGED_ADDRESSES_SQL)
+	sas_filter = 'AND sas.' + changed_where
+else:
+	changed_where = None
+	sas_filter = ''
 
 """MAIN"""
 #
-if WRITE_OUT:
+if WRITE_OUT and incremental:
+	print('Deleting service area summary rows of changed addresses...')
+	db.execute('DELETE FROM service_area_summary WHERE {}'.format(changed_where))
+	db.save()
+
+elif WRITE_OUT:
 	print('Dropping service area summary table...')
 	db.drop_table('service_area_summary')
 
 	print('Creating service area summary table...')
 	db.create_table('service_area_summary', sa_summary_fields)
+	db.save()
 
 sa_summary_table = db['service_area_summary']
 
@@ -89,83 +91,13 @@ sa_summary_table = db['service_area_summary']
 # 	line_dual_map[layer_id][seg_id]['left'] = left_value
 # 	line_dual_map[layer_id][seg_id]['right'] = right_value
 
-print('Reading address summary...')
-address_summary_rows = address_summary_table.read(\
-	fields=address_summary_fields, \
-	sort=['geocode_x', 'geocode_y']\
-)
-
-sa_summary_rows = []
-
-# Sort address summary rows by X, Y and use these to compare the last row
-# to the current one. This minimizes trips to the database for poly values.
-last_x = None
-last_y = None
-last_sa_rows = None
-#
 print('Intersecting addresses and service area polygons...')
-for i, address_summary_row in enumerate(address_summary_rows):
-	try:
-		if i % 10000 == 0:
-			print(i)
-
-			# Write in chunks
-			if WRITE_OUT: #and i % 50000 == 0:
-				sa_summary_table.write(sa_summary_rows)
-				sa_summary_rows = []
-
-		# Get attributes
-		street_address = address_summary_row['street_address']
-		# seg_id = address_summary_row['seg_id']
-		# seg_side = address_summary_row['seg_side']
-		x = address_summary_row['geocode_x']
-		y = address_summary_row['geocode_y']
-
-		sa_rows = None
-		# if x in xy_map:
-		# 	y_map = xy_map[x]
-		# 	if y in y_map:
-		# 		sa_rows = y_map[y]
-		if last_x and (last_x == x and last_y == y):
-			sa_rows = last_sa_rows
-
-		if sa_rows is None:
-			# Get intersecting service areas
-			where = 'ST_Intersects(geom, ST_SetSrid(ST_Point({}, {}), 2272))'.format(x, y)
-			sa_rows = poly_table.read(fields=['layer_id', 'value'], where=where, return_geom=False)
-
-			# Add to map
-			# x_map = xy_map[x] = {}
-			# x_map[y] = sa_rows
-
-		# Create and insert summary row
-		sa_summary_row = deepcopy(sa_summary_row_template)
-		sa_summary_row['street_address'] = street_address
-		update_dict = {}
-		for x in sa_rows:
-			if x['layer_id'] != 'zoning_rco':
-				update_dict[x['layer_id']] = x['value']
-			else:
-				update_dict[x['layer_id']] = x['value'] if not x['layer_id'] in update_dict else update_dict[x['layer_id']] + '|' + x['value']
-		sa_summary_row.update(update_dict)
-
-		sa_summary_rows.append(sa_summary_row)
-
-		last_x = x
-		last_y = y
-		last_sa_rows = sa_rows
-
-	except:
-		print(traceback.format_exc())
-		sys.exit()
-
-# Clear out XY map
-# xy_map = {}
-
+polygon_start = datetime.now()
 if WRITE_OUT:
-	print('Writing service area summary rows...')
-	sa_summary_table.write(sa_summary_rows)
-	del sa_summary_rows
+	pg_db = service_areas.connect(config['DATABASES']['engine'])
+	num_sa_summary_rows = service_areas.write_polygon_summary(pg_db, sa_layer_ids, where=changed_where)
+	pg_db.close()
+	print('Wrote {} service area summary rows in {}'.format(num_sa_summary_rows, datetime.now() - polygon_start))
 
 # # Update where method = yes_or_no:
 # for sa_layer_def in sa_layer_defs:
@@ -185,162 +117,51 @@ if WRITE_OUT:
 # 			# print(ais_db.c.rowcount)
 # 			db.save()
 ################################################################################
-# SERVICE AREA LINES
+# SERVICE AREA LINES, POINTS & NEAREST POLYGONS
 ################################################################################
 
 if WRITE_OUT:
-	print('\n** SERVICE AREA LINES ***\n')
-	print('Creating indexes...')
-	sa_summary_table.create_index('street_address')
-
+	print('\n** SERVICE AREA LINES, POINTS & NEAREST POLYGONS ***\n')
 	print('Creating temporary indexes...')
 	address_summary_table.create_index('seg_id')
 
-	for sa_layer_def in sa_layer_defs:
-		layer_id = sa_layer_def['layer_id']
-
-		if 'line_single' in sa_layer_def['sources']:
-			print('Updating from {}...'.format(layer_id))
-			stmt = '''
-				UPDATE service_area_summary sas
-				SET {layer_id} = sals.value
-				FROM address_summary ads, service_area_line_single sals
-				WHERE
-					sas.street_address = ads.street_address AND
-					sals.seg_id = ads.seg_id AND
-					sals.layer_id = '{layer_id}' AND
-					sals.value <> ''
-			'''.format(layer_id=layer_id)
-			db.execute(stmt)
-			# print(ais_db.c.rowcount)
-			db.save()
-
-		elif 'line_dual' in sa_layer_def['sources']:
-			print('Updating from {}...'.format(layer_id))
-			stmt = '''
-				UPDATE service_area_summary sas
-				SET {layer_id} = CASE WHEN (ads.seg_side = 'L') THEN sald.left_value ELSE sald.right_value END
-				FROM address_summary ads, service_area_line_dual sald
-				WHERE sas.street_address = ads.street_address AND
-					sald.seg_id = ads.seg_id AND
-					sald.layer_id = '{layer_id}' AND
-					CASE WHEN (ads.seg_side = 'L') THEN sald.left_value ELSE sald.right_value END <> ''
-			'''.format(layer_id=layer_id)
-			db.execute(stmt)
-			# print(ais_db.c.rowcount)
-			db.save()
+	# Each layer's values go to a staging table, in parallel, and are merged
+	# into the summary at once
+	layer_jobs = service_areas.get_layer_jobs(sa_layer_defs, where=changed_where)
+	sa_workers = config['ENGINE_BUILD']['service_area_workers']
+	print('Finding values of {} layers with {} workers...'.format(len(layer_jobs), sa_workers))
+	layers_start = datetime.now()
+	for layer_id, seconds in service_areas.run_layer_jobs(config['DATABASES']['engine'], layer_jobs, sa_workers):
+		print('  - {} ({:.1f}s)'.format(layer_id, seconds))
+	print('Found layer values in {}'.format(datetime.now() - layers_start))
 
 	print('Dropping temporary index...')
 	address_summary_table.drop_index('seg_id')
 
-#############################################################################
-# SERVICE AREA POINTS
-#############################################################################
-if WRITE_OUT:
-	print('Finding nearest service area point to each address...')
-	for sa_layer_def in sa_layer_defs:
-		layer_id = sa_layer_def['layer_id']
-		if 'point' in sa_layer_def['sources']:
-			method = sa_layer_def['sources']['point'].get('method')
-			if method == 'nearest':
-				print('Updating from {}...'.format(layer_id))
-				stmt = '''
-						with sap_layer as
-						(
-							select sap.*
-							from service_area_point sap
-							where sap.layer_id = '{layer_id}'
-						)
-						update service_area_summary sas
-						set {layer_id} = sapf.value
-						from
-							(
-							select ads.street_address, saplv.value
-							from address_summary ads
-							cross join lateral
-							(
-								select sap_layer.value
-								from sap_layer
-								order by st_setsrid(st_point(ads.geocode_x, ads.geocode_y), 2272) <-> sap_layer.geom limit 1
-							) as saplv
-							) sapf
-						where sas.street_address = sapf.street_address
-					'''.format(layer_id=layer_id)
-				db.execute(stmt)
-				db.save()
+	# Values shown as yes or no are set in the merge too
+	print('Merging layer values into service area summary...')
+	yes_or_no_layer_ids = [x['layer_id'] for x in sa_layer_defs if x.get('value_method') == 'yes_or_no']
+	for stmt in service_areas.get_merge_sql(sa_layer_ids, layer_jobs, yes_or_no_layer_ids, where=changed_where):
+		db.execute(stmt)
+	db.save()
+	service_areas.drop_stage_tables(db, layer_jobs)
 
-			elif method == 'seg_id':
-				print('Updating from {}...'.format(layer_id))
-				stmt = '''
-						UPDATE service_area_summary sas
-						SET {layer_id} = sap.value
-						FROM address_summary ads, service_area_point sap
-						WHERE
-							sas.street_address = ads.street_address AND
-							sap.seg_id = ads.seg_id AND
-							sap.layer_id = '{layer_id}' AND
-							sap.value <> ''
-					'''.format(layer_id=layer_id)
-				db.execute(stmt)
-				db.save()
+	if not incremental:
+		print('Creating indexes...')
+		sa_summary_table = db['service_area_summary']
+		sa_summary_table.create_index('street_address')
 
-#################
-# NEAREST POLY	#
-#################
-if WRITE_OUT:
-	print('Finding nearest service area polygon to each address...')
-	for sa_layer_def in sa_layer_defs:
-		layer_id = sa_layer_def['layer_id']
-		if 'polygon' in sa_layer_def['sources']:
-			method = sa_layer_def['sources']['polygon'].get('method')
-			if method != 'nearest_poly':
-				continue
-			print('Updating from {}...'.format(layer_id))
-			stmt = '''
-					with sap_layer as
-					(
-						select sap.*
-						from service_area_polygon sap
-						where sap.layer_id = '{layer_id}'
-					)
-					update service_area_summary sas
-					set {layer_id} = sapf.value
-					from
-						(
-						select ads.street_address, saplv.value
-						from address_summary ads
-						cross join lateral
-						(
-							select sap_layer.value
-							from sap_layer
-							order by st_setsrid(st_point(ads.geocode_x, ads.geocode_y), 2272) <-> sap_layer.geom limit 1
-						) as saplv
-						) sapf
-					where sas.street_address = sapf.street_address
-				'''.format(layer_id=layer_id)
-			db.execute(stmt)
-			db.save()
-################################
-# Update where method = yes_or_no:
-print("Updating service_area_summary values where method = 'yes_or_no'")
-for sa_layer_def in sa_layer_defs:
-	layer_id = sa_layer_def['layer_id']
-	method = sa_layer_def.get('value_method')
-	if method == 'yes_or_no':
-		stmt = '''
-				UPDATE service_area_summary sas
-				SET {layer_id} = (
-				CASE
-				WHEN {layer_id} != '' THEN 'Yes'
-				ELSE 'No'
-				END);
-				'''.format(layer_id=layer_id)
-		db.execute(stmt)
-		db.save()
 #################################
 # TODO Update address summary zip_code with point-in-poly value where USPS seg-based is Null (parameterize field to update, set in config, and execute in for loop)
 print("Updating null address_summary zip_codes from service_areas...")
-stmt = '''
+zip_stmt = '''
+UPDATE address_summary asum
+SET zip_code = sas.zip_code
+from service_area_summary sas
+where sas.street_address = asum.street_address and (asum.zip_code is Null or asum.zip_code in ('', null)) {}
+'''.format(sas_filter)
+# Updating the changed addresses is quicker with the indexes kept
+stmt = zip_stmt if incremental else '''
 DROP INDEX public.address_summary_opa_owners_trigram_idx;
 DROP INDEX public.address_summary_sort_idx;
 DROP INDEX public.address_summary_street_address_idx;
@@ -349,10 +170,7 @@ DROP INDEX public.ix_address_summary_opa_account_num;
 DROP INDEX public.ix_address_summary_pwd_parcel_id;
 DROP INDEX public.ix_address_summary_seg_id;
 
-UPDATE address_summary asum
-SET zip_code = sas.zip_code
-from service_area_summary sas
-where sas.street_address = asum.street_address and (asum.zip_code is Null or asum.zip_code in ('', null));
+{zip_stmt};
 
 CREATE INDEX ix_address_summary_seg_id
     ON public.address_summary USING btree
@@ -381,11 +199,13 @@ CREATE INDEX ix_address_summary_opa_account_num
 CREATE INDEX ix_address_summary_pwd_parcel_id
     ON public.address_summary USING btree
     (pwd_parcel_id);
-'''
+'''.format(zip_stmt=zip_stmt)
 db.execute(stmt)
 db.save()
 #################################
 # Clean up:
+# The build is done, so the next one can be incremental
+changes.mark_applied(db)
 db.close()
 
 print('Finished in {}'.format(datetime.now() - start))
\ No newline at end of file
@@ -9,7 +9,7 @@ import psycopg2
 # from phladdress.parser import Parser
 from ais import app
 from datum import Database
-from ais.models import StreetIntersection
+from ais.models import StreetIntersection, parser, use_parse_cache
 
 
 print('Starting...')
@@ -18,8 +18,8 @@ start = datetime.now()
 """SET UP"""
 
 config = app.config
+use_parse_cache()
 engine_srid = config['ENGINE_SRID']
-Parser = config['PARSER']
 db = Database(config['DATABASES']['engine'])
 dsn = config['DATABASES']['engine']
 db_user = dsn[dsn.index("//") + 2:dsn.index(":", dsn.index("//"))]
@@ -52,8 +52,6 @@ intersection_table = db[intersection_table_name]
 
 """MAIN"""
 
-parser = Parser()
-
 print('Deleting existing intersections...')
 intersection_table.delete(cascade=True)
 
@@ -0,0 +1,293 @@
+"""
+Set-based service area summaries for make_service_area_summary.
+
+Rather than query the polygons at each address in turn, the service area
+polygons containing every address are found in one statement, which PostGIS
+runs as a single pass over address_summary probing the polygon index. The
+results are streamed back through a server-side cursor, turned into summary
+rows and written with COPY in chunks.
+
+The values from service area lines and points, and from the nearest polygon
+of some layers, are then found for each layer separately and in parallel, each
+into a staging table, and merged into service_area_summary with one UPDATE
+rather than an UPDATE of the whole table per layer.
+"""
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from ais.util import parse_url
+
+# The layers and values of the polygons containing each address, in polygon
+# order. The lateral aggregate gives addresses outside every polygon a row too.
+POLYGON_JOIN_SQL = '''
+    SELECT ads.street_address, sa.layer_ids, sa.values
+    FROM address_summary ads
+    CROSS JOIN LATERAL (
+        SELECT array_agg(sap.layer_id ORDER BY sap.id) AS layer_ids,
+               array_agg(sap.value ORDER BY sap.id) AS values
+        FROM service_area_polygon sap
+        WHERE ST_Intersects(sap.geom, ST_SetSrid(ST_Point(ads.geocode_x, ads.geocode_y), 2272))
+    ) sa
+    {where}
+'''
+
+# Layers whose values are all kept, joined by '|', where polygons overlap.
+# Otherwise the last polygon's value is used.
+MULTI_VALUE_LAYERS = ['zoning_rco']
+
+FETCH_SIZE = 10000
+COPY_CHUNK_SIZE = 50000
+
+
+def connect(db_url):
+    """Open a psycopg2 connection for COPY and server-side cursors."""
+    comps = parse_url(db_url)
+    return psycopg2.connect(host=comps['host'], user=comps['user'], password=comps['password'],
+                            dbname=comps['db_name'])
+
+
+def summarize_polygons(layer_ids, polygon_rows):
+    """
+    Make a service area summary row (street address, then a value for each
+    layer) from each joined address row.
+    """
+    positions = {layer_id: i + 1 for i, layer_id in enumerate(layer_ids)}
+    for street_address, row_layer_ids, values in polygon_rows:
+        summary_row = [street_address] + [''] * len(layer_ids)
+        found = set()
+        for layer_id, value in zip(row_layer_ids or [], values or []):
+            position = positions.get(layer_id)
+            if position is None:
+                continue
+            if layer_id in MULTI_VALUE_LAYERS and layer_id in found:
+                summary_row[position] += '|' + value
+            else:
+                summary_row[position] = value
+            found.add(layer_id)
+        yield summary_row
+
+
+def copy_value(value):
+    """Format a value for COPY's text format."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, table, fields, rows, chunk_size=COPY_CHUNK_SIZE):
+    """COPY rows (sequences of values for `fields`) into a table in chunks. Returns the number of rows."""
+    stmt = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(fields))
+    count = 0
+    chunk = io.StringIO()
+    chunk_count = 0
+    for row in rows:
+        chunk.write('\t'.join(copy_value(value) for value in row) + '\n')
+        chunk_count += 1
+        if chunk_count == chunk_size:
+            chunk.seek(0)
+            cursor.copy_expert(stmt, chunk)
+            count += chunk_count
+            chunk = io.StringIO()
+            chunk_count = 0
+    if chunk_count:
+        chunk.seek(0)
+        cursor.copy_expert(stmt, chunk)
+        count += chunk_count
+    return count
+
+
+def write_polygon_summary(conn, layer_ids, where=None):
+    """
+    Join address_summary to the service area polygons and COPY a summary row
+    for each address into service_area_summary. Returns the number of rows.
+    """
+    read_cursor = conn.cursor(name='service_area_polygon_join')
+    read_cursor.itersize = FETCH_SIZE
+    read_cursor.execute(POLYGON_JOIN_SQL.format(where='WHERE ads.' + where if where else ''))
+    write_cursor = conn.cursor()
+    count = copy_rows(write_cursor, 'service_area_summary', ['street_address'] + layer_ids,
+                      summarize_polygons(layer_ids, read_cursor))
+    read_cursor.close()
+    write_cursor.close()
+    conn.commit()
+    return count
+
+
+# Per-layer updates from lines and points. Each selects the value of one layer
+# for each address it applies to into a staging table; the staging tables are
+# then merged into service_area_summary at once.
+STAGE_TABLE = 'service_area_stage_{layer_id}_{source}'
+
+LINE_SINGLE_SQL = '''
+    SELECT DISTINCT ON (ads.street_address) ads.street_address, sals.value
+    FROM address_summary ads, service_area_line_single sals
+    WHERE
+        sals.seg_id = ads.seg_id AND
+        sals.layer_id = '{layer_id}' AND
+        sals.value <> ''
+        {ads_filter}
+'''
+
+LINE_DUAL_SQL = '''
+    SELECT DISTINCT ON (ads.street_address) ads.street_address,
+        CASE WHEN (ads.seg_side = 'L') THEN sald.left_value ELSE sald.right_value END AS value
+    FROM address_summary ads, service_area_line_dual sald
+    WHERE
+        sald.seg_id = ads.seg_id AND
+        sald.layer_id = '{layer_id}' AND
+        CASE WHEN (ads.seg_side = 'L') THEN sald.left_value ELSE sald.right_value END <> ''
+        {ads_filter}
+'''
+
+POINT_SEG_ID_SQL = '''
+    SELECT DISTINCT ON (ads.street_address) ads.street_address, sap.value
+    FROM address_summary ads, service_area_point sap
+    WHERE
+        sap.seg_id = ads.seg_id AND
+        sap.layer_id = '{layer_id}' AND
+        sap.value <> ''
+        {ads_filter}
+'''
+
+# Nearest point or polygon of a layer
+NEAREST_SQL = '''
+    WITH sa_layer AS
+    (
+        SELECT sa.*
+        FROM {table} sa
+        WHERE sa.layer_id = '{layer_id}'
+    )
+    SELECT ads.street_address, salv.value
+    FROM address_summary ads
+    CROSS JOIN LATERAL
+    (
+        SELECT sa_layer.value
+        FROM sa_layer
+        ORDER BY st_setsrid(st_point(ads.geocode_x, ads.geocode_y), 2272) <-> sa_layer.geom LIMIT 1
+    ) AS salv
+    WHERE TRUE {ads_filter}
+'''
+
+
+def get_layer_jobs(sa_layer_defs, where=None):
+    """
+    Get the (layer ID, staging table, select) of each per-layer update, in the
+    order they take effect: values from later jobs win.
+    """
+    ads_filter = 'AND ads.' + where if where else ''
+    line_jobs = []
+    point_jobs = []
+    nearest_poly_jobs = []
+    for sa_layer_def in sa_layer_defs:
+        layer_id = sa_layer_def['layer_id']
+        sources = sa_layer_def['sources']
+        if 'line_single' in sources:
+            line_jobs.append((layer_id, 'line_single', LINE_SINGLE_SQL))
+        elif 'line_dual' in sources:
+            line_jobs.append((layer_id, 'line_dual', LINE_DUAL_SQL))
+        if 'point' in sources:
+            method = sources['point'].get('method')
+            if method == 'nearest':
+                point_jobs.append((layer_id, 'point', NEAREST_SQL.replace('{table}', 'service_area_point')))
+            elif method == 'seg_id':
+                point_jobs.append((layer_id, 'point', POINT_SEG_ID_SQL))
+        if 'polygon' in sources and sources['polygon'].get('method') == 'nearest_poly':
+            nearest_poly_jobs.append((layer_id, 'nearest_poly',
+                                      NEAREST_SQL.replace('{table}', 'service_area_polygon')))
+
+    return [(layer_id, STAGE_TABLE.format(layer_id=layer_id, source=source),
+             stmt.format(layer_id=layer_id, ads_filter=ads_filter))
+            for layer_id, source, stmt in line_jobs + point_jobs + nearest_poly_jobs]
+
+
+def run_layer_job(pool, stage_table, select):
+    """Select a layer's values into its staging table. Returns how long it took."""
+    start = time.time()
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS {}'.format(stage_table))
+            cursor.execute('CREATE UNLOGGED TABLE {} AS {}'.format(stage_table, select))
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+    return time.time() - start
+
+
+def run_layer_jobs(db_url, jobs, workers):
+    """
+    Run the per-layer jobs, `workers` at a time, each on its own connection.
+    Yields each job's layer ID and seconds taken as it finishes.
+    """
+    comps = parse_url(db_url)
+    pool = ThreadedConnectionPool(1, max(workers, 1), host=comps['host'], user=comps['user'],
+                                  password=comps['password'], dbname=comps['db_name'])
+    try:
+        with ThreadPoolExecutor(max(workers, 1)) as executor:
+            futures = {executor.submit(run_layer_job, pool, stage_table, select): layer_id
+                       for layer_id, stage_table, select in jobs}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+    finally:
+        pool.closeall()
+
+
+def get_merged_columns(layer_ids, jobs, yes_or_no_layer_ids):
+    """
+    Get the merged value of each layer that jobs update or that is shown as
+    yes or no, as SQL expressions over service_area_summary sas and the
+    staging tables (aliased by position in `jobs`). Returns the joins and
+    (layer ID, expression) pairs.
+    """
+    joins = []
+    layer_cases = {}
+    for i, (layer_id, stage_table, select) in enumerate(jobs):
+        alias = 'stage_{}'.format(i)
+        joins.append('LEFT JOIN {stage_table} {alias} ON {alias}.street_address = sas.street_address'
+                     .format(stage_table=stage_table, alias=alias))
+        # Later jobs win
+        layer_cases.setdefault(layer_id, []).insert(
+            0, 'WHEN {alias}.street_address IS NOT NULL THEN {alias}.value'.format(alias=alias))
+
+    columns = []
+    for layer_id in layer_ids:
+        if layer_id not in layer_cases and layer_id not in yes_or_no_layer_ids:
+            continue
+        value = 'sas.{}'.format(layer_id)
+        if layer_id in layer_cases:
+            value = 'CASE {} ELSE {} END'.format(' '.join(layer_cases[layer_id]), value)
+        if layer_id in yes_or_no_layer_ids:
+            value = "CASE WHEN {} != '' THEN 'Yes' ELSE 'No' END".format(value)
+        columns.append((layer_id, value))
+    return joins, columns
+
+
+def get_merge_sql(layer_ids, jobs, yes_or_no_layer_ids, where=None):
+    """
+    Get statements merging the staging tables into service_area_summary. The
+    rows (all of them, or those matching `where`) are updated in place so the
+    table keeps its primary key, indexes and storage settings.
+    """
+    joins, columns = get_merged_columns(layer_ids, jobs, yes_or_no_layer_ids)
+    if not columns:
+        return []
+    return ['''
+        UPDATE service_area_summary sas_update
+        SET {set_columns}
+        FROM (
+            SELECT sas.street_address, {select_columns}
+            FROM service_area_summary sas {joins}
+            {where}
+        ) merged
+        WHERE merged.street_address = sas_update.street_address
+    '''.format(set_columns=', '.join('{0} = merged.{0}'.format(layer_id) for layer_id, value in columns),
+               select_columns=', '.join('{} AS {}'.format(value, layer_id) for layer_id, value in columns),
+               joins=' '.join(joins), where='WHERE sas.' + where if where else '')]
+
+
+def drop_stage_tables(db, jobs):
+    for layer_id, stage_table, select in jobs:
+        db.execute('DROP TABLE IF EXISTS {}'.format(stage_table))
+    db.save()
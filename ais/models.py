@@ -3,7 +3,8 @@ import re
 from flask.ext.sqlalchemy import BaseQuery
 from geoalchemy2.types import Geometry
 from geoalchemy2.functions import ST_Transform, ST_X, ST_Y
-from sqlalchemy import func, and_, or_, cast, String, Integer, desc, distinct
+from sqlalchemy import func, or_, cast, case, String, Integer, desc, distinct
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import aliased
 from sqlalchemy.exc import NoSuchTableError
 from ais import app, app_db as db
@@ -11,10 +12,31 @@ from ais.util import *
 #from pprint import pprint
 
 Parser = app.config['PARSER']
-parser = Parser()
 config = app.config
+# One parser per worker, shared by the models, the API views and the engine
+# scripts. Engine scripts read it through the persistent parse cache (see
+# use_parse_cache); API workers don't, so requests never wait on its file.
+parser = CachedParser(Parser(), maxsize=config['PARSER_CACHE_SIZE'])
+
+def use_parse_cache():
+    """
+    Read the shared parser through the persistent parse cache for the rest of
+    this process. For engine scripts only. Returns the cache, or None if it's
+    off.
+    """
+    if not isinstance(parser.parser, PersistentParseCache):
+        parser.parser = make_parse_cache(parser.parser, config['PARSE_CACHE'])
+    return parser.parser if isinstance(parser.parser, PersistentParseCache) else None
+
 ENGINE_SRID = config['ENGINE_SRID']
+# Unit types that match each other in address queries
+SYNONYMOUS_UNIT_TYPES = ('APT', 'UNIT', '#', 'STE')
 default_SRID = 4326
+# Preferred geocode types, in order, for the on_street and on_curb request args
+GEOCODE_TYPES_ON_STREET = tuple(config['ADDRESS_SUMMARY']['geocode_priority'][geocode_type]
+                                for geocode_type in ('pwd_street', 'dor_street', 'true_range'))
+GEOCODE_TYPES_ON_CURB = tuple(config['ADDRESS_SUMMARY']['geocode_priority'][geocode_type]
+                              for geocode_type in ('pwd_curb', 'dor_curb', 'true_range'))
 # OWNER_RESPONSE_LIMIT = config['OWNER_RESPONSE_LIMIT']
 # OWNER_PARTS_THRESHOLD = config['OWNER_PARTS_THRESHOLD']
 ###########
@@ -555,6 +577,8 @@ class SourceAddress(db.Model):
     source_name = db.Column(db.Text)
     source_address = db.Column(db.Text)
     street_address = db.Column(db.Text)
+    # Fingerprint of the source row (see ais.engine.changes)
+    fingerprint = db.Column(db.Text)
 
 class AddressLinkQuery(BaseQuery):
     """A query class that knows how to query address links"""
@@ -871,10 +895,9 @@ class AddressSummaryQuery(BaseQuery):
         #if not unit_type or unit_type == '':
             return self
 
-        synonymous_unit_types = ('APT', 'UNIT', '#', 'STE')
-        if unit_type in synonymous_unit_types:
+        if unit_type in SYNONYMOUS_UNIT_TYPES:
             return self.filter(
-                AddressSummary.unit_type.in_(synonymous_unit_types))
+                AddressSummary.unit_type.in_(SYNONYMOUS_UNIT_TYPES))
         else:
             return self.filter_by(unit_type=unit_type)
 
@@ -1010,133 +1033,104 @@ class AddressSummaryQuery(BaseQuery):
         else:
             return self
 
+    def join_best_geocode(self, preferred_types=(), srid=default_SRID):
+        """
+        Join each address to its single best geocode. Geocode types listed in
+        `preferred_types` win in the order given; otherwise (or if an address
+        has none of them) the lowest geocode_type is used, which is the
+        default priority. The choice is made per address in SQL with a
+        DISTINCT ON, so this adds no round trips of its own.
+        """
+        address_subq = self.with_entities(AddressSummary.street_address).subquery()
+
+        priority = [Geocode.street_address]
+        if preferred_types:
+            priority.append(case(
+                [(Geocode.geocode_type == geocode_type, i)
+                 for i, geocode_type in enumerate(preferred_types)],
+                else_=len(preferred_types)))
+        priority.append(Geocode.geocode_type)
+
+        best_geocode = db.session.query(
+            Geocode.street_address, Geocode.geocode_type, Geocode.geom) \
+            .filter(Geocode.street_address.in_(address_subq)) \
+            .order_by(*priority) \
+            .distinct(Geocode.street_address) \
+            .subquery()
+
+        return self \
+            .join(best_geocode, best_geocode.c.street_address == AddressSummary.street_address) \
+            .add_columns(best_geocode.c.geocode_type, ST_Transform(best_geocode.c.geom, srid))
+
     def get_all_parcel_geocode_locations(self, srid=default_SRID, request=None):
 
-        geocode_xy_join = self \
+        return self \
             .outerjoin(Geocode, Geocode.street_address == AddressSummary.street_address) \
             .add_columns(Geocode.geocode_type, ST_Transform(Geocode.geom, srid)) \
             .order_by(Geocode.geocode_type)
 
-        # If geom exists for geocode_type specified in request.args, return, else return default best geocode type
-        if geocode_xy_join.first():
-            return geocode_xy_join
-        else:
-            # If geom doesn't exist for geocode_type specified in request.arg (or if specified geocode_type doesn't exist),
-            # return result of query without flag (set i=1 so all geocode_location flags are ignored)
-            return self.get_address_geoms(request=request, i=1)
-
     def get_parcel_geocode_location(self, parcel_geocode_location=None, srid=default_SRID, request=None):
-        if self.first():
-            # If request arg parcel_geocode_location is included (and if on_street arg is not),
-            # get address geom_data from geocode table where geocode_type = value specified in request arg.
-            # parcel_geocode_location_val = str(request.args.get('parcel_geocode_location'))
-            #if parcel_geocode_location == 'all':
-            if 'parcel_geocode_location' in request.args and parcel_geocode_location in ('', 'all'):
-                return self.get_all_parcel_geocode_locations(srid=srid, request=request)
-
-            parcel_geocode_location_val = config['ADDRESS_SUMMARY']['geocode_priority'][str(parcel_geocode_location)]
-
-            geocode_xy_join = self \
-                .outerjoin(Geocode, Geocode.street_address==AddressSummary.street_address) \
-                .filter(Geocode.geocode_type == parcel_geocode_location_val) \
-                .add_columns(Geocode.geocode_type, ST_Transform(Geocode.geom, srid))
-
-            # If geom exists for geocode_type specified in request.args, return, else return default best geocode type
-            if geocode_xy_join.first():
-                return geocode_xy_join
-            else:
-                # If geom doesn't exist for geocode_type specified in request.arg (or if specified geocode_type doesn't exist),
-                # return result of query without flag (set i=1 so all geocode_location flags are ignored)
-                return self.get_address_geoms(request=request, i=1)
-
-        else:
-            return self
+        # If request arg parcel_geocode_location is included (and if on_street arg is not),
+        # get address geom_data from geocode table where geocode_type = value specified in request arg.
+        if 'parcel_geocode_location' in request.args and parcel_geocode_location in ('', 'all'):
+            return self.get_all_parcel_geocode_locations(srid=srid, request=request)
 
+        # If the requested geocode_type doesn't exist (or an address doesn't have a geom for it),
+        # fall back to the default best geocode type
+        parcel_geocode_location_val = config['ADDRESS_SUMMARY']['geocode_priority'].get(str(parcel_geocode_location))
+        preferred_types = (parcel_geocode_location_val,) if parcel_geocode_location_val else ()
+        return self.join_best_geocode(preferred_types=preferred_types, srid=srid)
 
     def get_parcel_geocode_on_street(self, on_street=True, srid=default_SRID, request=None):
         # If request arg "on_street" is included, get address geom_data from geocode table where
         # highest available priority geocode_types_on_street is selected
-        if self.first() and on_street and request.args['on_street'].lower() != 'false':
-
-            geocode_xy_join = self \
-                .outerjoin(Geocode, Geocode.street_address == AddressSummary.street_address)
-
-            for geocode_type in [3,4,5]:
-
-                on_street_xy_row = geocode_xy_join \
-                    .filter(Geocode.geocode_type == geocode_type) \
-                    .add_columns(Geocode.geocode_type, ST_Transform(Geocode.geom, srid))
-
-                if on_street_xy_row.first():
-                    return on_street_xy_row
-                    break
-            # if cannot get on_street geocode_type, return self
-            return self.get_address_geoms(request=request, i=1)
-
-        else:
-            # call get_address_geoms but skip get_parcel_geocode_on_street method by setting i=1:
-            return self.get_address_geoms(request=request, i=1)
+        preferred_types = GEOCODE_TYPES_ON_STREET if on_street and request.args['on_street'].lower() != 'false' else ()
+        return self.join_best_geocode(preferred_types=preferred_types, srid=srid)
 
     def get_parcel_geocode_on_curb(self, on_curb=True, srid=default_SRID, request=None):
         # If request arg "on_curb" is included, get address geom_data from geocode table where
-        # highest available priority geocode_types_on_street is selected
-        if self.first() and on_curb and request.args['on_curb'].lower() != 'false':
-            
-            geocode_xy_join = self \
-                .outerjoin(Geocode, Geocode.street_address == AddressSummary.street_address)
-
-            for geocode_type in [7,8,5]:
-
-                on_curb_xy_row = geocode_xy_join \
-                    .filter(Geocode.geocode_type == geocode_type) \
-                    .add_columns(Geocode.geocode_type, ST_Transform(Geocode.geom, srid))
-
-                if on_curb_xy_row.first():
-
-                    return on_curb_xy_row
-                    break
-            # if cannot get on_curb geocode_type, return self
-            return self.get_address_geoms(request=request, i=1)
-
-        else:
-            # call get_address_geoms but skip get_parcel_geocode_on_curb method by setting i=1:
-            return self.get_address_geoms(request=request, i=1)
+        # highest available priority geocode_types_on_curb is selected
+        preferred_types = GEOCODE_TYPES_ON_CURB if on_curb and request.args['on_curb'].lower() != 'false' else ()
+        return self.join_best_geocode(preferred_types=preferred_types, srid=srid)
 
     def get_address_geoms(self, request=None, i=0):
 
-        if self.first():
-
-            srid = request.args.get('srid') if 'srid' in request.args else default_SRID
+        srid = request.args.get('srid') if 'srid' in request.args else default_SRID
 
-            if 'parcel_geocode_location' in request.args and i==0:
-                parcel_geocode_location = request.args.get('parcel_geocode_location')
-                return self.get_parcel_geocode_location(parcel_geocode_location=parcel_geocode_location, srid=srid, request=request)
+        if 'parcel_geocode_location' in request.args and i==0:
+            parcel_geocode_location = request.args.get('parcel_geocode_location')
+            return self.get_parcel_geocode_location(parcel_geocode_location=parcel_geocode_location, srid=srid, request=request)
 
-            elif 'on_street' in request.args and request.args['on_street'].lower() != 'false' and i==0:
-                return self.get_parcel_geocode_on_street(on_street=True, srid=srid, request=request)
+        elif 'on_street' in request.args and request.args['on_street'].lower() != 'false' and i==0:
+            return self.get_parcel_geocode_on_street(on_street=True, srid=srid, request=request)
 
-            elif 'on_curb' in request.args and request.args['on_curb'].lower() != 'false' and i==0:
-                return self.get_parcel_geocode_on_curb(on_curb=True, srid=srid, request=request)
+        elif 'on_curb' in request.args and request.args['on_curb'].lower() != 'false' and i==0:
+            return self.get_parcel_geocode_on_curb(on_curb=True, srid=srid, request=request)
 
-            stmt = self.with_entities(AddressSummary.street_address.label('street_address')).subquery()
-            add_subq = aliased(AddressSummary, stmt)
+        return self.join_best_geocode(srid=srid)
 
-            geo_subq = db.session.query(
-                Geocode.street_address, func.min(Geocode.geocode_type).label('geocode_type'))  \
-                .filter(Geocode.street_address == add_subq.street_address) \
-                .group_by(Geocode.street_address) \
-                .subquery()
 
-            geocode_xy_join = self \
-                .join(geo_subq, geo_subq.c.street_address == AddressSummary.street_address)\
-                .add_columns(geo_subq.c.geocode_type)\
-                .join(Geocode, and_(Geocode.street_address == AddressSummary.street_address, Geocode.geocode_type == geo_subq.c.geocode_type)) \
-                .add_columns(ST_Transform(Geocode.geom, srid))
+class OwnerToken(db.Model):
+    """
+    A token of the OPA owner names in address_summary (see owner_tokens), with
+    the IDs of the address_summary rows having it, in order. Built by
+    make_address_summary for owner searches.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.Text, unique=True)
+    num_addresses = db.Column(db.Integer)
+    address_ids = db.Column(ARRAY(db.Integer))
 
-            return geocode_xy_join
 
-        else:
-            return self
+class EngineState(db.Model):
+    """
+    What the engine build needs to remember between builds to rebuild
+    incrementally: table fingerprints and how far the last build got (see
+    ais.engine.changes).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.Text, unique=True)
+    value = db.Column(db.Text)
 
 
 try:
@@ -1264,6 +1258,23 @@ class AddressSummary(db.Model):
                 return g
         return None
 
+# Key order for cursor pagination over address_summary. Follows the columns of
+# address_summary_sort_idx, with street_address (unique per address) as a
+# tiebreaker.
+ADDRESS_SUMMARY_KEYSET_COLUMNS = (
+    AddressSummary.street_name,
+    AddressSummary.street_suffix,
+    AddressSummary.street_predir,
+    AddressSummary.street_postdir,
+    AddressSummary.address_low,
+    AddressSummary.address_high,
+    AddressSummary.unit_num,
+    AddressSummary.street_address,
+)
+# With parcel_geocode_location=all an address has a row for each of its
+# geocodes, so the geocode type breaks ties between them.
+ADDRESS_SUMMARY_GEOCODE_KEYSET_COLUMNS = ADDRESS_SUMMARY_KEYSET_COLUMNS + (Geocode.geocode_type,)
+
 ######################
 # ERRORS / REPORTING #
 ######################
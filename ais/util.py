@@ -1,4 +1,14 @@
 # from functools import partial
+import atexit
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from copy import deepcopy
 from six.moves.urllib.parse import urlparse
 # import pyproj
 # from shapely.wkt import loads as shp_loads, dumps as shp_dumps
@@ -20,6 +30,15 @@ def parity_for_range(low, high):
         return parity_low
     return 'B'
 
+# Owner names are indexed and searched by token: runs of letters and digits,
+# with apostrophes dropped (O'BRIEN => OBRIEN). make_address_summary splits
+# owners on the same pattern in SQL.
+OWNER_TOKEN_SEPARATOR = '[^A-Z0-9]+'
+
+def owner_tokens(owners):
+    """Split owner names (or an owner search) into tokens."""
+    return [token for token in re.split(OWNER_TOKEN_SEPARATOR, owners.upper().replace("'", '')) if token]
+
 # def dbl_quote(text):
 #     """Place double quotes around a string."""
 #     return '"{}"'.format(text)
@@ -79,22 +98,285 @@ class NotNoneDict (FilteredDict):
         super().__init__(not_none, *args, **kwargs)
 
 
+class CachedParser:
+    """
+    Wraps an address parser with a bounded LRU cache of parse results keyed by
+    the raw input string. Results are deep-copied on the way out, so callers
+    are free to mutate what they get back. Hit and miss counts are kept so the
+    cache can be sized; see `cache_info`.
+    """
+    def __init__(self, parser, maxsize=10000):
+        self.parser = parser
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, raw):
+        with self._lock:
+            result = self._cache.get(raw)
+            if result is not None:
+                self._cache.move_to_end(raw)
+                self.hits += 1
+
+        if result is None:
+            # Parse errors propagate to the caller and are not cached
+            result = self.parser.parse(raw)
+            with self._lock:
+                self.misses += 1
+                self._cache[raw] = result
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        return deepcopy(result)
+
+    def cache_info(self):
+        return OrderedDict([
+            ('hits', self.hits),
+            ('misses', self.misses),
+            ('maxsize', self.maxsize),
+            ('currsize', len(self._cache)),
+        ])
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class PersistentParseCache:
+    """
+    Wraps an address parser with an on-disk cache of parse results, in a SQLite
+    file shared by every process that uses the same path. Results are keyed by
+    the raw input string and the parser version, so upgrading the parser starts
+    a fresh cache. New results are written in batches of `batch_size` and when
+    the process exits.
+
+    The cache is best effort: if the file can't be opened or written (another
+    process holding the lock too long, say), parsing carries on without it.
+    """
+    GET_CHUNK_SIZE = 500
+
+    def __init__(self, parser, path, version, batch_size=1000):
+        self.parser = parser
+        self.path = path
+        self.version = version
+        self.batch_size = batch_size
+        self._pending = OrderedDict()  # raw => result not yet written
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _connect(self):
+        # Connections can't be shared with forked processes
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+        self._conn = None
+        try:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS parse_result (
+                    raw TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    result BLOB NOT NULL,
+                    PRIMARY KEY (raw, version)
+                )
+            ''')
+            conn.commit()
+        except sqlite3.Error:
+            return None
+        self._conn = conn
+        self._pid = os.getpid()
+        return conn
+
+    def get_many(self, raws):
+        """Get the cached results of any of the raw strings, keyed by string."""
+        results = {}
+        with self._lock:
+            for raw in raws:
+                if raw in self._pending:
+                    results[raw] = deepcopy(self._pending[raw])
+            conn = self._connect()
+            if conn is None:
+                return results
+            raws = [raw for raw in raws if raw not in results]
+            try:
+                for i in range(0, len(raws), self.GET_CHUNK_SIZE):
+                    chunk = raws[i:i + self.GET_CHUNK_SIZE]
+                    rows = conn.execute(
+                        'SELECT raw, result FROM parse_result WHERE version = ? AND raw IN ({})'
+                            .format(', '.join('?' * len(chunk))),
+                        [self.version] + chunk)
+                    results.update((raw, pickle.loads(result)) for raw, result in rows)
+            except sqlite3.Error:
+                pass
+        return results
+
+    def put_many(self, results):
+        """Cache (raw string, result) pairs."""
+        with self._lock:
+            for raw, result in results:
+                self._pending[raw] = result
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        pending, self._pending = self._pending, OrderedDict()
+        conn = self._connect()
+        if conn is None or not pending:
+            return
+        try:
+            conn.executemany('INSERT OR REPLACE INTO parse_result (raw, version, result) VALUES (?, ?, ?)',
+                             ((raw, self.version, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+                              for raw, result in pending.items()))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+
+    def parse(self, raw):
+        result = self.get_many([raw]).get(raw)
+        if result is None:
+            # Parse errors propagate to the caller and are not cached
+            result = self.parser.parse(raw)
+            self.put_many([(raw, deepcopy(result))])
+        return result
+
+
+def get_package_data_fingerprint(package):
+    """
+    Fingerprint the data files installed with a package (anything but Python
+    sources) by their paths, sizes and modification times, or None if the
+    package can't be found.
+    """
+    module = sys.modules.get(package)
+    if module is None or not getattr(module, '__file__', None):
+        return None
+    root = os.path.dirname(os.path.abspath(module.__file__))
+    digest = hashlib.sha1()
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(name for name in dir_names if name != '__pycache__')
+        for file_name in sorted(file_names):
+            if file_name.endswith(('.py', '.pyc', '.pyo')):
+                continue
+            path = os.path.join(dir_path, file_name)
+            stat = os.stat(path)
+            digest.update('{}\0{}\0{}\n'.format(os.path.relpath(path, root), stat.st_size,
+                                                   stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:16]
+
+
+def get_parser_version(parser):
+    """
+    Get the version of the parser's results: the installed version of the
+    package it comes from and a fingerprint of that package's data files
+    (street centerlines, zip codes, etc., which are refreshed between builds
+    without a new release), or None if the version can't be told.
+    """
+    package = type(parser).__module__.split('.')[0]
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution(package).version
+    except Exception:
+        version = getattr(sys.modules.get(package), '__version__', None)
+    if version is None:
+        return None
+    fingerprint = get_package_data_fingerprint(package)
+    return '{}+data.{}'.format(version, fingerprint) if fingerprint else version
+
+
+def make_parse_cache(parser, cache_config):
+    """
+    Wrap a parser with the persistent parse cache described by PARSE_CACHE, or
+    return it as is if the cache is off or the parser's version is unknown.
+    """
+    version = cache_config['parser_version'] or get_parser_version(parser)
+    if not cache_config['enabled'] or version is None:
+        return parser
+    return PersistentParseCache(parser, cache_config['path'], version)
+
+
+# Coordinate transformers are expensive to build (each one loads two proj
+# definitions), so build them once per process and key them by SRID pair.
+_transformers = {}
+
+def get_transformer(from_srid, to_srid):
+    """
+    Returns a function that projects x and y coordinates from one SRID to
+    another. The function accepts scalars or equal-length sequences, so a whole
+    batch of points can be projected in a single call.
+    """
+    key = (int(from_srid), int(to_srid))
+    transformer = _transformers.get(key)
+    if transformer is None:
+        from functools import partial
+        import pyproj
+
+        if key[0] == key[1]:
+            transformer = lambda x, y, z=None: (x, y) if z is None else (x, y, z)
+        else:
+            transformer = partial(
+                pyproj.transform,
+                # source coordinate system; preserve_units so that pyproj does
+                # not assume meters
+                pyproj.Proj(init='epsg:{}'.format(key[0]), preserve_units=True),
+                # destination coordinate system
+                pyproj.Proj(init='epsg:{}'.format(key[1]), preserve_units=True))
+        _transformers[key] = transformer
+    return transformer
+
+
 def project_shape(shape, from_srid, to_srid):
-    from functools import partial
-    import pyproj
     from shapely.ops import transform
 
-    project = partial(
-        pyproj.transform,
-        # source coordinate system; preserve_units so that pyproj does not
-        # assume meters
-        pyproj.Proj(init='epsg:{}'.format(from_srid), preserve_units=True),
-        # destination coordinate system
-        pyproj.Proj(init='epsg:{}'.format(to_srid), preserve_units=True))
-
+    project = get_transformer(from_srid, to_srid)
     return transform(project, shape)
 
 
+def project_points(points, from_srid, to_srid):
+    """
+    Projects a sequence of (x, y) tuples in one vectorized call and returns a
+    list of projected (x, y) tuples in the same order.
+    """
+    points = list(points)
+    if not points:
+        return []
+    project = get_transformer(from_srid, to_srid)
+    xs, ys = project([p[0] for p in points], [p[1] for p in points])
+    return list(zip(xs, ys))
+
+
+def project_shapes(shapes, from_srid, to_srid):
+    """
+    Projects a sequence of shapes. Points (the common case for a page of
+    geocoded features) are batched into a single call to the transformer;
+    anything else falls back to projecting shape by shape. `None` values are
+    passed through.
+    """
+    from shapely.geometry import Point as ShpPoint
+
+    shapes = list(shapes)
+    point_idxs = [i for i, shape in enumerate(shapes)
+                  if isinstance(shape, ShpPoint) and not shape.is_empty]
+    projected = project_points([(shapes[i].x, shapes[i].y) for i in point_idxs],
+                               from_srid, to_srid)
+
+    results = [None] * len(shapes)
+    for i, xy in zip(point_idxs, projected):
+        results[i] = ShpPoint(xy)
+    for i, shape in enumerate(shapes):
+        if results[i] is None and shape is not None:
+            results[i] = project_shape(shape, from_srid, to_srid)
+    return results
+
+
 def geom_to_shape(geom, from_srid, to_srid):
     from geoalchemy2.shape import to_shape
     shape = to_shape(geom)
@@ -102,6 +384,18 @@ def geom_to_shape(geom, from_srid, to_srid):
 	#return project_shape(shape, from_srid, to_srid)
 
 
+def get_strtree_position(hit, tree_positions):
+    """
+    Get the position, among the geometries an STRtree was built from, of a
+    geometry the tree returned. Shapely 2 returns positions, earlier versions
+    the geometries themselves, which are looked up in `tree_positions`
+    (id(geometry) => position).
+    """
+    if hasattr(hit, 'geom_type'):
+        return tree_positions[id(hit)]
+    return int(hit)
+
+
 def interpolate_buffered(line, distance_ratio, _buffer):
 	'''
 	Interpolate along a line with a buffer at both ends.
@@ -1,5 +1,6 @@
 import os
 import re
+from collections import OrderedDict
 
 SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
 if 'SQLALCHEMY_POOL_SIZE' in os.environ:
@@ -11,6 +12,21 @@ SQLALCHEMY_ECHO = (os.environ.get('SQLALCHEMY_ECHO', 'False').title() == 'True')
 
 from passyunk.parser import PassyunkParser
 PARSER = PassyunkParser
+# Max number of parse results to keep in each API worker's LRU cache
+PARSER_CACHE_SIZE = int(os.environ.get('PARSER_CACHE_SIZE', 10000))
+# Each API worker logs its parse cache hits and misses at most this often, in
+# seconds, for sizing the cache (0 for never)
+PARSER_CACHE_LOG_INTERVAL = int(os.environ.get('PARSER_CACHE_LOG_INTERVAL', 3600))
+# Parse results kept on disk for the engine scripts (not the API), keyed by
+# the raw string and parser version (see ais.util.PersistentParseCache). The
+# parser version defaults to the installed parser package's, plus a fingerprint
+# of its data files, so refreshed parser data starts a fresh cache.
+PARSE_CACHE = {
+    'enabled':          (os.environ.get('PARSE_CACHE_ENABLED', 'True').title() == 'True'),
+    'path':             os.environ.get('PARSE_CACHE_PATH',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ais', 'engine', 'parse_cache.sqlite')),
+    'parser_version':   os.environ.get('PARSE_CACHE_PARSER_VERSION'),
+}
 
 DATABASES = {
     # these are set in instance config or environment variables
@@ -24,10 +40,123 @@ ENGINE_SRID = 2272
 DEFAULT_API_SRID = 4326
 DEFAULT_SEARCH_RADIUS = 300
 MAXIMUM_SEARCH_RADIUS = 10000
+# Server-side cache of rendered responses, off by default. Backend is 'lru'
+# (in-process, per worker), 'redis' (shared between workers) or empty to
+# disable. The redis backend relies on the server's maxmemory policy for size
+# eviction. With 'lru' on several hosts, PROMOTION_STAMP_FILE must be shared by
+# them (or promote run on each) for promotion to flush every host's cache.
+RESPONSE_CACHE = {
+    'backend':          os.environ.get('RESPONSE_CACHE_BACKEND', ''),
+    'max_entries':      int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 5000)),
+    'ttl':              int(os.environ.get('RESPONSE_CACHE_TTL', 3600)),
+    'redis_url':        os.environ.get('RESPONSE_CACHE_REDIS_URL', 'redis://localhost:6379/0'),
+    # Request args that change a response (besides being echoed back in it)
+    'key_args':         ('srid', 'include_units', 'opa_only', 'on_street', 'on_curb',
+                         'parcel_geocode_location', 'page', 'source_details',
+                         'estimate', 'search_radius', 'cursor', 'page_size', 'format',
+                         'limit'),
+}
 OWNER_RESPONSE_LIMIT = 999
+# Owner searches match owner name tokens (see owner_search.py): equal tokens,
+# tokens they're a prefix of if `prefix`, and tokens within `max_typos` edits
+# for parts of at least `typo_min_length` characters. At most `max_candidates`
+# matches are ranked.
+OWNER_SEARCH = {
+    'prefix':           (os.environ.get('OWNER_SEARCH_PREFIX', 'True').title() == 'True'),
+    'max_typos':        int(os.environ.get('OWNER_SEARCH_MAX_TYPOS', 0)),
+    'typo_min_length':  int(os.environ.get('OWNER_SEARCH_TYPO_MIN_LENGTH', 5)),
+    'max_candidates':   int(os.environ.get('OWNER_SEARCH_MAX_CANDIDATES', 5000)),
+}
+# Max number of queries in one request to /batch/addresses
+BATCH_MAX_QUERIES = int(os.environ.get('BATCH_MAX_QUERIES', 1000))
+# Encoder for JSON responses: 'auto' (ujson if installed, else json), 'ujson' or 'json'
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+# Largest page a bulk consumer can ask for with `page_size`
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 10000))
+# Number of rows fetched and serialized at a time in streamed responses
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 500))
+# `ais api promote` touches this file; each worker runs its promotion hooks
+# (cache flushes, index reloads) when it sees it change. Workers only see the
+# file on their own host, so with several hosts put it on shared storage.
+PROMOTION_STAMP_FILE = os.environ.get('PROMOTION_STAMP_FILE', '/tmp/ais-promotion-stamp')
+PROMOTION_CHECK_INTERVAL = int(os.environ.get('PROMOTION_CHECK_INTERVAL', 10))
+# In-memory index of street segments, true ranges and service area polygons,
+# used to estimate unmatched addresses without querying. Loaded per worker;
+# skipped (falling back to queries) if it would exceed max_memory_mb.
+SEGMENT_INDEX = {
+    'enabled':          (os.environ.get('SEGMENT_INDEX_ENABLED', 'False').title() == 'True'),
+    'max_memory_mb':    int(os.environ.get('SEGMENT_INDEX_MAX_MEMORY_MB', 512)),
+}
+# In-memory KD-tree of the curb and true range geocode points, used to find
+# the addresses nearest a point in /reverse_geocode without querying. Loaded
+# and budgeted like SEGMENT_INDEX.
+REVERSE_GEOCODE_INDEX = {
+    'enabled':          (os.environ.get('REVERSE_GEOCODE_INDEX_ENABLED', 'False').title() == 'True'),
+    'max_memory_mb':    int(os.environ.get('REVERSE_GEOCODE_INDEX_MAX_MEMORY_MB', 256)),
+}
+# Most addresses /reverse_geocode returns with `limit`
+REVERSE_GEOCODE_MAX_LIMIT = int(os.environ.get('REVERSE_GEOCODE_MAX_LIMIT', 100))
 OWNER_PARTS_THRESHOLD = 10
 VALID_ADDRESS_LOW_SUFFIXES = ('F', 'R', 'A', 'S', 'M', 'P', 'G', 'B', 'C', 'D', 'L', 'Q', '2')
 
+# Engine build stages (engine scripts), with the stages each one depends on and
+# the tables it writes. `ais engine run all` starts each stage once the stages
+# it depends on have finished, running up to ENGINE_BUILD['workers'] at a time;
+# with one worker they run in this order.
+ENGINE_STAGES = OrderedDict([
+    ('load_streets',                    {'depends_on': [],
+                                         'tables': ['street_segment']}),
+    ('load_street_aliases',             {'depends_on': [],
+                                         'tables': ['street_alias']}),
+    ('make_street_intersections',       {'depends_on': [],
+                                         'tables': ['street_intersection']}),
+    ('load_opa_properties',             {'depends_on': [],
+                                         'tables': ['opa_property']}),
+    ('load_dor_parcels',                {'depends_on': ['load_streets'],
+                                         'tables': ['dor_parcel', 'dor_parcel_error']}),
+    ('load_dor_condos',                 {'depends_on': ['load_dor_parcels'],
+                                         'tables': ['dor_condominium', 'dor_condominium_error']}),
+    ('load_pwd_parcels',                {'depends_on': [],
+                                         'tables': ['pwd_parcel']}),
+    ('load_curbs',                      {'depends_on': ['load_dor_parcels', 'load_pwd_parcels'],
+                                         'tables': ['curb', 'parcel_curb']}),
+    ('load_addresses',                  {'depends_on': ['load_streets', 'load_opa_properties', 'load_dor_parcels',
+                                                        'load_dor_condos', 'load_pwd_parcels'],
+                                         'tables': ['address', 'address_tag', 'address_link', 'address_street',
+                                                    'address_parcel', 'address_property', 'address_error',
+                                                    'source_address', 'address_change']}),
+    ('geocode_addresses',               {'depends_on': ['load_addresses', 'load_curbs'],
+                                         'tables': ['geocode']}),
+    ('make_linked_tags',                {'depends_on': ['geocode_addresses'],
+                                         'tables': ['address_tag']}),
+    ('geocode_addresses_from_links',    {'depends_on': ['make_linked_tags'],
+                                         'tables': ['geocode']}),
+    ('make_address_summary',            {'depends_on': ['geocode_addresses_from_links'],
+                                         'tables': ['address_summary', 'owner_token']}),
+    ('load_service_areas',              {'depends_on': [],
+                                         'tables': ['service_area_layer', 'service_area_polygon',
+                                                    'service_area_line_single', 'service_area_line_dual',
+                                                    'service_area_point']}),
+    ('make_service_area_summary',       {'depends_on': ['make_address_summary', 'load_service_areas'],
+                                         'tables': ['service_area_summary']}),
+])
+ENGINE_SCRIPTS_ALL = list(ENGINE_STAGES)
+ENGINE_BUILD = {
+    'workers':          int(os.environ.get('ENGINE_BUILD_WORKERS', 4)),
+    # Each stage's output, and the record of the last build used to resume it
+    'log_dir':          os.environ.get('ENGINE_BUILD_LOG_DIR',
+                                       os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ais', 'engine', 'log', 'build')),
+    # Rebuild every address rather than only those whose sources changed
+    # (see ais/engine/changes.py)
+    'full_rebuild':     (os.environ.get('ENGINE_FULL_REBUILD', 'False').title() == 'True'),
+    # Processes load_addresses parses source addresses with, and how many
+    # addresses each is given at a time
+    'parse_workers':    int(os.environ.get('ENGINE_PARSE_WORKERS', os.cpu_count() or 1)),
+    'parse_chunk_size': int(os.environ.get('ENGINE_PARSE_CHUNK_SIZE', 1000)),
+    # Connections make_service_area_summary finds layer values on in parallel
+    'service_area_workers': int(os.environ.get('ENGINE_SERVICE_AREA_WORKERS', 4)),
+}
+
 BASE_DATA_SOURCES = {
     'streets': {
         'db':               'gis',